@@ -7,22 +7,46 @@ All functions needed for the various steps of the project are stored here.
 @author: sebas
 """
 
+import os
+import sys
+import json
+import math
+import time
+import shutil
+import sqlite3
+import hashlib
+import tempfile
+import threading
+import multiprocessing
+from abc import ABC, abstractmethod
+from collections import deque, OrderedDict
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from datetime import datetime, timedelta
 import requests
 import numpy as np
+from numpy.lib.stride_tricks import sliding_window_view
 
 
 
 #----------------- Functions related to obtaining price data -----------------
 
-def dl_historical_data(product_id, start_time, end_time, granularity):
-    ''' Uses the Coinbase Pro API to import historical data'''
+coinbase_url = 'https://api.pro.coinbase.com'
+
+
+def dl_historical_data(product_id, start_time, end_time, granularity, session=None, base_url=coinbase_url):
+    ''' Uses the Coinbase Pro API to import historical data. A 
+    requests.Session can be passed to reuse its connection'''
     
     time_data = {
             'start': start_time,
             'end': end_time,
             'granularity': granularity
     }
-    response = requests.get('https://api.pro.coinbase.com/products/' + product_id + '/candles', params=time_data)
+    
+    if session is None:
+        session = requests
+    
+    response = session.get(base_url + '/products/' + product_id + '/candles', params=time_data)
     
     # check for invalid api response
     if response.status_code != 200:
@@ -31,494 +55,4457 @@ def dl_historical_data(product_id, start_time, end_time, granularity):
     return response.json()
 
 
+class TokenBucket:
+    
+    '''Thread-safe token bucket rate limiter. Allows bursts of up to 
+    "capacity" requests, and "rate" requests per second on average'''
+    
+    def __init__(self, rate, capacity=None):
+        self.rate = rate
+        self.capacity = capacity if capacity is not None else max(1, rate)
+        self.tokens = self.capacity
+        self.updated = time.monotonic()
+        self.lock = threading.Lock()
+    
+    
+    def acquire(self):
+        
+        '''Blocks until a token is available, then takes it'''
+        
+        while True:
+            with self.lock:
+                now = time.monotonic()
+                self.tokens = min(self.capacity, self.tokens + (now-self.updated)*self.rate)
+                self.updated = now
+                
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                
+                wait = (1-self.tokens)/self.rate
+            
+            time.sleep(wait)
+
+
+def download_historical_data(product_id, end_time, N_imports, granularity, filename, 
+                             max_workers=8, rate=5, max_retries=5, checkpoint_every=50, 
+                             base_url=coinbase_url):
+    
+    '''
+    Downloads N_imports consecutive requests' worth of candles (300 each), 
+    going back in time from end_time (a datetime), and saves them to filename 
+    in the same format as the old import loop: newest candles first, one row 
+    per candle, as returned by dl_historical_data. Returns the data as well.
+    
+    Requests are sent from max_workers threads at once, each with its own 
+    pooled connection, while a shared TokenBucket keeps the overall rate 
+    below "rate" requests per second. Failed requests are retried up to 
+    max_retries times with exponential backoff.
+    
+    Each request gets its own fixed slot in a preallocated file 
+    (filename + '.part'), and the finished requests are listed in a manifest 
+    (filename + '.manifest.json') every checkpoint_every requests. If the 
+    download crashes, calling this again for the same product, granularity 
+    and number of requests only downloads what's missing (keeping the end 
+    time of the first attempt). base_url can point at a local stand-in server 
+    for testing.
+    '''
+    
+    slot_size = 301 # start and end are both included, so a request can return up to 301 candles
+    
+    part_filename = filename + '.part'
+    manifest_filename = filename + '.manifest.json'
+    
+    request_info = {'product_id': product_id, 
+                    'end_time': end_time.isoformat(), 
+                    'N_imports': N_imports, 
+                    'granularity': granularity}
+    
+    manifest = None
+    if os.path.isfile(manifest_filename) and os.path.isfile(part_filename):
+        with open(manifest_filename) as f:
+            manifest = json.load(f)
+        
+        # an unfinished download of the same thing is resumed with its original end time
+        if all(manifest['request'][key] == request_info[key] for key in ['product_id', 'N_imports', 'granularity']):
+            request_info['end_time'] = manifest['request']['end_time']
+            end_time = datetime.fromisoformat(request_info['end_time'])
+            print('Resuming download ending at ' + request_info['end_time'])
+        else:
+            manifest = None
+    
+    if manifest is None:
+        manifest = {'request': request_info, 'counts': {}}
+        slots = np.lib.format.open_memmap(part_filename, mode='w+', dtype='float64', shape=(N_imports, slot_size, 6))
+    else:
+        slots = np.lib.format.open_memmap(part_filename, mode='r+')
+    
+    counts = {int(i): manifest['counts'][i] for i in manifest['counts']}
+    
+    def save_manifest():
+        slots.flush()
+        manifest['counts'] = {str(i): counts[i] for i in counts}
+        with open(manifest_filename + '.tmp', 'w') as f:
+            json.dump(manifest, f)
+        os.replace(manifest_filename + '.tmp', manifest_filename) # never leaves a half-written manifest behind
+    
+    bucket = TokenBucket(rate)
+    sessions = threading.local()
+    
+    def download_window(i):
+        
+        # one session per thread keeps its connection open between requests
+        if not hasattr(sessions, 'session'):
+            sessions.session = requests.Session()
+        
+        starttime = (end_time - timedelta(seconds=granularity*300*(i+1))).isoformat()
+        endtime = (end_time - timedelta(seconds=granularity*300*i)).isoformat()
+        
+        for attempt in range(max_retries+1):
+            bucket.acquire()
+            try:
+                subdata = np.array(dl_historical_data(product_id, starttime, endtime, granularity, session=sessions.session, base_url=base_url), dtype='float64')
+                break
+            except Exception:
+                if attempt == max_retries:
+                    raise
+                time.sleep(min(30, 0.5*2**attempt)*(1 + np.random.random()))
+        
+        subdata = subdata.reshape(-1, 6)
+        slots[i,:len(subdata),:] = subdata
+        
+        return i, len(subdata)
+    
+    todo = [i for i in range(N_imports) if i not in counts]
+    
+    start = time.time()
+    
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        
+        futures = [executor.submit(download_window, i) for i in todo]
+        
+        try:
+            for n_done, future in enumerate(as_completed(futures), 1):
+                
+                i, count = future.result()
+                counts[i] = count
+                
+                # Periodically report progress and save a checkpoint
+                if n_done % checkpoint_every == 0:
+                    save_manifest()
+                    
+                    progress = 100*n_done/len(todo)
+                    print("{:.1f}".format(progress) + '% complete after ' + "{:.2f}".format(time.time() - start) + ' s.')
+        
+        except BaseException:
+            for future in futures:
+                future.cancel()
+            save_manifest()
+            raise
+    
+    save_manifest()
+    
+    # put the windows back together, newest first, dropping candles that 
+    # appear in two neighbouring windows
+    data = np.concatenate([slots[i,:counts[i],:] for i in range(N_imports)])
+    
+    if len(data) > 0:
+        data = data[np.argsort(-data[:,0], kind='stable')]
+        data = data[np.concatenate(([True], data[1:,0] != data[:-1,0]))]
+    
+    np.save(filename, data)
+    
+    del slots
+    os.remove(part_filename)
+    os.remove(manifest_filename)
+    
+    return data
+
+
+def fill_candle_gaps(data, imp_step, prev_row=None):
+    ''' Fills in missing candles in data (sorted from earliest to latest), 
+    giving each one OLHC equal to the previous candle's close and 0 volume. 
+    If prev_row is given, it's the candle just before data (e.g. the last 
+    candle already stored), and any candles missing between it and data are 
+    filled in as well. prev_row itself isn't included in the output.
+    
+    Every row of the output is written exactly once: the number of candles 
+    missing after each candle gives the row each one moves to, and the 
+    missing ones are filled in between with a few vectorized operations, so 
+    this takes linear time even with thousands of gaps. Timestamps are 
+    assumed to be multiples of imp_step apart, which is always the case for 
+    Coinbase data'''
+    
+    if prev_row is not None:
+        data = np.vstack((np.reshape(prev_row, (1,-1)).astype(data.dtype), data))
+    
+    data_spacing = data[1:,0]-data[:-1,0]
+    
+    # number of candles missing after each candle
+    missing_rows = np.zeros(len(data), dtype='int64')
+    missing_rows[:-1] = np.where(data_spacing>imp_step, data_spacing/imp_step - 1, 0).astype('int64')
+    
+    # row of data_complete where each candle ends up
+    new_inds = np.arange(len(data)) + np.concatenate(([0], np.cumsum(missing_rows)[:-1]))
+    
+    data_complete = np.empty((len(data) + np.sum(missing_rows), data.shape[1]), dtype=data.dtype)
+    data_complete[new_inds,:] = data
+    
+    # for every missing candle, the candle it follows and how many candles after it it is
+    prev_inds = np.repeat(np.arange(len(data)), missing_rows)
+    steps = np.arange(len(prev_inds)) - np.repeat(np.cumsum(missing_rows) - missing_rows, missing_rows) + 1
+    
+    fill_inds = new_inds[prev_inds] + steps
+    
+    data_complete[fill_inds,0] = data[prev_inds,0] + steps*imp_step # time, low, high, open, close, volume
+    data_complete[fill_inds,1:5] = data[prev_inds,4][:,np.newaxis]
+    data_complete[fill_inds,5] = 0
+    
+    if prev_row is not None:
+        data_complete = data_complete[1:]
+    
+    return data_complete
+
+
 def clean_historical_data(filename):
     ''' Fills in missing candles from the data imported using 
-    dl_historical_data'''
+    dl_historical_data (see fill_candle_gaps)'''
 
     data = np.load(filename)
     data = np.flipud(data) # Put earliest candles at the top
     
-    data_complete = np.copy(data)
-    
     data_spacing = data[1:,0]-data[:-1,0]
     
     imp_step = np.min(data_spacing) # Desired candle width
     
-    data_gaps = np.where(data_spacing>imp_step)[0] # Locate indices where gaps larger than imp_step appear
+    return fill_candle_gaps(data, imp_step)
+
+
+# names of the 6 columns returned by Coinbase, in the order they're stored in the .npy files
+candle_columns = ['time', 'low', 'high', 'open', 'close', 'volume']
+
+
+class CandleData:
+    
+    '''
+    Read-only 2D view of some of the columns of a candle store (see 
+    save_candle_store), that can be used wherever data_comp is used. Each 
+    column is a memory-mapped array, so selecting a single column, like 
+    data_comp[:,3] or data_comp[inds,3], costs nothing and reads only the 
+    pages that are actually used. Selecting several columns at once builds 
+    a normal numpy array of just the selected rows.
+    '''
+    
+    def __init__(self, arrays, columns, folder=None, start=0):
+        self.arrays = arrays
+        self.columns = columns
+        self.folder = folder
+        self.start = start
+        self.shape = (len(arrays[0]), len(arrays))
+        self.ndim = 2
+    
     
-    offset = int(0)
+    def __len__(self):
+        return self.shape[0]
     
-    for i in range(len(data_gaps)):
+    
+    def __getitem__(self, key):
         
-        missing_rows = int(data_spacing[data_gaps[i]]/imp_step - 1)
+        if not isinstance(key, tuple):
+            key = (key, slice(None))
         
-        newrows = np.array([[data_complete[data_gaps[i]+offset,0]+imp_step, # time, low, high, open, close, volume
-                         data_complete[data_gaps[i]+offset,4],
-                         data_complete[data_gaps[i]+offset,4],
-                         data_complete[data_gaps[i]+offset,4],
-                         data_complete[data_gaps[i]+offset,4],
-                         0]])
+        rows, cols = key
         
-        if missing_rows>1: # If more than one candle is missing in a row
-            
-            for j in range(1,missing_rows):
-                
-                newrows = np.vstack([newrows,
-                                  np.array([[newrows[j-1,0]+imp_step,
-                                          newrows[j-1,1],
-                                          newrows[j-1,2],
-                                          newrows[j-1,3],
-                                          newrows[j-1,4],
-                                          newrows[j-1,5]]])])
+        if isinstance(cols, (int, np.integer)):
+            return self.arrays[cols][rows]
         
-        data_complete = np.insert(data_complete, data_gaps[i]+1+offset, newrows, 0)
+        if isinstance(cols, slice):
+            arrays = self.arrays[cols]
+        else:
+            arrays = [self.arrays[k] for k in cols]
         
-        offset += missing_rows
+        if isinstance(rows, (int, np.integer)):
+            return np.array([array[rows] for array in arrays])
         
-        if i % 100 == 0:
-            print("{:.1f}".format(100*i/len(data_gaps)) + '% complete')
+        return np.column_stack([array[rows] for array in arrays])
     
-    return data_complete
+    
+    def __reduce__(self):
+        # when sent to another process, reopen the store there instead of copying the data
+        if self.folder is not None:
+            return (load_candle_store, (self.folder, self.columns, self.start, self.start + len(self)))
+        return (CandleData, (self.arrays, self.columns))
+    
+    
+    def __array__(self, dtype=None, copy=None):
+        data = np.column_stack(self.arrays)
+        return data if dtype is None else data.astype(dtype)
 
 
+def save_candle_store(data, folder, trading_pair=None, imp_step=None):
+    
+    '''Saves candle data (time, low, high, open, close, volume as returned by 
+    clean_historical_data) as a columnar store: one raw float64 file per 
+    column in folder, plus meta.json describing them. Columns can then be 
+    memory-mapped individually by load_candle_store'''
+    
+    if not os.path.isdir(folder):
+        os.makedirs(folder)
+    
+    for k in range(len(candle_columns)):
+        np.ascontiguousarray(data[:,k], dtype='<f8').tofile(os.path.join(folder, candle_columns[k] + '.bin'))
+    
+    if imp_step is None and len(data) > 1:
+        imp_step = int(data[1,0]-data[0,0])
+    
+    meta = {'trading_pair': trading_pair, 
+            'imp_step': imp_step, 
+            'n_rows': len(data), 
+            'columns': candle_columns, 
+            'dtype': '<f8'}
+    
+    with open(os.path.join(folder, 'meta.json'), 'w') as f:
+        json.dump(meta, f, indent=4)
 
-#------------ Functions related to generating and testing signals ------------
 
+def load_candle_store_meta(folder):
+    with open(os.path.join(folder, 'meta.json')) as f:
+        return json.load(f)
 
 
-def signal_generator_function(data):
-    ''' This is a dummy function that will just generate a random set of 
-    signals throughout the time period covered by "data"'''
+def load_candle_store(folder, columns=('time', 'low', 'high', 'close'), start=0, end=None):
     
-    # Generate random (approximate) number of trade signals over the period covered by data
-    signals_length = np.random.randint(len(data))
+    '''Memory-maps the chosen columns of a candle store for rows [start, end). 
+    Returns a CandleData whose column k is columns[k], so the default gives 
+    the same layout as data_comp[:,[0,1,2,4]]. Row indices used with it are 
+    relative to start, so signals and events should use start=0'''
     
-    # Generate random times for trade signals to occur (as indices of data). 
-    # Because randint can generate duplicates, this might be shorter than 
-    # signals_length, but in this example it doesn't really matter.
-    rand_ints = np.unique(np.sort(np.random.randint(0,len(data), size=signals_length)))
+    meta = load_candle_store_meta(folder)
     
-    # First column is index in data where the signal occurs, second column is 
-    # the type of signal (1=increase long position, -1 = increase short position)
-    signals = np.zeros((len(rand_ints),2)) 
+    if end is None or end > meta['n_rows']:
+        end = meta['n_rows']
     
-    signals[:,0] = rand_ints
+    itemsize = np.dtype(meta['dtype']).itemsize
     
-    rand_signs = np.random.randint(0,2, size = len(rand_ints))
-    rand_signs[rand_signs==0]=-1
+    arrays = []
+    for name in columns:
+        if end > start:
+            arrays.append(np.asarray(np.memmap(os.path.join(folder, name + '.bin'), dtype=meta['dtype'], mode='r', offset=start*itemsize, shape=(end-start,))))
+        else:
+            arrays.append(np.empty(0, dtype=meta['dtype']))
     
-    signals[:,1] = rand_signs
+    return CandleData(arrays, list(columns), folder, start)
+
+
+def candle_store_from_npy(filename, folder, trading_pair=None):
+    '''Converts one of the old ..._complete.npy files into a candle store'''
+    save_candle_store(np.load(filename, mmap_mode='r'), folder, trading_pair)
+
+
+def append_candle_store(folder, data):
     
-    return signals
+    '''Appends candles (time, low, high, open, close, volume, earliest first) 
+    to the end of a candle store in place. Only the new rows are written, and 
+    meta.json is updated last, so an interrupted append leaves the store as 
+    it was (any partially written rows are ignored and overwritten next time)'''
+    
+    meta = load_candle_store_meta(folder)
+    
+    itemsize = np.dtype(meta['dtype']).itemsize
+    
+    for k in range(len(meta['columns'])):
+        with open(os.path.join(folder, meta['columns'][k] + '.bin'), 'r+b') as f:
+            f.seek(meta['n_rows']*itemsize)
+            f.write(np.ascontiguousarray(data[:,k], dtype=meta['dtype']).tobytes())
+            f.truncate()
+    
+    meta['n_rows'] += len(data)
+    
+    with open(os.path.join(folder, 'meta.json.tmp'), 'w') as f:
+        json.dump(meta, f, indent=4)
+    os.replace(os.path.join(folder, 'meta.json.tmp'), os.path.join(folder, 'meta.json'))
 
 
-def generate_inputs(data_comp, fitlength, i, range_length):
-    ''' This function produces a list of indices in data_comp where the 
-    signal_generator function should be applied. It essentially filters out 
-    long flat sections of data_comp that may lead to meaningless or unreliable 
-    behavior from the signal generator function. These flat sections typically 
-    correspond to times when the Coinbase servers went down.'''
+def update_candle_store(folder, trading_pair=None, imp_step=None, **download_args):
     
-    searchrange = range(i+1,i+range_length+1)
+    '''Brings a candle store up to date without downloading everything again. 
+    Only candles after the last stored one are downloaded (with 
+    download_historical_data, which download_args are passed on to), gaps 
+    are filled in from the last stored candle onwards, and the new rows are 
+    appended in place, so the cost only depends on how much new data there 
+    is. The candle that's still in progress is left out. Returns the number 
+    of rows added'''
     
-    currentlen = 1 #will track the length of the current flat section
+    meta = load_candle_store_meta(folder)
     
-    currentlenstart = searchrange[0] #used to make the start of the current flat section
+    trading_pair = trading_pair if trading_pair is not None else meta['trading_pair']
+    imp_step = imp_step if imp_step is not None else meta['imp_step']
     
-    flats = np.empty((0,2)).astype(int)
+    last_row = load_candle_store(folder, candle_columns, meta['n_rows']-1)[0,:]
+    last_time = last_row[0]
     
-    for p in searchrange:
-        
-        #Step through the search range, and if a candle close is identical to 
-        #the previous candle's close, add one to the length of the current flat section
-        if data_comp[p,1] == data_comp[p-1,1]:
-            currentlen+=1
-        
-        #If the current close price differs from the previous candle's, check 
-        #how long the current flat section is, and if it's too long 
-        #(>fitlength/2), add that section to "flats"
-        else:
-            if currentlen>fitlength/2:
-                flats = np.vstack((flats,[currentlenstart,currentlen]))
-            currentlen = 1 #reset currentlen and currentlenstart after adding to flats
-            currentlenstart = p
+    # Coinbase times are in UTC
+    timenow = datetime.utcnow()
+    now_timestamp = (timenow - datetime(1970,1,1)).total_seconds()
+    
+    N_new = int((now_timestamp - last_time)//imp_step)
     
-    #excepts is a list of indices marking places where the signal generator function will not be run
-    excepts = list(range(fitlength))
+    if N_new <= 0:
+        return 0
     
-    for k in range(len(flats)):
-        excepts = excepts + list(range(flats[k,0],sum(flats[k,:])+fitlength))
+    N_imports = int(np.ceil(N_new/300))
     
+    update_filename = os.path.normpath(folder) + '_update.npy'
     
-    inputs = list(range(i,i+range_length)) #initialize inputs list as full range
+    data = download_historical_data(trading_pair, timenow, N_imports, imp_step, update_filename, **download_args)
+    os.remove(update_filename)
     
-    inputs = [x for x in inputs if x not in excepts] #remove exceptions
+    # only complete candles after the last stored one, earliest first
+    data = data[np.logical_and(data[:,0] > last_time, data[:,0] + imp_step <= now_timestamp)]
+    data = np.flipud(data)
     
-    return inputs
+    if len(data) == 0:
+        return 0
+    
+    data = fill_candle_gaps(data, imp_step, prev_row=last_row)
+    
+    append_candle_store(folder, data)
+    
+    return len(data)
 
 
-def merge_signals(fitlength, range_length, start_subsection, end_subsection):
-    '''Merges the subsection signals from start_subsection to end_subsection '''
+# candle widths (in seconds) that Coinbase offers, which the coarser levels of a candle pyramid are built at
+pyramid_widths = [300, 900, 3600, 21600, 86400]
+
+
+def candle_store_name(trading_pair, imp_step):
+    '''Folder name of the candle store of a trading pair and candle width, as 
+    used in historical_data_importer.py'''
+    return trading_pair + '_historical_data_' + str(int(imp_step/60)) + 'min_complete'
+
+
+def resample_candles(data, width, imp_step):
     
-    total_signals = np.empty((0,3))
+    '''Combines candles imp_step seconds wide (time, low, high, open, close, 
+    volume, earliest first and without gaps, e.g. a CandleData of all the 
+    columns of a candle store) into candles width seconds wide: lowest low, 
+    highest high, first open, last close and total volume. Like Coinbase's, 
+    the new candles start at multiples of width (in UTC), and any new candle 
+    that data doesn't fully cover (at the start or end) is left out.
     
+    The candles are grouped by where their time/width changes, and each 
+    column is aggregated in one go with reduceat, so this is linear in the 
+    number of candles and reads each column once'''
     
-    folder = 'signals_flen' + str(fitlength)
+    if width % imp_step != 0:
+        raise ValueError('width must be a multiple of imp_step')
     
-    for i in [e*range_length for e in range(start_subsection,end_subsection)]:
+    factor = int(width//imp_step)
+    
+    times = data[:,0]
+    
+    if len(times) == 0:
+        return np.empty((0, len(candle_columns)))
+    
+    bins = np.floor_divide(times, width)
+    
+    # first row of each new candle, and how many rows it's made of
+    starts = np.flatnonzero(np.concatenate(([True], bins[1:] != bins[:-1])))
+    counts = np.diff(np.append(starts, len(times)))
+    ends = starts + counts - 1
+    
+    candles = np.empty((len(starts), len(candle_columns)))
+    candles[:,0] = bins[starts]*width
+    candles[:,1] = np.minimum.reduceat(data[:,1], starts)
+    candles[:,2] = np.maximum.reduceat(data[:,2], starts)
+    candles[:,3] = data[starts,3]
+    candles[:,4] = data[ends,4]
+    candles[:,5] = np.add.reduceat(data[:,5], starts)
+    
+    return candles[counts == factor]
+
+
+def update_candle_pyramid(folder, widths=pyramid_widths, folders=None):
+    
+    '''Builds the coarser levels of a candle pyramid from the candle store in 
+    folder (normally the 1 minute candles), or brings them up to date after 
+    new candles have been appended to it. Each level is a normal candle store 
+    (next to folder and named with candle_store_name, unless folders are 
+    given), so any script can use it just by changing imp_step, without 
+    downloading anything. Widths that aren't wider than the candles in folder 
+    are skipped.
+    
+    Each level is made from the widest level below it that its width is a 
+    multiple of (e.g. 1 hour candles from the 15 minute ones), and a level 
+    that already exists only gets the candles after its last one appended, 
+    so keeping the pyramid up to date only reads the new rows. Returns a dict 
+    of the number of candles added to each level'''
+    
+    meta = load_candle_store_meta(folder)
+    
+    if folders is None:
+        if meta['trading_pair'] is None:
+            raise ValueError('the candle store has no trading pair, so folders must be given')
+        parent = os.path.dirname(os.path.normpath(folder))
+        folders = [os.path.join(parent, candle_store_name(meta['trading_pair'], width)) for width in widths]
+    
+    levels = [(meta['imp_step'], folder)] # (width, folder) of every level built so far
+    added_rows = {}
+    
+    for width, level_folder in sorted(zip(widths, folders)):
         
-        signals = np.load('Example_signal_A/' + folder + '/' + folder + '_range' + str(i) + '_' + str(i+range_length) + '.npy')
+        if width <= meta['imp_step']:
+            continue
         
-        total_signals = np.vstack((total_signals, signals))
+        sources = [level for level in levels if width % level[0] == 0]
+        if len(sources) == 0:
+            raise ValueError('candle width ' + str(width) + ' is not a multiple of ' + str(meta['imp_step']))
+        source_step, source_folder = max(sources)
+        
+        # rows of the source level after the last candle of this level
+        start = 0
+        if os.path.isdir(level_folder):
+            n_rows = load_candle_store_meta(level_folder)['n_rows']
+            if n_rows > 0:
+                last_time = load_candle_store(level_folder, ('time',), n_rows-1)[0,0]
+                start = int(np.searchsorted(load_candle_store(source_folder, ('time',))[:,0], last_time + width))
+        
+        candles = resample_candles(load_candle_store(source_folder, candle_columns, start), width, source_step)
+        
+        if os.path.isdir(level_folder):
+            append_candle_store(level_folder, candles)
+        else:
+            save_candle_store(candles, level_folder, meta['trading_pair'], width)
+        
+        added_rows[width] = len(candles)
+        levels.append((width, level_folder))
     
-    np.save('Example_signal_A/' + folder + '/' + folder + '_range' + str(start_subsection*range_length) + '_' + str(end_subsection*range_length) + '.npy',total_signals)
+    return added_rows
 
 
+def to_datetime64(timestamps):
+    '''Vectorized replacement for np.vectorize(datetime.fromtimestamp): converts 
+    unix timestamps (in seconds) to datetime64, which matplotlib can plot 
+    directly. Note that datetime64 is always UTC, not local time'''
+    return np.asarray(timestamps).astype('int64').astype('datetime64[s]')
 
-#------ Functions for testing trading strategies based on the signals --------
 
+def to_timestamp(t):
+    '''Converts a unix timestamp, datetime (UTC), datetime64 or date string 
+    like '2021-06-01 12:00' to a unix timestamp in seconds'''
+    if isinstance(t, (int, float, np.integer, np.floating)):
+        return float(t)
+    return float(np.datetime64(t, 's').astype('int64'))
 
 
-def calc_max_drawdown(balance_ext):
+class TimeIndex:
     
-    """Takes in a balance_ext matrix and determines the largest drawdown over 
-    the covered time period"""
+    '''
+    Converts candle times to rows of the candle data and back. After 
+    clean_historical_data the candles are exactly imp_step seconds apart, 
+    so the row of a time is just (time - first time)/imp_step. That's 
+    checked once for the whole time column when the index is made, and if 
+    the candles turn out not to be uniform (or imp_step isn't given and 
+    can't be worked out) it falls back to a binary search over the times. 
+    Either way, whole arrays of times are converted at once. 
+    '''
     
-    largest_drawdown = 0
+    def __init__(self, times, imp_step=None):
+        
+        self.times = times
+        self.n_rows = len(times)
+        self.t0 = float(times[0]) if self.n_rows > 0 else 0.
+        
+        if imp_step is None and self.n_rows > 1:
+            imp_step = float(times[1] - times[0])
+        
+        self.imp_step = imp_step
+        
+        self.uniform = (self.n_rows <= 1 or
+                        (imp_step is not None and imp_step > 0
+                         and times[self.n_rows-1] - self.t0 == (self.n_rows-1)*imp_step
+                         and bool(np.all(np.diff(times) == imp_step))))
     
-    i = 0
     
-    while i < len(balance_ext)-1:
-        if balance_ext[i,1]>balance_ext[i+1,1]:
-            drawdown_range_end = np.where(balance_ext[i+1:,1]>balance_ext[i,1])[0]
-            if len(drawdown_range_end)>0:
-                drawdown = 1-min(balance_ext[i+1:i+drawdown_range_end[0]+1,1])/balance_ext[i,1]
-                
-                if drawdown>largest_drawdown:
-                    largest_drawdown = drawdown
-                    largest_drawdown_index = i
-                    min_index = np.argmin(balance_ext[i+1:i+drawdown_range_end[0]+1,1]) + i + 1
-                i += drawdown_range_end[0]+1
+    def rows(self, times, exact=True):
+        
+        '''Rows of the candles at the given times. With exact=True every time 
+        has to be the time of one of the candles (otherwise a ValueError is 
+        raised). With exact=False it's the row of the last candle at or 
+        before each time (-1 if before the first candle)'''
+        
+        times = np.asarray(times, dtype='float64')
+        scalar = times.ndim == 0
+        times = np.atleast_1d(times)
+        
+        if self.uniform and self.imp_step is not None:
+            
+            rows = np.floor((times - self.t0)/self.imp_step).astype('int64')
+            
+            if exact:
+                found = np.logical_and(rows >= 0, rows < self.n_rows)
+                found[found] = (self.t0 + rows[found]*self.imp_step == times[found])
             else:
-                drawdown = 1-min(balance_ext[i+1:,1])/balance_ext[i,1]
-                if drawdown>largest_drawdown:
-                    largest_drawdown = drawdown
-                    largest_drawdown_index = i
-                    min_index = np.argmin(balance_ext[i+1:,1]) + i + 1
-                break
+                rows = np.clip(rows, -1, self.n_rows-1)
+        
         else:
-            i+=1
+            
+            rows = np.searchsorted(self.times, times, side='right') - 1
+            
+            if exact:
+                found = rows >= 0
+                found[found] = self.times[rows[found]] == times[found]
+        
+        if exact and not np.all(found):
+            raise ValueError(str(np.count_nonzero(~found)) + ' of the times are not candle times, e.g. ' + str(times[~found].flat[0]))
+        
+        return rows[0] if scalar else rows
+    
+    
+    def row(self, t, exact=True):
+        '''Same as rows, but for a single time (anything to_timestamp accepts)'''
+        return int(self.rows(to_timestamp(t), exact))
+    
+    
+    def rows_between(self, start, end):
+        
+        '''Returns (first row, last row + 1) of the candles from start up to 
+        (but not including) end, where start and end can be anything 
+        to_timestamp accepts, so ranges can be picked by date'''
+        
+        start_row = self.row(start, exact=False)
+        if start_row < 0 or self.times[start_row] < to_timestamp(start):
+            start_row += 1
+        
+        end_row = self.row(end, exact=False)
+        if end_row < 0 or self.times[end_row] < to_timestamp(end):
+            end_row += 1
+        
+        return start_row, end_row
+    
     
-    return largest_drawdown, largest_drawdown_index, min_index
+    def datetimes(self, rows):
+        '''datetime64 of the candles at the given rows'''
+        rows = np.asarray(rows).astype('int64')
+        if self.uniform and self.imp_step is not None:
+            return to_datetime64(self.t0 + rows*self.imp_step)
+        return to_datetime64(self.times[rows])
 
 
-def process_sigs(events, price_data, sigs_w_close, lev, lev_limit, slippage):
+def load_time_index(data_comp, folder=None):
+    '''TimeIndex for column 0 of data_comp, using the imp_step of the candle 
+    store in folder if there is one'''
+    imp_step = None
+    if folder is not None and os.path.isdir(folder):
+        imp_step = load_candle_store_meta(folder)['imp_step']
+    return TimeIndex(data_comp[:,0], imp_step)
+
+
+class PriceRangeIndex:
     
-    """This piece takes over once 'events' has been generated, and calculates 
-    gains, losses, balance over time, total profits before and after tax, etc. 
+    '''Block min/max pyramid over the low and high columns of the price data, 
+    used to answer range queries without scanning the raw candles. Level k 
+    holds the min (for lows) or max (for highs) of consecutive blocks of 2**k 
+    candles, so every query only needs to touch O(log n) entries.
     
-    events is a list of all events (increase/decrease long/short position, by how much, and when)
+    Build it once per dataset with load_price_range_index, which caches the 
+    pyramid on disk next to the .npy file.'''
     
-    price_data is just the historical price data
+    def __init__(self, lows, highs, min_levels=None, max_levels=None):
+        
+        # level 0 is the raw data itself, so it isn't copied or cached
+        self.mins = [lows]
+        self.maxs = [highs]
+        
+        if min_levels is None:
+            min_levels, max_levels = self._build_levels(lows, highs)
+        
+        self.mins += min_levels
+        self.maxs += max_levels
+        self.sizes = [len(level) for level in self.mins]
     
-    sigs_with_close lists the signals when they occur, and when they later get closed
     
-    lev is the leverage used each time a position is added to. it is a 
-    percentage of the current total account balance
+    @classmethod
+    def from_flat_levels(cls, lows, highs, offsets, mins, maxs):
+        '''Rebuilds an index from the output of flat_levels, without copying'''
+        
+        min_levels = [mins[offsets[k]:offsets[k+1]] for k in range(len(offsets)-1)]
+        max_levels = [maxs[offsets[k]:offsets[k+1]] for k in range(len(offsets)-1)]
+        
+        return cls(lows, highs, min_levels, max_levels)
     
-    lev_limit is the maximum total leverage (long + short) allowed. If 
-    reacting to a given signal would cause lev_limit to be exceeded, then the 
-    signal is ignored
     
-    slippage is simply the estimated average slippage per order"""
+    def flat_levels(self):
+        '''Returns all levels above the raw data stored back to back in one 
+        array each for the mins and maxs, plus offsets marking where each 
+        level starts. Used for saving the index or sharing it between processes'''
+        
+        offsets = np.cumsum([0] + [len(level) for level in self.mins[1:]])
+        mins = np.concatenate([np.empty(0)] + self.mins[1:])
+        maxs = np.concatenate([np.empty(0)] + self.maxs[1:])
+        
+        return offsets, mins, maxs
     
-    # balance_ext will list account balance at every minute for the entire period
-    balance_ext = np.zeros((int(1+max(sigs_w_close[:,2]))-int(sigs_w_close[0,0]),2),dtype='float64')
-    balance_ext[:,0] = range(int(sigs_w_close[0,0]),int(1+max(sigs_w_close[:,2])))
-    balance_ext[:,1] = 1
     
-    # will keep track of total gains and losses for calculating profit after taxes later
-    gains = 0
-    losses = 0
+    @staticmethod
+    def _build_levels(lows, highs):
+        
+        min_levels = []
+        max_levels = []
+        
+        current_min = np.asarray(lows)
+        current_max = np.asarray(highs)
+        
+        while len(current_min) > 1:
+            
+            # pad odd lengths with the last element so blocks can be paired up
+            if len(current_min) % 2 == 1:
+                current_min = np.append(current_min, current_min[-1])
+                current_max = np.append(current_max, current_max[-1])
+            
+            current_min = np.minimum(current_min[0::2], current_min[1::2])
+            current_max = np.maximum(current_max[0::2], current_max[1::2])
+            
+            min_levels.append(current_min)
+            max_levels.append(current_max)
+        
+        return min_levels, max_levels
     
-    total_profits = 1
-    total_profits_aft_tax = 1
     
-    # matrix that will keep track of positions over time
-    positions = np.zeros((len(balance_ext),6)) # 0 long pos, 1 short pos, 2 net pos, 3 total pos, 4 long avg entry, 5 short avg entry
+    def _range_reduce(self, levels, i, j, func):
+        
+        result = None
+        k = 0
+        
+        while i < j:
+            if i & 1:
+                result = levels[k][i] if result is None else func(result, levels[k][i])
+                i += 1
+            if j & 1:
+                j -= 1
+                result = levels[k][j] if result is None else func(result, levels[k][j])
+            i >>= 1
+            j >>= 1
+            k += 1
+        
+        return result
     
-    chunk = 10000 #breaks everything up into smaller chunks to avoid many manipulations of large arrays. 10000 seems to be a generally good value
-    offset = 0
     
-    amounts = np.zeros((len(sigs_w_close),1))
+    def range_min(self, i, j):
+        '''Lowest low in rows [i, j). Returns None for an empty range'''
+        return self._range_reduce(self.mins, int(i), int(min(j, self.sizes[0])), min)
     
-    #indices marking the start of each chunk
-    subs_starts = range(np.floor(events[0,0]/chunk).astype(int), np.ceil(events[-1,0]/chunk).astype(int))
     
-    skipped_signals = np.zeros((len(sigs_w_close),1))
+    def range_max(self, i, j):
+        '''Highest high in rows [i, j). Returns None for an empty range'''
+        return self._range_reduce(self.maxs, int(i), int(min(j, self.sizes[0])), max)
     
-    for j in subs_starts:
+    
+    def _first_crossing(self, levels, i, hit):
         
-        sub_events = events[np.logical_and(events[:,0]>=j*chunk, events[:,0]<(j+1)*chunk),:]
-        sub_balance_ext = balance_ext[np.logical_and(balance_ext[:,0]>=j*chunk, balance_ext[:,0]<(j+1)*chunk),:]
-        sub_positions = positions[np.logical_and(balance_ext[:,0]>=j*chunk, balance_ext[:,0]<(j+1)*chunk),:]
-        sub_price_data = price_data[j*chunk:(j+1)*chunk,:]
+        k = 0
+        i = int(i)
         
-        for i in range(len(sub_events)):
-            
-            update_ind = sub_events[i,0]-sub_balance_ext[0,0].astype(int) #current index within the current chunk
-            
-            if sub_events[i,1]==1: #increase long position size
-                
-                if sub_positions[update_ind,3]/sub_balance_ext[update_ind,1] + lev < lev_limit: #check if lev_limit will be exceeded
-                    
+        # go up the pyramid until a block containing a hit is found
+        while True:
+            if i >= self.sizes[k]:
+                return -1
+            if hit(levels[k][i]):
+                break
+            i += 1
+            while i & 1 == 0 and k+1 < len(levels):
+                i >>= 1
+                k += 1
+        
+        # then go back down to the first candle in that block that's a hit
+        while k > 0:
+            k -= 1
+            i <<= 1
+            if not hit(levels[k][i]):
+                i += 1
+        
+        return i
+    
+    
+    def first_low_at_or_below(self, i, price, end=None):
+        '''First row at or after i where the low is <= price, or -1 if there 
+        is none before end'''
+        
+        ind = self._first_crossing(self.mins, i, lambda x: x <= price)
+        if end is not None and ind >= end:
+            return -1
+        return ind
+    
+    
+    def first_high_at_or_above(self, i, price, end=None):
+        '''First row at or after i where the high is >= price, or -1 if there 
+        is none before end'''
+        
+        ind = self._first_crossing(self.maxs, i, lambda x: x >= price)
+        if end is not None and ind >= end:
+            return -1
+        return ind
+    
+    
+    def low_below(self, i, j, price):
+        '''True if the low ever reaches price in rows [i, j)'''
+        low = self.range_min(i, j)
+        return low is not None and low <= price
+    
+    
+    def high_above(self, i, j, price):
+        '''True if the high ever reaches price in rows [i, j)'''
+        high = self.range_max(i, j)
+        return high is not None and high >= price
+
+
+def load_price_range_index(filename, price_data):
+    
+    '''Returns a PriceRangeIndex over columns 1 (low) and 2 (high) of 
+    price_data, which must be the data stored in filename (or a column subset 
+    of it that keeps time, low and high first). filename can also be a 
+    candle store folder. The pyramid is cached next to the .npy file (or 
+    folder) and rebuilt whenever the data is newer than the cache or the 
+    number of rows doesn't match'''
+    
+    if os.path.isdir(filename):
+        cache_filename = os.path.normpath(filename) + '_range_index.npz'
+        data_filename = os.path.join(filename, 'meta.json')
+    else:
+        cache_filename = os.path.splitext(filename)[0] + '_range_index.npz'
+        data_filename = filename
+    
+    lows = price_data[:,1]
+    highs = price_data[:,2]
+    
+    if os.path.isfile(cache_filename) and os.path.getmtime(cache_filename) >= os.path.getmtime(data_filename):
+        
+        cache = np.load(cache_filename)
+        
+        if int(cache['n_rows']) == len(price_data):
+            
+            return PriceRangeIndex.from_flat_levels(lows, highs, cache['offsets'], cache['mins'], cache['maxs'])
+    
+    range_index = PriceRangeIndex(lows, highs)
+    
+    offsets, mins, maxs = range_index.flat_levels()
+    
+    # several processes can build the same cache at once (e.g. backtest_pairs 
+    # or walk_forward workers), so it's written under a name of its own first 
+    # and then moved into place, and nobody ever reads a half-written file
+    tmp_filename = cache_filename + '.' + str(os.getpid()) + '.tmp.npz'
+    np.savez(tmp_filename, n_rows=len(price_data), offsets=offsets, mins=mins, maxs=maxs)
+    os.replace(tmp_filename, cache_filename)
+    
+    return range_index
+
+
+
+#------------ Functions related to generating and testing signals ------------
+
+
+
+def signal_generator_function(data):
+    ''' This is a dummy function that will just generate a random set of 
+    signals throughout the time period covered by "data"'''
+    
+    # Generate random (approximate) number of trade signals over the period covered by data
+    signals_length = np.random.randint(len(data))
+    
+    # Generate random times for trade signals to occur (as indices of data). 
+    # Because randint can generate duplicates, this might be shorter than 
+    # signals_length, but in this example it doesn't really matter.
+    rand_ints = np.unique(np.sort(np.random.randint(0,len(data), size=signals_length)))
+    
+    # First column is index in data where the signal occurs, second column is 
+    # the type of signal (1=increase long position, -1 = increase short position)
+    signals = np.zeros((len(rand_ints),2)) 
+    
+    signals[:,0] = rand_ints
+    
+    rand_signs = np.random.randint(0,2, size = len(rand_ints))
+    rand_signs[rand_signs==0]=-1
+    
+    signals[:,1] = rand_signs
+    
+    return signals
+
+
+def signal_generator_batch(windows):
+    ''' Batched version of signal_generator_function (and just as much of a 
+    dummy). Instead of one window of data at a time, it gets a whole block 
+    of consecutive windows: windows[k] is the fitlength rows of data_comp 
+    before the k-th index of the block, so windows has the shape 
+    (number of indices, fitlength, number of columns). It's a read-only 
+    strided view (see run_signal_block), so it mustn't be written to. 
+    
+    Returns one row per window: the time at which the signal occurs (here 
+    the last candle in the window) and the type of signal (1=increase long 
+    position, -1 = increase short position, 0 = no signal)'''
+    
+    results = np.zeros((len(windows),2))
+    
+    results[:,0] = windows[:,-1,0]
+    
+    # randomly give about one in a hundred windows a long or short signal
+    rand_signs = np.random.randint(-1,2, size=len(windows))
+    rand_signs[np.random.random(len(windows)) > 0.01] = 0
+    
+    results[:,1] = rand_signs
+    
+    return results
+
+
+def split_into_blocks(inputs, n_blocks):
+    ''' Splits a sorted array of indices into blocks of consecutive indices, 
+    so each block can be run by a batched signal generator in one go. Blocks 
+    end wherever inputs skips indices, and are limited to about 
+    len(inputs)/n_blocks indices each. Returns a list of (first, last+1) pairs'''
+    
+    inputs = np.asarray(inputs)
+    
+    if len(inputs) == 0:
+        return []
+    
+    max_size = int(np.ceil(len(inputs)/n_blocks))
+    
+    # start and end of every run of consecutive indices
+    breaks = np.nonzero(np.diff(inputs) != 1)[0] + 1
+    run_starts = inputs[np.concatenate(([0], breaks))]
+    run_ends = inputs[np.concatenate((breaks-1, [len(inputs)-1]))] + 1
+    
+    blocks = []
+    for run_start, run_end in zip(run_starts.tolist(), run_ends.tolist()):
+        for block_start in range(run_start, run_end, max_size):
+            blocks.append((block_start, min(block_start+max_size, run_end)))
+    
+    return blocks
+
+
+# Signal generator results in typed form: the row of data_comp where the 
+# signal occurs, its side (1 long, -1 short, no_signal for none) and an 
+# optional strength (nan if the generator doesn't give one)
+signal_dtype = np.dtype([('index', '<i8'), ('side', 'i1'), ('strength', '<f4')])
+
+no_signal = 0
+
+
+def signal_records(results, times, first_row):
+    ''' Converts the results of a signal generator (rows of time, signal 
+    type and optionally strength, see signal_generator_batch) to signal_dtype 
+    records. times are the candle times of rows first_row, first_row+1, ... 
+    of data_comp, and have to cover every time a signal occurs at'''
+    
+    results = np.asarray(results)
+    
+    records = np.empty(len(results), dtype=signal_dtype)
+    
+    records['side'] = results[:,1]
+    records['strength'] = results[:,2] if results.shape[1] > 2 else np.nan
+    records['index'] = -1
+    
+    found = records['side'] != no_signal
+    
+    if np.any(found):
+        records['index'][found] = TimeIndex(times).rows(results[found,0]) + first_row
+    
+    return records
+
+
+def open_signal_buffer(filename, length):
+    ''' Creates a memory-mapped .npy file of length signal_dtype records to 
+    collect the results of a subsection in. A new file is all zeros, so 
+    every entry starts out as no_signal and entries that are never run 
+    (like invalid inputs) don't have to be written at all'''
+    return np.lib.format.open_memmap(filename, mode='w+', dtype=signal_dtype, shape=(length,))
+
+
+def compact_signals(buffer, strength=False):
+    ''' Picks the entries of a signal buffer that have a signal, in one 
+    vectorized pass. Returns them as the usual float array of signals 
+    (index, type), plus a strength column if strength is True'''
+    
+    found = buffer[buffer['side'] != no_signal]
+    
+    signals = np.empty((len(found), 3 if strength else 2))
+    signals[:,0] = found['index']
+    signals[:,1] = found['side']
+    
+    if strength:
+        signals[:,2] = found['strength']
+    
+    return signals
+
+
+def run_signal_block(data_comp, block_start, block_end, fitlength, generator=signal_generator_batch, out=None, out_start=0):
+    ''' Runs a batched signal generator (see signal_generator_batch) for every 
+    index from block_start to block_end-1. The rows the block needs are read 
+    from data_comp once, and the windows are a sliding_window_view over 
+    them, so no window is ever copied. 
+    
+    If out is given (a signal buffer from open_signal_buffer whose first 
+    entry is index out_start), the results are converted to signal_dtype 
+    records and written straight into it instead of being returned, so 
+    nothing has to be sent back from a worker process'''
+    
+    block_data = np.ascontiguousarray(data_comp[block_start-fitlength:block_end-1,:])
+    
+    # sliding_window_view puts the window dimension last, so it's swapped 
+    # with the columns to get windows[k] == data_comp[block_start+k-fitlength:block_start+k,:]
+    windows = sliding_window_view(block_data, fitlength, axis=0).transpose(0,2,1)
+    
+    results = generator(windows)
+    
+    if out is None:
+        return results
+    
+    out[block_start-out_start:block_end-out_start] = signal_records(results, block_data[:,0], block_start-fitlength)
+
+
+def flat_sections_mask(closes, fitlength, i, range_length):
+    ''' Returns a boolean mask over the indices i to i+range_length-1 that is 
+    True where the signal generator function should not be run, because 
+    the index is within the first fitlength candles of the data set or 
+    within fitlength candles after the start of a long flat section (more 
+    than fitlength/2 identical closes in a row). Flat sections that are 
+    still going on at i+range_length aren't counted. 
+    
+    This is the same thing the original loop in generate_inputs did, 
+    including its quirk of counting the first flat section as starting at 
+    i+1, but using run lengths instead of checking every candle in python.'''
+    
+    # True where a candle close differs from the previous candle's
+    changes = closes[i+1:i+range_length+1] != closes[i:i+range_length]
+    
+    # the flat section ending at each change starts at the previous change 
+    # (or at i for the first one)
+    ends = np.nonzero(changes)[0] + i + 1
+    starts = np.concatenate(([i], ends[:-1]))
+    lengths = ends - starts
+    
+    starts[:1] = i+1
+    
+    long_flats = lengths > fitlength/2
+    starts = starts[long_flats]
+    lengths = lengths[long_flats]
+    
+    # mark the excluded indices by adding 1 where each excluded section starts 
+    # and subtracting 1 where it ends
+    bounds = np.zeros(range_length+1, dtype='int64')
+    np.add.at(bounds, np.clip(np.concatenate(([0], starts)) - i, 0, range_length), 1)
+    np.add.at(bounds, np.clip(np.concatenate(([fitlength], starts + lengths + fitlength)) - i, 0, range_length), -1)
+    
+    return np.cumsum(bounds[:-1]) > 0
+
+
+def generate_inputs(data_comp, fitlength, i, range_length):
+    ''' This function produces a list of indices in data_comp where the 
+    signal_generator function should be applied. It essentially filters out 
+    long flat sections of data_comp that may lead to meaningless or unreliable 
+    behavior from the signal generator function. These flat sections typically 
+    correspond to times when the Coinbase servers went down.'''
+    
+    excepts = flat_sections_mask(data_comp[:,1], fitlength, i, range_length)
+    
+    return (np.nonzero(~excepts)[0] + i).tolist()
+
+
+def valid_input_mask(data_comp, fitlength):
+    ''' Same as generate_inputs, but for the whole of data_comp in one go. 
+    Returns a boolean mask that is True at every index where the signal 
+    generator function should be applied, so the inputs for any subsection 
+    are just the True indices in that part of the mask. Unlike calling 
+    generate_inputs per subsection, this also catches flat sections that 
+    cross the border between two subsections. The last index is never 
+    valid since there's no candle after it to decide whether a flat section 
+    ends there.'''
+    
+    mask = np.zeros(len(data_comp), dtype=bool)
+    
+    if len(data_comp) > 1:
+        mask[:-1] = ~flat_sections_mask(data_comp[:,1], fitlength, 0, len(data_comp)-1)
+    
+    return mask
+
+
+def merge_signals(fitlength, range_length, start_subsection, end_subsection):
+    '''Merges the subsection signals from start_subsection to end_subsection '''
+    
+    total_signals = np.empty((0,3))
+    
+    
+    folder = 'signals_flen' + str(fitlength)
+    
+    for i in [e*range_length for e in range(start_subsection,end_subsection)]:
+        
+        signals = np.load('Example_signal_A/' + folder + '/' + folder + '_range' + str(i) + '_' + str(i+range_length) + '.npy')
+        
+        total_signals = np.vstack((total_signals, signals))
+    
+    np.save('Example_signal_A/' + folder + '/' + folder + '_range' + str(start_subsection*range_length) + '_' + str(end_subsection*range_length) + '.npy',total_signals)
+
+
+
+class SignalStore:
+    
+    '''
+    Append-only store for generated signals, replacing the per-subsection 
+    .npy files and merge_signals. Each append (normally one finished 
+    subsection) is saved as its own chunk file, sorted by candle index, and 
+    index.json lists the range of inputs each chunk covers, kept sorted by 
+    where it starts, together with the range of candle indices of its 
+    signals. The two aren't the same, since a signal is dated at a candle 
+    inside the window of its input, which can be up to lookback candles 
+    before the range. Loading any [start, end) range only checks the signal 
+    ranges of the chunks and does a binary search inside each chunk it 
+    overlaps, and only the rows returned are read from disk. Chunks may be 
+    appended in any order, as long as their input ranges don't overlap.
+    '''
+    
+    def __init__(self, folder):
+        
+        self.folder = folder
+        
+        if not os.path.isdir(folder):
+            os.makedirs(folder)
+        
+        index_filename = os.path.join(folder, 'index.json')
+        
+        if os.path.isfile(index_filename):
+            with open(index_filename) as f:
+                self.chunks = json.load(f)
+        else:
+            self.chunks = []
+        
+        self._update_bounds()
+    
+    
+    def _update_bounds(self):
+        self.range_starts = np.array([chunk['range_start'] for chunk in self.chunks], dtype='int64')
+        self.range_ends = np.array([chunk['range_end'] for chunk in self.chunks], dtype='int64')
+        # chunks from before index_start/index_end were added never have signals outside their range
+        self.index_starts = np.array([chunk.get('index_start', chunk['range_start']) for chunk in self.chunks], dtype='int64')
+        self.index_ends = np.array([chunk.get('index_end', chunk['range_end']) for chunk in self.chunks], dtype='int64')
+    
+    
+    def _save_index(self):
+        index_filename = os.path.join(self.folder, 'index.json')
+        with open(index_filename + '.tmp', 'w') as f:
+            json.dump(self.chunks, f, indent=1)
+        os.replace(index_filename + '.tmp', index_filename)
+    
+    
+    def append(self, signals, range_start, range_end, lookback=0):
+        
+        '''Adds the signals generated for the inputs [range_start, range_end). 
+        Column 0 of signals is the candle index each signal is dated at, which 
+        can be up to lookback candles before range_start (normally lookback 
+        is the fitlength, since the signal of input j can be dated anywhere in 
+        data_comp[j-fitlength:j])'''
+        
+        k = np.searchsorted(self.range_starts, range_start)
+        
+        if (k > 0 and self.range_ends[k-1] > range_start) or (k < len(self.chunks) and self.range_starts[k] < range_end):
+            raise ValueError('Signals for range ' + str(range_start) + '-' + str(range_end) + ' overlap signals already in the store')
+        
+        signals = np.asarray(signals)
+        signals = signals[np.argsort(signals[:,0], kind='stable')]
+        
+        if len(signals) > 0 and (signals[0,0] < range_start - lookback or signals[-1,0] >= range_end):
+            raise ValueError('Signals outside of range ' + str(range_start - lookback) + '-' + str(range_end))
+        
+        index_start = int(signals[0,0]) if len(signals) > 0 else int(range_start)
+        index_end = int(signals[-1,0]) + 1 if len(signals) > 0 else int(range_start)
+        
+        filename = 'chunk_' + str(range_start) + '_' + str(range_end) + '.npy'
+        np.save(os.path.join(self.folder, filename), signals)
+        
+        # the chunk file is complete before it's added to the index, so a 
+        # crash never leaves a broken chunk in the store
+        self.chunks.insert(k, {'range_start': int(range_start), 'range_end': int(range_end), 
+                               'index_start': index_start, 'index_end': index_end, 
+                               'n_signals': len(signals), 'filename': filename})
+        self._save_index()
+        self._update_bounds()
+    
+    
+    def has_range(self, range_start, range_end):
+        
+        '''True if signals have been stored for every input in [range_start, range_end)'''
+        
+        k = np.searchsorted(self.range_ends, range_start, side='right')
+        
+        while range_start < range_end:
+            if k >= len(self.chunks) or self.range_starts[k] > range_start:
+                return False
+            range_start = self.range_ends[k]
+            k += 1
+        
+        return True
+    
+    
+    def load(self, start=0, end=None):
+        
+        '''Returns all stored signals with candle index in [start, end), sorted by 
+        index, including ones dated before the input range of their chunk'''
+        
+        if end is None:
+            end = self.range_ends[-1] if len(self.chunks) > 0 else 0
+        
+        # chunks with signals in [start, end)
+        overlapping = np.flatnonzero((self.index_ends > start) & (self.index_starts < end))
+        
+        parts = []
+        
+        for k in overlapping:
+            
+            if self.chunks[k]['n_signals'] == 0:
+                continue
+            
+            signals = np.load(os.path.join(self.folder, self.chunks[k]['filename']), mmap_mode='r')
+            
+            a = np.searchsorted(signals[:,0], start, side='left') if start > self.index_starts[k] else 0
+            b = np.searchsorted(signals[:,0], end, side='left') if end < self.index_ends[k] else len(signals)
+            
+            parts.append(np.array(signals[a:b]))
+        
+        if len(parts) == 0:
+            return np.zeros((0,2))
+        
+        signals = np.concatenate(parts)
+        
+        # the first signals of a chunk can come before the last ones of the chunk before it
+        if np.any(signals[1:,0] < signals[:-1,0]):
+            signals = signals[np.argsort(signals[:,0], kind='stable')]
+        
+        return signals
+
+
+def import_signal_files(store, fitlength, range_length, start_subsection, end_subsection):
+    '''Adds the old per-subsection signal files of Example_signal_A to a SignalStore'''
+    
+    folder = 'signals_flen' + str(fitlength)
+    
+    for i in [e*range_length for e in range(start_subsection,end_subsection)]:
+        
+        if not store.has_range(i, i+range_length):
+            signals = np.load('Example_signal_A/' + folder + '/' + folder + '_range' + str(i) + '_' + str(i+range_length) + '.npy')
+            store.append(signals, i, i+range_length, fitlength)
+
+
+
+#------------ Functions for generating signals one candle at a time ----------
+
+
+
+class CandleRingBuffer:
+    
+    '''Fixed-size buffer holding the last "length" candles. Every candle is 
+    stored twice, length rows apart, so the current window is always one 
+    contiguous slice of the buffer and adding a candle is O(1)'''
+    
+    def __init__(self, length, n_cols):
+        self.length = length
+        self.data = np.zeros((2*length, n_cols))
+        self.pos = 0 # row the next candle goes into
+        self.count = 0
+    
+    
+    def push(self, candle):
+        self.data[self.pos] = candle
+        self.data[self.pos+self.length] = candle
+        self.pos = (self.pos + 1) % self.length
+        self.count = min(self.count + 1, self.length)
+    
+    
+    def full(self):
+        return self.count == self.length
+    
+    
+    def window(self):
+        '''The candles in the buffer, oldest first, as a view (don't keep it 
+        around, it changes with the next push)'''
+        if self.full():
+            return self.data[self.pos:self.pos+self.length]
+        return self.data[self.length:self.length+self.count]
+
+
+class RollingWindow:
+    
+    '''Base class for the rolling statistics below. Keeps the last n values 
+    so the one dropping out of the window is known, and recalculates 
+    everything from scratch every n values so rounding errors from adding 
+    and subtracting can't build up (which keeps the cost O(1) on average)'''
+    
+    def __init__(self, n):
+        self.n = n
+        self.values = deque()
+        self.since_recalc = 0
+    
+    
+    def push(self, x):
+        
+        x = float(x)
+        self.values.append(x)
+        old = self.values.popleft() if len(self.values) > self.n else None
+        
+        self.since_recalc += 1
+        if self.since_recalc >= self.n:
+            self.recalc()
+            self.since_recalc = 0
+        else:
+            self.add(x, old)
+        
+        return self.value()
+    
+    
+    def full(self):
+        return len(self.values) == self.n
+
+
+class RollingMean(RollingWindow):
+    
+    '''Mean of the last n values'''
+    
+    def __init__(self, n):
+        super().__init__(n)
+        self.total = 0.0
+    
+    def add(self, x, old):
+        self.total += x - (old if old is not None else 0.0)
+    
+    def recalc(self):
+        self.total = math.fsum(self.values)
+    
+    def value(self):
+        return self.total/len(self.values)
+
+
+class RollingVariance(RollingWindow):
+    
+    '''Variance of the last n values (ddof=0 like np.var). The sums are taken 
+    relative to a reference value near the data to avoid cancellation'''
+    
+    def __init__(self, n, ddof=0):
+        super().__init__(n)
+        self.ddof = ddof
+        self.ref = None
+        self.sum1 = 0.0
+        self.sum2 = 0.0
+    
+    def add(self, x, old):
+        if self.ref is None:
+            self.ref = x
+        self.sum1 += x - self.ref
+        self.sum2 += (x - self.ref)**2
+        if old is not None:
+            self.sum1 -= old - self.ref
+            self.sum2 -= (old - self.ref)**2
+    
+    def recalc(self):
+        self.ref = self.values[-1]
+        self.sum1 = math.fsum(x - self.ref for x in self.values)
+        self.sum2 = math.fsum((x - self.ref)**2 for x in self.values)
+    
+    def value(self):
+        k = len(self.values)
+        if k - self.ddof <= 0:
+            return np.nan
+        return max(0.0, (self.sum2 - self.sum1**2/k)/(k - self.ddof))
+
+
+class RollingMinMax(RollingWindow):
+    
+    '''Minimum and maximum of the last n values, using monotonic queues of 
+    candidates (O(1) amortized, and exact, so it never needs recalculating)'''
+    
+    def __init__(self, n):
+        super().__init__(n)
+        self.count = 0
+        self.mins = deque() # (position, value), values increasing
+        self.maxs = deque() # (position, value), values decreasing
+    
+    def add(self, x, old):
+        
+        while self.mins and self.mins[-1][1] >= x:
+            self.mins.pop()
+        while self.maxs and self.maxs[-1][1] <= x:
+            self.maxs.pop()
+        
+        self.mins.append((self.count, x))
+        self.maxs.append((self.count, x))
+        self.count += 1
+        
+        # drop candidates that have left the window
+        if self.mins[0][0] <= self.count - 1 - self.n:
+            self.mins.popleft()
+        if self.maxs[0][0] <= self.count - 1 - self.n:
+            self.maxs.popleft()
+    
+    def recalc(self):
+        self.add(self.values[-1], None)
+    
+    def value(self):
+        return self.mins[0][1], self.maxs[0][1]
+
+
+class RollingSlope(RollingWindow):
+    
+    '''Least squares slope of the last n values against their position in 
+    the window (i.e., per candle)'''
+    
+    def __init__(self, n):
+        super().__init__(n)
+        self.sum_y = 0.0
+        self.sum_xy = 0.0
+    
+    def add(self, x, old):
+        if old is not None:
+            # every value that stays moves one position towards the start
+            self.sum_y -= old
+            self.sum_xy -= self.sum_y
+        self.sum_xy += (len(self.values)-1)*x
+        self.sum_y += x
+    
+    def recalc(self):
+        self.sum_y = math.fsum(self.values)
+        self.sum_xy = math.fsum(i*y for i, y in enumerate(self.values))
+    
+    def value(self):
+        k = len(self.values)
+        if k < 2:
+            return 0.0
+        sum_x = k*(k-1)/2
+        sum_xx = (k-1)*k*(2*k-1)/6
+        return (k*self.sum_xy - sum_x*self.sum_y)/(k*sum_xx - sum_x**2)
+
+
+class StreamingSignalGenerator(ABC):
+    
+    '''
+    Base class for signal generators that are fed one candle at a time 
+    instead of a whole window, for running live or replaying history. The 
+    last fitlength candles are kept in self.buffer (a CandleRingBuffer), and 
+    subclasses have to implement on_candle (otherwise they can't be made), 
+    which gets each new candle after it's been added to the buffer and 
+    returns the signal type (1 long, -1 short, 0 no signal). Subclasses 
+    should keep their own state up to date with the rolling statistics 
+    above, so each candle is O(1) work, and set that state up in reset.
+    
+    A signal returned after the candle at row j-1 corresponds to index j in 
+    generate_signals.py, since it's based on data_comp[j-fitlength:j,:].
+    '''
+    
+    def __init__(self, fitlength, n_cols=2):
+        self.fitlength = fitlength
+        self.n_cols = n_cols
+        self.reset()
+    
+    
+    def reset(self):
+        self.buffer = CandleRingBuffer(self.fitlength, self.n_cols)
+    
+    
+    def update(self, candle):
+        self.buffer.push(candle)
+        return self.on_candle(candle)
+    
+    
+    @abstractmethod
+    def on_candle(self, candle):
+        pass
+    
+    
+    def replay(self, data_comp, start, end):
+        
+        '''Starts from scratch and feeds the candles before each index from 
+        start to end-1 through the generator (beginning fitlength candles 
+        earlier to fill the buffer). Returns the same format as 
+        signal_generator_batch: one row per index with the time of the last 
+        candle in its window and the signal type. Indices whose window isn't 
+        full get 0'''
+        
+        self.reset()
+        
+        first = max(0, start-self.fitlength)
+        
+        # read the candles once instead of one row at a time from data_comp
+        candles = np.asarray(data_comp[first:end-1,:], dtype='float64').tolist() if end-1 > first else []
+        
+        results = np.zeros((end-start,2))
+        
+        for row, candle in enumerate(candles, first):
+            signal = self.update(candle)
+            
+            j = row + 1
+            if j >= start:
+                results[j-start,0] = candle[0]
+                results[j-start,1] = signal if self.buffer.full() else 0
+        
+        return results
+
+
+class ExampleStreamingGenerator(StreamingSignalGenerator):
+    
+    '''Dummy streaming generator showing how the rolling statistics are 
+    used. Gives a long signal when the close breaks out to the top of the 
+    window while more than 2 standard deviations above the mean and the 
+    trend is up, and a short signal in the opposite case. Expects candles 
+    with the close in column 1, like data_comp in generate_signals.py'''
+    
+    def reset(self):
+        super().reset()
+        self.mean = RollingMean(self.fitlength)
+        self.var = RollingVariance(self.fitlength)
+        self.minmax = RollingMinMax(self.fitlength)
+        self.slope = RollingSlope(self.fitlength)
+    
+    
+    def on_candle(self, candle):
+        
+        close = candle[1]
+        
+        mean = self.mean.push(close)
+        std = math.sqrt(self.var.push(close))
+        low, high = self.minmax.push(close)
+        slope = self.slope.push(close)
+        
+        if close >= high and close > mean + 2*std and slope > 0:
+            return 1
+        if close <= low and close < mean - 2*std and slope < 0:
+            return -1
+        return 0
+
+
+
+#----------------- Functions for instrumenting the backtests -----------------
+
+
+
+class StageTimer:
+    
+    '''Adds the time spent inside a with statement to one of the timers of 
+    an Instrumentation'''
+    
+    def __init__(self, instrumentation, name):
+        self.instrumentation = instrumentation
+        self.name = name
+    
+    
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+    
+    
+    def __exit__(self, *args):
+        self.instrumentation.add_time(self.name, time.perf_counter() - self.start)
+
+
+class SamplingProfiler:
+    
+    '''Samples where a thread is every interval seconds from a background 
+    thread, and counts how often each line of each function was the one 
+    running. Costs nothing in the thread being profiled'''
+    
+    def __init__(self, interval=0.001, thread_id=None):
+        self.interval = interval
+        self.thread_id = thread_id if thread_id is not None else threading.get_ident()
+        self.samples = {}
+        self.stopped = threading.Event()
+        self.thread = threading.Thread(target=self.run, daemon=True)
+    
+    
+    def start(self):
+        self.thread.start()
+        return self
+    
+    
+    def run(self):
+        while not self.stopped.wait(self.interval):
+            frame = sys._current_frames().get(self.thread_id)
+            if frame is not None:
+                key = frame.f_code.co_name + ' (' + os.path.basename(frame.f_code.co_filename) + ':' + str(frame.f_lineno) + ')'
+                self.samples[key] = self.samples.get(key, 0) + 1
+    
+    
+    def stop(self):
+        self.stopped.set()
+        self.thread.join()
+        return self.samples
+
+
+class Instrumentation:
+    
+    '''
+    Collects what happens in the backtests, instead of printing it:
+        
+        timers: seconds spent in each stage (preprocessing, event_loop, 
+            liquidation_checks, output_expansion) 
+        counters: backtests, events_processed, skipped_signals, 
+            liquidations, early_aborts (leverage too high or account 
+            drained), and one per abort reason 
+        records: one dict per backtest and per abort, e.g. 
+            {'event': 'abort', 'reason': 'account_drained', 'index': 123456}, 
+            which are also passed to sink (e.g. print) if one is set 
+        samples: the counts of a SamplingProfiler, if one was started
+    
+    There's one of these, "instrumentation", shared by all the backtests. 
+    It's disabled by default, and then the backtests only check 
+    instrumentation.enabled a few times per call, so it costs nothing 
+    measurable. collect returns everything as a dict (and starts over), 
+    which merge adds to another Instrumentation, so the results of worker 
+    processes can be added up.
+    '''
+    
+    def __init__(self, max_records=10000):
+        self.enabled = False
+        self.sink = None
+        self.max_records = max_records
+        self.profiler = None
+        self.reset()
+    
+    
+    def reset(self):
+        self.timers = {}
+        self.counters = {}
+        self.records = deque(maxlen=self.max_records)
+        self.samples = {}
+    
+    
+    def enable(self, sink=None):
+        self.enabled = True
+        self.sink = sink
+    
+    
+    def disable(self):
+        self.enabled = False
+    
+    
+    def timer(self, name):
+        return StageTimer(self, name)
+    
+    
+    def add_time(self, name, seconds):
+        self.timers[name] = self.timers.get(name, 0.0) + seconds
+    
+    
+    def count(self, name, n=1):
+        self.counters[name] = self.counters.get(name, 0) + int(n)
+    
+    
+    def record(self, event, **fields):
+        record = {'event': event, 'time': time.time()}
+        record.update(fields)
+        self.records.append(record)
+        if self.sink is not None:
+            self.sink(record)
+    
+    
+    def start_profiler(self, interval=0.001):
+        '''Starts sampling the current thread (see SamplingProfiler)'''
+        self.profiler = SamplingProfiler(interval).start()
+    
+    
+    def stop_profiler(self):
+        if self.profiler is not None:
+            for key, n in self.profiler.stop().items():
+                self.samples[key] = self.samples.get(key, 0) + n
+            self.profiler = None
+    
+    
+    def summary(self):
+        return {'timers': dict(self.timers), 
+                'counters': dict(self.counters), 
+                'records': list(self.records), 
+                'samples': dict(self.samples)}
+    
+    
+    def collect(self):
+        summary = self.summary()
+        self.reset()
+        return summary
+    
+    
+    def merge(self, summary):
+        for name, seconds in summary['timers'].items():
+            self.add_time(name, seconds)
+        for name, n in summary['counters'].items():
+            self.count(name, n)
+        for record in summary['records']:
+            self.records.append(record)
+        for key, n in summary['samples'].items():
+            self.samples[key] = self.samples.get(key, 0) + n
+
+
+instrumentation = Instrumentation()
+
+
+def report_abort(reason, index):
+    
+    '''Counts and records a backtest that was stopped early (called instead 
+    of the prints that process_sigs used to have)'''
+    
+    instrumentation.count('early_aborts' if reason in ('leverage_too_high', 'account_drained') else 'liquidations')
+    instrumentation.count('aborts.' + reason)
+    instrumentation.record('abort', reason=reason, index=int(index))
+
+
+
+#------ Functions for testing trading strategies based on the signals --------
+
+
+
+def calc_max_drawdown(balance_ext):
+    
+    """Takes in a balance_ext matrix and determines the largest drawdown over 
+    the covered time period. Returns the drawdown and the rows of balance_ext 
+    where it starts and bottoms out (see calc_drawdowns)"""
+    
+    return calc_drawdowns(balance_ext).max()
+
+
+class Drawdowns:
+    
+    """
+    All the drawdowns of an equity curve, as found by calc_drawdowns, with 
+    one entry per drawdown in each array (in the order they happen). A 
+    drawdown starts at the last row at a new high before the balance drops, 
+    bottoms out at its trough, and is over (recovered) at the first row where 
+    the balance is higher than at the start, which is also where the next 
+    drawdown period begins, so drawdowns never overlap. 
+    
+    peaks, troughs and recoveries are rows of the balance array (recoveries 
+    is -1 for a drawdown that hasn't recovered by the end), and 
+    peak_index, trough_index and recovery_index are the same points as 
+    indices of the candle data. durations is the number of candles from peak 
+    to trough, and recovery_times from trough to recovery (nan if not 
+    recovered). depths is the fraction of the balance lost at the trough. 
+    """
+    
+    def __init__(self, peaks, troughs, recoveries, depths, index):
+        
+        self.peaks = peaks
+        self.troughs = troughs
+        self.recoveries = recoveries
+        self.depths = depths
+        
+        self.peak_index = index[peaks]
+        self.trough_index = index[troughs]
+        self.recovery_index = np.where(recoveries >= 0, index[recoveries], np.nan)
+        
+        self.durations = self.trough_index - self.peak_index
+        self.recovery_times = self.recovery_index - self.trough_index
+    
+    
+    def __len__(self):
+        return len(self.depths)
+    
+    
+    def max(self):
+        """Largest drawdown, and the rows where it peaks and bottoms out. 
+        (0, 0, 0) if there are no drawdowns"""
+        if len(self.depths) == 0:
+            return 0, 0, 0
+        k = np.argmax(self.depths)
+        return self.depths[k], self.peaks[k], self.troughs[k]
+    
+    
+    def top(self, k):
+        """Positions (in these arrays) of the k largest drawdowns, largest first"""
+        return np.argsort(-self.depths, kind='stable')[:k]
+
+
+def calc_drawdowns(balance, index=None):
+    
+    """Finds every drawdown of an equity curve in one pass with a running 
+    maximum (see Drawdowns). balance can be balance_ext, or just a 1D array 
+    of balances, in which case index gives the candle index of each balance 
+    (by default its row), or the ChangePoints of the balance. Because the 
+    balance only changes at change points, a compressed equity curve 
+    (balances at change points only, with their candle indices) has the same 
+    drawdowns as the expanded one, except that a drawdown after a flat top 
+    starts where the top starts.
+    
+    The drawdowns found are the same as calc_max_drawdown always found, 
+    including where each one starts: at the last candle of a flat top, and 
+    only ending once the previous high is beaten (not just equalled)."""
+    
+    if isinstance(balance, ChangePoints):
+        index, balance = balance.points()
+        balance = balance[:,0]
+    
+    balance = np.asarray(balance)
+    
+    if balance.ndim == 2:
+        if index is None:
+            index = balance[:,0]
+        balance = balance[:,1]
+    
+    n = len(balance)
+    positions = np.arange(n)
+    
+    if index is None:
+        index = positions
+    
+    index = np.asarray(index)
+    
+    if n == 0:
+        return Drawdowns(positions, positions, positions, np.zeros(0), index)
+    
+    running_max = np.maximum.accumulate(balance)
+    
+    # every new (strictly higher) high starts a new drawdown period
+    new_high = np.ones(n, dtype=bool)
+    new_high[1:] = running_max[1:] > running_max[:-1]
+    
+    period_starts = np.nonzero(new_high)[0]
+    period_ends = np.append(period_starts[1:], n)
+    period = np.cumsum(new_high) - 1
+    
+    # the drawdown starts just before the first row below the high of its 
+    # period, and bottoms out at the first row at the lowest balance
+    underwater = np.where(balance < running_max, positions, n)
+    first_underwater = np.minimum.reduceat(underwater, period_starts)
+    
+    lows = np.minimum.reduceat(balance, period_starts)
+    troughs = np.minimum.reduceat(np.where(balance == lows[period], positions, n), period_starts)
+    
+    has_drawdown = first_underwater < period_ends
+    
+    peaks = first_underwater[has_drawdown] - 1
+    troughs = troughs[has_drawdown]
+    recoveries = np.where(period_ends < n, period_ends, -1)[has_drawdown]
+    depths = 1 - lows[has_drawdown]/balance[period_starts[has_drawdown]]
+    
+    return Drawdowns(peaks, troughs, recoveries, depths, index)
+
+
+def rolling_max_drawdown(balance, window=None):
+    
+    """Largest drawdown within the last window rows at every row of an 
+    equity curve (balance_ext, a 1D array of balances or ChangePoints, which 
+    get expanded). With window=None it's the largest drawdown so far instead. 
+    
+    The largest drawdown of a stretch of rows is the largest drop in log 
+    balance from any row to a later one, and that can be combined for two 
+    neighbouring stretches from their maximum, minimum and largest drop. So 
+    the rows are cut into blocks of length window, the combination is 
+    accumulated forwards and backwards within each block, and each window 
+    (which always covers the end of one block and the start of the next) is 
+    one combination of the two. That's O(n) for any window length"""
+    
+    if isinstance(balance, ChangePoints):
+        balance = balance.expand()
+    
+    balance = np.asarray(balance, dtype='float64')
+    
+    if balance.ndim == 2:
+        balance = balance[:,1] if balance.shape[1] > 1 else balance[:,0]
+    
+    n = len(balance)
+    
+    if n == 0:
+        return np.zeros(0)
+    
+    log_balance = np.log(np.maximum(balance, 1e-300))
+    
+    if window is None or window >= n:
+        largest_drop = np.maximum.accumulate(np.maximum.accumulate(log_balance) - log_balance)
+        return 1 - np.exp(-largest_drop)
+    
+    n_blocks = int(np.ceil(n/window))
+    
+    blocks = np.full(n_blocks*window, log_balance[-1])
+    blocks[:n] = log_balance
+    blocks = blocks.reshape(n_blocks, window)
+    
+    # from the start of each block to each row
+    prefix_min = np.minimum.accumulate(blocks, axis=1)
+    prefix_drop = np.maximum.accumulate(np.maximum.accumulate(blocks, axis=1) - blocks, axis=1)
+    
+    # from each row to the end of its block
+    reverse = blocks[:,::-1]
+    suffix_max = np.maximum.accumulate(reverse, axis=1)[:,::-1]
+    suffix_drop = np.maximum.accumulate(reverse - np.minimum.accumulate(reverse, axis=1), axis=1)[:,::-1]
+    
+    prefix_min = prefix_min.reshape(-1)[:n]
+    prefix_drop = prefix_drop.reshape(-1)[:n]
+    suffix_max = suffix_max.reshape(-1)
+    suffix_drop = suffix_drop.reshape(-1)
+    
+    largest_drop = prefix_drop.copy()
+    
+    # windows that start in one block and end in the next
+    ends = np.arange(window, n)
+    starts = ends - window + 1
+    split = starts % window != 0
+    
+    ends = ends[split]
+    starts = starts[split]
+    
+    largest_drop[ends] = np.maximum(np.maximum(suffix_drop[starts], prefix_drop[ends]), suffix_max[starts] - prefix_min[ends])
+    
+    # windows that are exactly one block
+    whole = np.arange(window-1, n, window)
+    largest_drop[whole] = suffix_drop[whole-window+1]
+    
+    return 1 - np.exp(-largest_drop)
+
+
+def process_sigs(events, price_data, sigs_w_close, lev, lev_limit, slippage, range_index=None):
+    
+    """This piece takes over once 'events' has been generated, and calculates 
+    gains, losses, balance over time, total profits before and after tax, etc. 
+    
+    events is a list of all events (increase/decrease long/short position, by how much, and when)
+    
+    price_data is just the historical price data
+    
+    sigs_with_close lists the signals when they occur, and when they later get closed
+    
+    lev is the leverage used each time a position is added to. it is a 
+    percentage of the current total account balance
+    
+    lev_limit is the maximum total leverage (long + short) allowed. If 
+    reacting to a given signal would cause lev_limit to be exceeded, then the 
+    signal is ignored
+    
+    slippage is simply the estimated average slippage per order
+    
+    range_index is an optional PriceRangeIndex over price_data (see 
+    load_price_range_index). If given, it's used for the liquidation checks 
+    instead of scanning the price data between every pair of events"""
+    
+    # balance_ext will list account balance at every minute for the entire period
+    balance_ext = np.zeros((int(1+max(sigs_w_close[:,2]))-int(sigs_w_close[0,0]),2),dtype='float64')
+    balance_ext[:,0] = range(int(sigs_w_close[0,0]),int(1+max(sigs_w_close[:,2])))
+    balance_ext[:,1] = 1
+    
+    # will keep track of total gains and losses for calculating profit after taxes later
+    gains = 0
+    losses = 0
+    
+    total_profits = 1
+    total_profits_aft_tax = 1
+    
+    # matrix that will keep track of positions over time
+    positions = np.zeros((len(balance_ext),6)) # 0 long pos, 1 short pos, 2 net pos, 3 total pos, 4 long avg entry, 5 short avg entry
+    
+    chunk = 10000 #breaks everything up into smaller chunks to avoid many manipulations of large arrays. 10000 seems to be a generally good value
+    offset = 0
+    
+    amounts = np.zeros((len(sigs_w_close),1))
+    
+    #indices marking the start of each chunk
+    subs_starts = range(np.floor(events[0,0]/chunk).astype(int), np.ceil(events[-1,0]/chunk).astype(int))
+    
+    skipped_signals = np.zeros((len(sigs_w_close),1))
+    
+    # see Instrumentation
+    instrumenting = instrumentation.enabled
+    if instrumenting:
+        loop_start = time.perf_counter()
+        events_processed = 0
+    
+    for j in subs_starts:
+        
+        sub_events = events[np.logical_and(events[:,0]>=j*chunk, events[:,0]<(j+1)*chunk),:]
+        sub_balance_ext = balance_ext[np.logical_and(balance_ext[:,0]>=j*chunk, balance_ext[:,0]<(j+1)*chunk),:]
+        sub_positions = positions[np.logical_and(balance_ext[:,0]>=j*chunk, balance_ext[:,0]<(j+1)*chunk),:]
+        sub_price_data = price_data[j*chunk:(j+1)*chunk,:]
+        
+        for i in range(len(sub_events)):
+            
+            update_ind = sub_events[i,0]-sub_balance_ext[0,0].astype(int) #current index within the current chunk
+            
+            if sub_events[i,1]==1: #increase long position size
+                
+                if sub_positions[update_ind,3]/sub_balance_ext[update_ind,1] + lev < lev_limit: #check if lev_limit will be exceeded
+                    
+                    amounts[sub_events[i,2]] = sub_balance_ext[update_ind,1]*lev
+                    
+                    if sub_positions[update_ind,0] == 0:
+                        sub_positions[update_ind:,4] = sub_price_data[sub_events[i,0]-j*chunk,3]*(1+slippage)
+                    else:
+                        sub_positions[update_ind:,4] = (np.prod(sub_positions[update_ind,[0,4]]) + (1+slippage)*sub_price_data[sub_events[i,0]-j*chunk,3]*amounts[sub_events[i,2]])/(sub_positions[update_ind,0] + amounts[sub_events[i,2]])
+                    
+                    sub_positions[update_ind:,0] += amounts[sub_events[i,2]]
+                    sub_balance_ext[update_ind:,1] -= amounts[sub_events[i,2]]*0.00075
+                
+                else:
+                    skipped_signals[sub_events[i,2]] = 1
+                
+                
+            elif sub_events[i,1]==-1: #increase short position size
+                
+                if sub_positions[update_ind,3]/sub_balance_ext[update_ind,1] + lev < lev_limit: #check if lev_limit will be exceeded
+                    
                     amounts[sub_events[i,2]] = sub_balance_ext[update_ind,1]*lev
                     
-                    if sub_positions[update_ind,0] == 0:
-                        sub_positions[update_ind:,4] = sub_price_data[sub_events[i,0]-j*chunk,3]*(1+slippage)
+                    if sub_positions[update_ind,1] == 0:
+                        sub_positions[update_ind:,5] = sub_price_data[sub_events[i,0]-j*chunk,3]*(1-slippage)
+                    else:
+                        sub_positions[update_ind:,5] = (np.prod(sub_positions[update_ind,[1,5]]) - (1-slippage)*sub_price_data[sub_events[i,0]-j*chunk,3]*amounts[sub_events[i,2]])/(sub_positions[update_ind,1] - amounts[sub_events[i,2]])
+                    
+                    sub_positions[update_ind:,1] -= amounts[sub_events[i,2]]
+                    sub_balance_ext[update_ind:,1] -= amounts[sub_events[i,2]]*0.00075
+                    
+                else:
+                    skipped_signals[sub_events[i,2]] = 1
+                
+                
+            elif sub_events[i,1]==2: #reduce long position size
+                
+                if skipped_signals[sub_events[i,2]] == 0:
+                    
+                    #includes taker fees at open and close (must remove opening 
+                    #fee before adding to balance_ext, since it's already been 
+                    #accounted for)
+                    profit = ((sigs_w_close[sub_events[i,2],3]*(1-slippage)/sub_positions[update_ind,4])*(1-0.00075) - 0.00075 - 1)*amounts[sub_events[i,2],0]
+                    
+                    sub_positions[update_ind:,0] -= amounts[sub_events[i,2]]
+                    
+                    if sub_positions[update_ind,0] == 0:
+                        sub_positions[update_ind:,4] = 0
+                    elif sub_positions[update_ind,0] != 0 and abs(sub_positions[update_ind,0]/sub_balance_ext[update_ind,1]) < 0.000001: #catches rounding errors
+                        sub_positions[update_ind:,4] = 0
+                        sub_positions[update_ind:,0] = 0
+                    
+                    
+                    sub_balance_ext[update_ind:,1] += profit + amounts[sub_events[i,2]]*0.00075
+                    
+                        
+            elif sub_events[i,1]==-2: #reduce short position size
+                
+                if skipped_signals[sub_events[i,2]] == 0:
+                    
+                    #includes taker fees at open and close (must remove opening 
+                    #fee before adding to balance_ext, since it's already been 
+                    #accounted for)
+                    profit = ((sub_positions[update_ind,5]*(1+slippage)/sigs_w_close[sub_events[i,2],3])*(1-0.00075) - 0.00075 - 1)*amounts[sub_events[i,2],0]
+                    
+                    sub_positions[update_ind:,1] += amounts[sub_events[i,2]]
+                    
+                    if sub_positions[update_ind,1] == 0:
+                        sub_positions[update_ind:,5] = 0
+                    elif sub_positions[update_ind,1] != 0 and abs(sub_positions[update_ind,1]/sub_balance_ext[update_ind,1]) < 0.000001:
+                        sub_positions[update_ind:,5] = 0
+                        sub_positions[update_ind:,1] = 0
+                    
+                    
+                    sub_balance_ext[update_ind:,1] += profit + amounts[sub_events[i,2]]*0.00075
+                    
+            
+            sub_positions[update_ind:,2] = sub_positions[update_ind:,0] + sub_positions[update_ind:,1]
+            sub_positions[update_ind:,3] = sub_positions[update_ind:,0] - sub_positions[update_ind:,1]
+            
+            # if total leverage gets too high at any point, throw out the result
+            if sub_positions[update_ind,3]/sub_balance_ext[update_ind,1]>95:
+                if instrumenting:
+                    report_abort('leverage_too_high', sub_events[i,0])
+                total_profits=0
+                total_profits_aft_tax=0
+                break
+            
+            # if balance gets too low, give up and stop
+            if sub_balance_ext[update_ind,1] < 0.0001:
+                if instrumenting:
+                    report_abort('account_drained', sub_events[i,0])
+                total_profits=0
+                total_profits_aft_tax=0
+                break
+            
+            # check for liquidations between current event and next event
+            if i<len(sub_events)-1 and sub_events[i,0] != sub_events[i+1,0]:
+                
+                if sub_positions[update_ind,2]>sub_balance_ext[update_ind,1]: #long positions with leverage below 1 can't be liquidated
+                    
+                    liq_price = sub_positions[update_ind,4]*(1 - (sub_balance_ext[update_ind,1]/sub_positions[update_ind,2]))
+                    
+                    if range_index is not None:
+                        liquidated = range_index.low_below(sub_events[i,0], sub_events[i+1,0], liq_price)
                     else:
-                        sub_positions[update_ind:,4] = (np.prod(sub_positions[update_ind,[0,4]]) + (1+slippage)*sub_price_data[sub_events[i,0]-j*chunk,3]*amounts[sub_events[i,2]])/(sub_positions[update_ind,0] + amounts[sub_events[i,2]])
+                        liquidated = sum(sub_price_data[sub_events[i,0]-j*chunk:sub_events[i+1,0]-j*chunk,1]<=liq_price)>0
                     
-                    sub_positions[update_ind:,0] += amounts[sub_events[i,2]]
-                    sub_balance_ext[update_ind:,1] -= amounts[sub_events[i,2]]*0.00075
+                    if liquidated:
+                        total_profits=0
+                        total_profits_aft_tax=0
+                        if instrumenting:
+                            report_abort('long_liquidated', sub_events[i,0])
+                        break
+                    
+                    
+                elif sub_positions[update_ind,2]<0: #short positions with leverage below 1 CAN be liquidated
+                    
+                    liq_price = sub_positions[update_ind,5]*(1 - (sub_balance_ext[update_ind,1]/sub_positions[update_ind,2]))
+                    
+                    if range_index is not None:
+                        liquidated = range_index.high_above(sub_events[i,0], sub_events[i+1,0], liq_price)
+                    else:
+                        liquidated = sum(sub_price_data[sub_events[i,0]-j*chunk:sub_events[i+1,0]-j*chunk,2]>=liq_price)>0
+                    
+                    if liquidated:
+                        total_profits=0
+                        total_profits_aft_tax=0
+                        if instrumenting:
+                            report_abort('short_liquidated', sub_events[i,0])
+                        break
+                    
+            
+        if instrumenting and len(sub_events) > 0:
+            events_processed += i+1
+        
+        if total_profits == 0: #break out of the second for loop if any of the inner breaks get triggered (since they always set total_profits=0)
+            break
+        
+        balance_ext[np.logical_and(balance_ext[:,0]>=j*chunk, balance_ext[:,0]<(j+1)*chunk),:] = sub_balance_ext
+        positions[np.logical_and(balance_ext[:,0]>=j*chunk, balance_ext[:,0]<(j+1)*chunk),:] = sub_positions
+        
+        balance_ext[balance_ext[:,0]>=(j+1)*chunk,1] = sub_balance_ext[-1,1]
+        positions[balance_ext[:,0]>=(j+1)*chunk,:] = sub_positions[-1,:]
+        
+        offset+=chunk
+    
+    if instrumenting:
+        instrumentation.add_time('event_loop', time.perf_counter() - loop_start)
+        instrumentation.count('events_processed', events_processed)
+        instrumentation.count('skipped_signals', np.sum(skipped_signals))
+    
+    # Sum up all events that generate gains and all events that generate losses. This is necessary to calculate profits after tax
+    balance_changes = np.ones((len(balance_ext),1))
+    balance_changes[0,0] = balance_ext[0,1]-1
+    balance_changes[1:,0] = balance_ext[1:,1]-balance_ext[:-1,1]
+    
+    gains = sum(balance_changes[balance_changes>0])
+    losses = sum(balance_changes[balance_changes<0])
+    
+    #Calculate profits before and after tax. Because of the way Swedish taxes 
+    #work, one may only subtract 70% of ones losses from one's gains before 
+    #calculating tax. This means, e.g., that one could "break even," but still 
+    #end up owing tax. This is why it's incredibly important to use profits 
+    #AFTER tax as a metric to judge trading algorithms
+    total_profits = 1 + gains + losses
+    total_profits_aft_tax = 1 + 0.7*gains + 0.79*losses 
+        
+    return total_profits, sigs_w_close, balance_ext, positions, gains, losses, total_profits_aft_tax, skipped_signals
+
+
+def expand_change_points(cp_index, cp_values, initial, start, stop):
+    
+    """Expands a step function given as change points into one row per index 
+    in range(start, stop). cp_index must be sorted and unique, and row k of 
+    cp_values holds the values that apply from cp_index[k] until the next 
+    change point. Before the first change point the values are 'initial'"""
+    
+    initial = np.asarray(initial, dtype='float64').reshape(-1)
+    cp_index = np.asarray(cp_index, dtype='int64')
+    cp_values = np.asarray(cp_values, dtype='float64').reshape(len(cp_index), len(initial))
+    
+    # only keep change points that fall inside the requested range
+    keep = np.logical_and(cp_index >= start, cp_index < stop)
+    
+    # the value in force at 'start' comes from the last change point before it
+    before = np.nonzero(cp_index < start)[0]
+    if len(before) > 0:
+        initial = cp_values[before[-1]]
+    
+    values = np.vstack((initial, cp_values[keep]))
+    run_lengths = np.diff(np.concatenate(([start], cp_index[keep], [stop])))
+    
+    return np.repeat(values, run_lengths, axis=0)
+
+
+class ChangePoints:
+    
+    """ 
+    Compact form of a per-minute output of process_sigs (balance or 
+    positions): the rows index where the values change, values[k] being the 
+    values from index[k] until the next change point, and initial being the 
+    values before the first one. The full per-minute array covers rows 
+    start to stop-1, but is only made when asked for, so the memory used 
+    depends on the number of events rather than the number of minutes. 
+    """
+    
+    def __init__(self, index, values, initial, start, stop):
+        self.index = index
+        self.values = values
+        self.initial = np.asarray(initial, dtype='float64')
+        self.start = start
+        self.stop = stop
+    
+    
+    def __len__(self):
+        return self.stop - self.start
+    
+    
+    @property
+    def nbytes(self):
+        return self.index.nbytes + self.values.nbytes
+    
+    
+    def expand(self, start=None, stop=None):
+        """Per-minute values for rows start to stop-1 (the whole range by default)"""
+        start = self.start if start is None else start
+        stop = self.stop if stop is None else stop
+        return expand_change_points(self.index, self.values, self.initial, start, stop)
+    
+    
+    def expand_with_index(self, start=None, stop=None):
+        """Same as expand, with the row number added as column 0. For the 
+        balance that's the usual balance_ext"""
+        start = self.start if start is None else start
+        stop = self.stop if stop is None else stop
+        return np.column_stack((np.arange(start, stop), self.expand(start, stop)))
+    
+    
+    def at(self, rows):
+        """Values at any rows, without expanding anything in between"""
+        rows = np.atleast_1d(rows)
+        k = np.searchsorted(self.index, rows, side='right') - 1
+        return np.where((k >= 0)[:,None], self.values[np.maximum(k, 0)], self.initial) if len(self.index) > 0 else np.tile(self.initial, (len(rows), 1))
+    
+    
+    def points(self):
+        """Change points with the initial values added at start, i.e. every 
+        point where the step function takes a new value (calc_drawdowns can 
+        use these directly)"""
+        keep = np.logical_and(self.index > self.start, self.index < self.stop)
+        before = np.nonzero(self.index <= self.start)[0]
+        first = self.values[before[-1]] if len(before) > 0 else self.initial
+        return np.concatenate(([self.start], self.index[keep])), np.vstack((first, self.values[keep]))
+
+
+def process_sigs_sparse(events, price_data, sigs_w_close, lev, lev_limit, slippage, expand=True, compressed=False, range_index=None):
+    
+    """Event-driven version of process_sigs. Takes the same inputs and returns 
+    the same outputs, but the account state is only updated once per event 
+    instead of over the whole remainder of the chunk, so the cost scales with 
+    the number of events rather than the number of minutes.
+    
+    The state after every event is recorded as a change point (index in 
+    price_data plus balance and the 6 position columns), and balance_ext and 
+    positions are only expanded to one row per minute at the very end. With 
+    expand=False that step is skipped entirely and balance_ext and positions 
+    are returned as None, which is all the optimizer needs. With 
+    compressed=True they're returned as ChangePoints instead, which can be 
+    expanded later (all of it, or just part of it) if needed. range_index 
+    works the same as in process_sigs. 
+    
+    To reproduce process_sigs exactly, two of its quirks are kept: events at 
+    or after the last chunk boundary (when the last event falls exactly on 
+    one) are never processed, and liquidations are only checked between 
+    events within the same chunk. When a run is aborted (too much leverage, 
+    drained account or liquidation), process_sigs discards the chunk it was 
+    working on, so the change points in that chunk are discarded here too"""
+    
+    chunk = 10000 # chunk size of process_sigs, needed for the quirks described above
+    
+    first_ind = int(sigs_w_close[0,0])
+    last_ind = int(max(sigs_w_close[:,2]))
+    
+    # process_sigs never reaches events beyond its last chunk
+    events = events[events[:,0] < np.ceil(events[-1,0]/chunk).astype(int)*chunk,:]
+    
+    amounts = np.zeros((len(sigs_w_close),1))
+    skipped_signals = np.zeros((len(sigs_w_close),1))
+    
+    # plain python lists are much faster than numpy arrays for scalar access in the loop
+    ev_inds = events[:,0].tolist()
+    ev_types = events[:,1].tolist()
+    ev_sigs = events[:,2].tolist()
+    ev_prices = price_data[events[:,0],3].tolist()
+    close_prices = sigs_w_close[:,3].tolist()
+    lows = price_data[:,1]
+    highs = price_data[:,2]
+    
+    # 0 long pos, 1 short pos, 2 net pos, 3 total pos, 4 long avg entry, 5 short avg entry
+    long_pos = short_pos = net_pos = total_pos = long_entry = short_entry = 0.0
+    balance = 1.0
+    
+    # change points: index, balance, then the 6 position columns
+    cp_index = []
+    cp_values = []
+    
+    aborted = False
+    
+    # see Instrumentation
+    instrumenting = instrumentation.enabled
+    if instrumenting:
+        loop_start = time.perf_counter()
+        liquidation_time = 0.0
+    
+    for i in range(len(ev_inds)):
+        
+        ind = ev_inds[i]
+        k = ev_sigs[i]
+        
+        if ev_types[i] == 1: #increase long position size
+            
+            if total_pos/balance + lev < lev_limit: #check if lev_limit will be exceeded
                 
+                amounts[k] = balance*lev
+                amount = amounts[k,0]
+                
+                if long_pos == 0:
+                    long_entry = ev_prices[i]*(1+slippage)
                 else:
-                    skipped_signals[sub_events[i,2]] = 1
+                    long_entry = (long_pos*long_entry + (1+slippage)*ev_prices[i]*amount)/(long_pos + amount)
+                
+                long_pos += amount
+                balance -= amount*0.00075
+            
+            else:
+                skipped_signals[k] = 1
+        
+        elif ev_types[i] == -1: #increase short position size
+            
+            if total_pos/balance + lev < lev_limit: #check if lev_limit will be exceeded
+                
+                amounts[k] = balance*lev
+                amount = amounts[k,0]
+                
+                if short_pos == 0:
+                    short_entry = ev_prices[i]*(1-slippage)
+                else:
+                    short_entry = (short_pos*short_entry - (1-slippage)*ev_prices[i]*amount)/(short_pos - amount)
+                
+                short_pos -= amount
+                balance -= amount*0.00075
+            
+            else:
+                skipped_signals[k] = 1
+        
+        elif ev_types[i] == 2: #reduce long position size
+            
+            if skipped_signals[k,0] == 0:
+                
+                amount = amounts[k,0]
+                
+                profit = ((close_prices[k]*(1-slippage)/long_entry)*(1-0.00075) - 0.00075 - 1)*amount
+                
+                long_pos -= amount
+                
+                if long_pos == 0:
+                    long_entry = 0.0
+                elif abs(long_pos/balance) < 0.000001: #catches rounding errors
+                    long_entry = 0.0
+                    long_pos = 0.0
+                
+                balance += profit + amount*0.00075
+        
+        elif ev_types[i] == -2: #reduce short position size
+            
+            if skipped_signals[k,0] == 0:
+                
+                amount = amounts[k,0]
+                
+                profit = ((short_entry*(1+slippage)/close_prices[k])*(1-0.00075) - 0.00075 - 1)*amount
+                
+                short_pos += amount
+                
+                if short_pos == 0:
+                    short_entry = 0.0
+                elif abs(short_pos/balance) < 0.000001:
+                    short_entry = 0.0
+                    short_pos = 0.0
+                
+                balance += profit + amount*0.00075
+        
+        net_pos = long_pos + short_pos
+        total_pos = long_pos - short_pos
+        
+        # several events can share an index, only the state after the last one is kept
+        if len(cp_index) > 0 and cp_index[-1] == ind:
+            cp_values[-1] = [balance, long_pos, short_pos, net_pos, total_pos, long_entry, short_entry]
+        else:
+            cp_index.append(ind)
+            cp_values.append([balance, long_pos, short_pos, net_pos, total_pos, long_entry, short_entry])
+        
+        # if total leverage gets too high at any point, throw out the result
+        if total_pos/balance > 95:
+            if instrumenting:
+                report_abort('leverage_too_high', ind)
+            aborted = True
+            break
+        
+        # if balance gets too low, give up and stop
+        if balance < 0.0001:
+            if instrumenting:
+                report_abort('account_drained', ind)
+            aborted = True
+            break
+        
+        # check for liquidations between current event and next event (within the same chunk)
+        if i < len(ev_inds)-1 and ind != ev_inds[i+1] and ind//chunk == ev_inds[i+1]//chunk:
+            
+            if instrumenting:
+                check_start = time.perf_counter()
+            
+            if net_pos > balance: #long positions with leverage below 1 can't be liquidated
+                
+                liq_price = long_entry*(1 - (balance/net_pos))
+                
+                if range_index is not None:
+                    liquidated = range_index.low_below(ind, ev_inds[i+1], liq_price)
+                else:
+                    liquidated = lows[ind:ev_inds[i+1]].min() <= liq_price
+                
+                if instrumenting:
+                    liquidation_time += time.perf_counter() - check_start
+                
+                if liquidated:
+                    if instrumenting:
+                        report_abort('long_liquidated', ind)
+                    aborted = True
+                    break
+            
+            elif net_pos < 0: #short positions with leverage below 1 CAN be liquidated
+                
+                liq_price = short_entry*(1 - (balance/net_pos))
+                
+                if range_index is not None:
+                    liquidated = range_index.high_above(ind, ev_inds[i+1], liq_price)
+                else:
+                    liquidated = highs[ind:ev_inds[i+1]].max() >= liq_price
+                
+                if instrumenting:
+                    liquidation_time += time.perf_counter() - check_start
+                
+                if liquidated:
+                    if instrumenting:
+                        report_abort('short_liquidated', ind)
+                    aborted = True
+                    break
+    
+    if instrumenting:
+        instrumentation.add_time('event_loop', time.perf_counter() - loop_start)
+        instrumentation.add_time('liquidation_checks', liquidation_time)
+        instrumentation.count('events_processed', i+1 if len(ev_inds) > 0 else 0)
+        instrumentation.count('skipped_signals', np.sum(skipped_signals))
+    
+    cp_index = np.array(cp_index, dtype='int64')
+    cp_values = np.array(cp_values, dtype='float64').reshape(len(cp_index), 7)
+    
+    if aborted: # roll back to the start of the chunk where the run was aborted, like process_sigs
+        keep = cp_index < (ind//chunk)*chunk
+        cp_index = cp_index[keep]
+        cp_values = cp_values[keep]
+    
+    # Sum up all balance changes that are gains and all that are losses. This 
+    # is necessary to calculate profits after tax
+    balance_changes = np.diff(np.concatenate(([1.0], cp_values[:,0])))
+    
+    gains = sum(balance_changes[balance_changes>0])
+    losses = sum(balance_changes[balance_changes<0])
+    
+    #Calculate profits before and after tax (see process_sigs for details)
+    total_profits = 1 + gains + losses
+    total_profits_aft_tax = 1 + 0.7*gains + 0.79*losses
+    
+    if instrumenting:
+        expansion_start = time.perf_counter()
+    
+    if compressed:
+        
+        balance_ext = ChangePoints(cp_index, cp_values[:,:1], [1], first_ind, last_ind+1)
+        positions = ChangePoints(cp_index, cp_values[:,1:], np.zeros(6), first_ind, last_ind+1)
+    
+    elif expand:
+        
+        expanded = expand_change_points(cp_index, cp_values, [1, 0, 0, 0, 0, 0, 0], first_ind, last_ind+1)
+        
+        balance_ext = np.zeros((len(expanded),2),dtype='float64')
+        balance_ext[:,0] = range(first_ind, last_ind+1)
+        balance_ext[:,1] = expanded[:,0]
+        
+        positions = expanded[:,1:]
+    
+    else:
+        balance_ext = None
+        positions = None
+    
+    if instrumenting:
+        instrumentation.add_time('output_expansion', time.perf_counter() - expansion_start)
+    
+    return total_profits, sigs_w_close, balance_ext, positions, gains, losses, total_profits_aft_tax, skipped_signals
+
+
+class BatchBacktestState:
+    
+    '''
+    Account state of every candidate of a batched backtest (see 
+    resume_sigs_batch) after some of the events have been processed, so the 
+    backtest can be stopped at any candle and carried on later from the same 
+    point. next_event is the row of events to carry on from, and current_ind 
+    the index of the last event processed. The gains and losses of the 
+    events at current_ind haven't been added yet (see totals).
+    
+    Candidates can be dropped with select, e.g. to only carry on with the 
+    most promising ones, and the state can be saved to and loaded from a 
+    .npz file.
+    '''
+    
+    fields = ['levs', 'lev_limits', 'amounts', 'skipped_signals', 'long_pos', 'short_pos', 
+              'long_entry', 'short_entry', 'balance', 'active', 'gains', 'losses', 
+              'prev_balance', 'chunk_gains', 'chunk_losses']
+    
+    def __init__(self, levs, lev_limits, n_sigs):
+        
+        self.levs = np.asarray(levs, dtype='float64')
+        self.lev_limits = np.asarray(lev_limits, dtype='float64')
+        M = len(self.levs)
+        
+        self.amounts = np.zeros((M,n_sigs))
+        self.skipped_signals = np.zeros((M,n_sigs), dtype=bool)
+        
+        self.long_pos = np.zeros(M)
+        self.short_pos = np.zeros(M)
+        self.long_entry = np.zeros(M)
+        self.short_entry = np.zeros(M)
+        self.balance = np.ones(M)
+        self.active = np.ones(M, dtype=bool)
+        
+        self.gains = np.zeros(M)
+        self.losses = np.zeros(M)
+        self.prev_balance = np.ones(M)
+        self.chunk_gains = np.zeros(M)
+        self.chunk_losses = np.zeros(M)
+        
+        self.next_event = 0
+        self.current_ind = None
+    
+    
+    def __len__(self):
+        return len(self.levs)
+    
+    
+    def select(self, keep):
+        '''New state with only the candidates in keep (a boolean mask or 
+        indices)'''
+        state = BatchBacktestState(self.levs[keep], self.lev_limits[keep], self.amounts.shape[1])
+        for name in self.fields:
+            setattr(state, name, getattr(self, name)[keep])
+        state.next_event = self.next_event
+        state.current_ind = self.current_ind
+        return state
+    
+    
+    def totals(self):
+        
+        '''total_profits, gains, losses and total_profits_aft_tax (arrays of 
+        length M) of the events processed so far, i.e. what process_sigs_batch 
+        would give if the backtest ended here'''
+        
+        gains = self.gains
+        losses = self.losses
+        
+        if self.current_ind is not None:
+            change = self.balance - self.prev_balance
+            gains = np.where(self.active & (change > 0), gains + change, gains)
+            losses = np.where(self.active & (change < 0), losses + change, losses)
+        
+        return 1 + gains + losses, gains, losses, 1 + 0.7*gains + 0.79*losses
+    
+    
+    def save(self, filename):
+        np.savez(filename, next_event=self.next_event, 
+                 current_ind=-1 if self.current_ind is None else self.current_ind, 
+                 **{name: getattr(self, name) for name in self.fields})
+    
+    
+    @classmethod
+    def load(cls, filename):
+        data = np.load(filename)
+        state = cls(data['levs'], data['lev_limits'], data['amounts'].shape[1])
+        for name in cls.fields:
+            setattr(state, name, data[name])
+        state.next_event = int(data['next_event'])
+        state.current_ind = None if int(data['current_ind']) < 0 else int(data['current_ind'])
+        return state
+
+
+def process_sigs_batch(events, price_data, sigs_w_close, levs, lev_limits, slippage, range_index=None):
+    
+    """Runs process_sigs_sparse for many (lev, lev_limit) pairs at once. All 
+    candidates share the same events, so the loop over events is only done 
+    once, with the account state of every candidate held in arrays and 
+    updated together. Candidates that get aborted (too much leverage, drained 
+    account or liquidation) are frozen at the start of the chunk where that 
+    happened, exactly like in process_sigs, and ignored from then on.
+    
+    levs and lev_limits are arrays of length M. Returns total_profits, gains, 
+    losses and total_profits_aft_tax as arrays of length M, plus 
+    skipped_signals with one row per candidate. Only the totals are 
+    calculated, use process_sigs_sparse to get balance_ext and positions for 
+    a single candidate. To stop the backtest part way through and carry on 
+    later, use resume_sigs_batch instead"""
+    
+    state = resume_sigs_batch(BatchBacktestState(levs, lev_limits, len(sigs_w_close)), events, price_data, sigs_w_close, slippage, range_index=range_index)
+    
+    if instrumentation.enabled: # see Instrumentation
+        instrumentation.count('skipped_signals', np.count_nonzero(state.skipped_signals))
+    
+    total_profits, gains, losses, total_profits_aft_tax = state.totals()
+    
+    return total_profits, gains, losses, total_profits_aft_tax, state.skipped_signals
+
+
+def resume_sigs_batch(state, events, price_data, sigs_w_close, slippage, stop=None, range_index=None):
+    
+    """The event loop of process_sigs_batch. Carries on the backtest in state 
+    (a BatchBacktestState) from where it was left, up to but not including 
+    the candle at index stop (or to the end if stop is None), and returns 
+    state, which is updated in place. state.totals() gives the profits up to 
+    stop. Running a backtest in several steps gives exactly the same results 
+    as running it in one go, as long as events, price_data and sigs_w_close 
+    are the same every time"""
+    
+    chunk = 10000 # same chunks as process_sigs, see process_sigs_sparse
+    
+    levs = state.levs
+    lev_limits = state.lev_limits
+    
+    # events at or after the last chunk boundary are never processed, like in process_sigs
+    n_events = np.searchsorted(events[:,0], np.ceil(events[-1,0]/chunk).astype(int)*chunk)
+    
+    first = state.next_event
+    last = n_events if stop is None else min(n_events, np.searchsorted(events[:,0], stop))
+    
+    # one event past the ones processed here, for the liquidation check of the last one
+    ev_inds = events[first:min(last+1, n_events),0].tolist()
+    ev_types = events[first:last,1].tolist()
+    ev_sigs = events[first:last,2].tolist()
+    ev_prices = price_data[events[first:last,0],3].tolist()
+    close_prices = sigs_w_close[:,3].tolist()
+    lows = price_data[:,1]
+    highs = price_data[:,2]
+    
+    amounts = state.amounts
+    skipped_signals = state.skipped_signals
+    
+    long_pos = state.long_pos
+    short_pos = state.short_pos
+    net_pos = long_pos + short_pos
+    total_pos = long_pos - short_pos
+    long_entry = state.long_entry
+    short_entry = state.short_entry
+    balance = state.balance
+    
+    active = state.active
+    
+    # gains and losses are summed up one event index at a time, as in 
+    # process_sigs_sparse. The values at the start of the current chunk are 
+    # kept so that aborted candidates can be rolled back to them
+    gains = state.gains
+    losses = state.losses
+    prev_balance = state.prev_balance
+    chunk_gains = state.chunk_gains
+    chunk_losses = state.chunk_losses
+    
+    current_ind = state.current_ind
+    
+    # see Instrumentation
+    instrumenting = instrumentation.enabled
+    if instrumenting:
+        loop_start = time.perf_counter()
+        liquidation_time = 0.0
+        liquidations = 0
+        aborted_before = np.count_nonzero(~active)
+    
+    i = -1
+    
+    with np.errstate(divide='ignore', invalid='ignore'):
+        
+        for i in range(len(ev_types)):
+            
+            ind = ev_inds[i]
+            k = ev_sigs[i]
+            
+            if ind != current_ind:
+                
+                if current_ind is not None:
+                    change = balance - prev_balance
+                    gains = np.where(active & (change > 0), gains + change, gains)
+                    losses = np.where(active & (change < 0), losses + change, losses)
+                    prev_balance = np.where(active, balance, prev_balance)
                 
+                if current_ind is None or ind//chunk != current_ind//chunk:
+                    chunk_gains = gains.copy()
+                    chunk_losses = losses.copy()
+                
+                current_ind = ind
+            
+            if ev_types[i] == 1 or ev_types[i] == -1: #increase long/short position size
+                
+                opened = active & (total_pos/balance + levs < lev_limits) #check if lev_limit will be exceeded
+                
+                amount = balance*levs
+                amounts[:,k] = np.where(opened, amount, amounts[:,k])
+                skipped_signals[:,k] = active & ~opened
+                
+                if ev_types[i] == 1:
+                    new_entry = np.where(long_pos == 0, ev_prices[i]*(1+slippage), 
+                                         (long_pos*long_entry + (1+slippage)*ev_prices[i]*amount)/(long_pos + amount))
+                    long_entry = np.where(opened, new_entry, long_entry)
+                    long_pos = np.where(opened, long_pos + amount, long_pos)
+                else:
+                    new_entry = np.where(short_pos == 0, ev_prices[i]*(1-slippage), 
+                                         (short_pos*short_entry - (1-slippage)*ev_prices[i]*amount)/(short_pos - amount))
+                    short_entry = np.where(opened, new_entry, short_entry)
+                    short_pos = np.where(opened, short_pos - amount, short_pos)
+                
+                balance = np.where(opened, balance - amount*0.00075, balance)
+            
+            else: #reduce long/short position size
                 
-            elif sub_events[i,1]==-1: #increase short position size
+                closed = active & ~skipped_signals[:,k]
+                amount = amounts[:,k]
                 
-                if sub_positions[update_ind,3]/sub_balance_ext[update_ind,1] + lev < lev_limit: #check if lev_limit will be exceeded
+                if ev_types[i] == 2:
+                    profit = ((close_prices[k]*(1-slippage)/long_entry)*(1-0.00075) - 0.00075 - 1)*amount
                     
-                    amounts[sub_events[i,2]] = sub_balance_ext[update_ind,1]*lev
+                    new_pos = long_pos - amount
+                    flat = np.logical_or(new_pos == 0, abs(new_pos/balance) < 0.000001) #catches rounding errors
                     
-                    if sub_positions[update_ind,1] == 0:
-                        sub_positions[update_ind:,5] = sub_price_data[sub_events[i,0]-j*chunk,3]*(1-slippage)
-                    else:
-                        sub_positions[update_ind:,5] = (np.prod(sub_positions[update_ind,[1,5]]) - (1-slippage)*sub_price_data[sub_events[i,0]-j*chunk,3]*amounts[sub_events[i,2]])/(sub_positions[update_ind,1] - amounts[sub_events[i,2]])
+                    long_entry = np.where(closed & flat, 0.0, long_entry)
+                    long_pos = np.where(closed, np.where(flat, 0.0, new_pos), long_pos)
+                else:
+                    profit = ((short_entry*(1+slippage)/close_prices[k])*(1-0.00075) - 0.00075 - 1)*amount
                     
-                    sub_positions[update_ind:,1] -= amounts[sub_events[i,2]]
-                    sub_balance_ext[update_ind:,1] -= amounts[sub_events[i,2]]*0.00075
+                    new_pos = short_pos + amount
+                    flat = np.logical_or(new_pos == 0, abs(new_pos/balance) < 0.000001)
                     
-                else:
-                    skipped_signals[sub_events[i,2]] = 1
+                    short_entry = np.where(closed & flat, 0.0, short_entry)
+                    short_pos = np.where(closed, np.where(flat, 0.0, new_pos), short_pos)
                 
+                balance = np.where(closed, balance + (profit + amount*0.00075), balance)
+            
+            net_pos = long_pos + short_pos
+            total_pos = long_pos - short_pos
+            
+            # same checks as in process_sigs, but a failing candidate is only 
+            # taken out of the run instead of stopping it
+            aborted = active & np.logical_or(total_pos/balance > 95, balance < 0.0001)
+            
+            if instrumenting:
+                early_aborts = np.count_nonzero(aborted)
+                check_start = time.perf_counter()
+            
+            if i < len(ev_inds)-1 and ind != ev_inds[i+1] and ind//chunk == ev_inds[i+1]//chunk:
                 
-            elif sub_events[i,1]==2: #reduce long position size
+                longs = active & (net_pos > balance)
+                shorts = active & (net_pos < 0)
                 
-                if skipped_signals[sub_events[i,2]] == 0:
-                    
-                    #includes taker fees at open and close (must remove opening 
-                    #fee before adding to balance_ext, since it's already been 
-                    #accounted for)
-                    profit = ((sigs_w_close[sub_events[i,2],3]*(1-slippage)/sub_positions[update_ind,4])*(1-0.00075) - 0.00075 - 1)*amounts[sub_events[i,2],0]
-                    
-                    sub_positions[update_ind:,0] -= amounts[sub_events[i,2]]
-                    
-                    if sub_positions[update_ind,0] == 0:
-                        sub_positions[update_ind:,4] = 0
-                    elif sub_positions[update_ind,0] != 0 and abs(sub_positions[update_ind,0]/sub_balance_ext[update_ind,1]) < 0.000001: #catches rounding errors
-                        sub_positions[update_ind:,4] = 0
-                        sub_positions[update_ind:,0] = 0
-                    
-                    
-                    sub_balance_ext[update_ind:,1] += profit + amounts[sub_events[i,2]]*0.00075
-                    
-                        
-            elif sub_events[i,1]==-2: #reduce short position size
+                if np.any(longs):
+                    low = range_index.range_min(ind, ev_inds[i+1]) if range_index is not None else lows[ind:ev_inds[i+1]].min()
+                    aborted |= longs & (low <= long_entry*(1 - (balance/net_pos)))
                 
-                if skipped_signals[sub_events[i,2]] == 0:
-                    
-                    #includes taker fees at open and close (must remove opening 
-                    #fee before adding to balance_ext, since it's already been 
-                    #accounted for)
-                    profit = ((sub_positions[update_ind,5]*(1+slippage)/sigs_w_close[sub_events[i,2],3])*(1-0.00075) - 0.00075 - 1)*amounts[sub_events[i,2],0]
-                    
-                    sub_positions[update_ind:,1] += amounts[sub_events[i,2]]
-                    
-                    if sub_positions[update_ind,1] == 0:
-                        sub_positions[update_ind:,5] = 0
-                    elif sub_positions[update_ind,1] != 0 and abs(sub_positions[update_ind,1]/sub_balance_ext[update_ind,1]) < 0.000001:
-                        sub_positions[update_ind:,5] = 0
-                        sub_positions[update_ind:,1] = 0
-                    
-                    
-                    sub_balance_ext[update_ind:,1] += profit + amounts[sub_events[i,2]]*0.00075
-                    
+                if np.any(shorts):
+                    high = range_index.range_max(ind, ev_inds[i+1]) if range_index is not None else highs[ind:ev_inds[i+1]].max()
+                    aborted |= shorts & (high >= short_entry*(1 - (balance/net_pos)))
+            
+            if instrumenting:
+                liquidation_time += time.perf_counter() - check_start
+                liquidations += np.count_nonzero(aborted) - early_aborts
+            
+            if np.any(aborted):
+                gains = np.where(aborted, chunk_gains, gains)
+                losses = np.where(aborted, chunk_losses, losses)
+                active = active & ~aborted
+                
+                if not np.any(active):
+                    break
+    
+    # nothing is left to run once every candidate has been aborted
+    state.next_event = first + i + 1 if np.any(active) else n_events
+    state.current_ind = current_ind
+    
+    state.long_pos, state.short_pos = long_pos, short_pos
+    state.long_entry, state.short_entry = long_entry, short_entry
+    state.balance, state.active = balance, active
+    state.gains, state.losses, state.prev_balance = gains, losses, prev_balance
+    state.chunk_gains, state.chunk_losses = chunk_gains, chunk_losses
+    
+    if instrumenting:
+        instrumentation.add_time('event_loop', time.perf_counter() - loop_start)
+        instrumentation.add_time('liquidation_checks', liquidation_time)
+        instrumentation.count('events_processed', i+1)
+        instrumentation.count('early_aborts', np.count_nonzero(~active) - aborted_before - liquidations)
+        instrumentation.count('liquidations', liquidations)
+    
+    return state
+
+
+def prepare_signal_events(signals, price_data):
+    '''
+    Does all the work of calc_profit_simple that doesn't depend on the trading 
+    parameters: finds where each position gets closed (at the next signal in 
+    the opposite direction) and puts all opens and closes into a single 
+    sorted list of events. 
+    
+    Returns sigs_w_close and events (see process_sigs), plus TP_pct, the 
+    price change between opening and closing each position in the direction 
+    of its signal.
+    '''
+    
+    # convert signals to int to use the first column as indices
+    signals = signals.astype(int)
+    
+    sig_flips = np.nonzero(signals[1:,1]-signals[:-1,1])[0]+1
+    
+    # each position is closed at the first flip after it was opened
+    pos_flips = signals[sig_flips,0][np.searchsorted(sig_flips, np.arange(sig_flips[-1]), side='right')]
+    
+    # signals after the last flip are never closed, so they're dropped
+    signals = signals[:sig_flips[-1]]
+    
+    
+    # new array, same as signals, plus an extra column listing when each 
+    # position is closed
+    sigs_w_close = np.zeros((len(signals),4),dtype='float64')
+    sigs_w_close[:,0] = signals[:,0]
+    sigs_w_close[:,1] = signals[:,1]
+    sigs_w_close[:,2] = pos_flips
+    sigs_w_close[:,3] = price_data[pos_flips,3]
+    
+    # price change between opening and closing each position, in the 
+    # direction of the signal
+    current_price = price_data[signals[:,0],3]
+    
+    longs = signals[:,1]>0
+    shorts = signals[:,1]<0
+    
+    TP_pct = np.zeros(len(signals))
+    TP_pct[longs] = sigs_w_close[longs,3]/current_price[longs] - 1
+    TP_pct[shorts] = 1 - sigs_w_close[shorts,3]/current_price[shorts]
+    
+    
+    # put all opens and closes into a single list. 0: index in price_data when 
+    # it takes place, 1: indicates whether it's open long/short (+/-1) or 
+    # close long/short (+/-2), 2: row number in sigs_w_close where the event 
+    # came from
+    events = np.zeros((2*len(sigs_w_close),3))
+    
+    events[:len(sigs_w_close),:2] = sigs_w_close[:,:2]
+    events[:len(sigs_w_close),2] = range(len(sigs_w_close))
+    events[len(sigs_w_close):,0] = sigs_w_close[:,2]
+    events[len(sigs_w_close):,1] = 2*sigs_w_close[:,1]
+    events[len(sigs_w_close):,2] = range(len(sigs_w_close))
+    
+    #sort by when they occur
+    events = events[np.lexsort((events[:,2],events[:,0])),:].astype(int)
+    
+    return sigs_w_close, events, TP_pct
+
+
+class PreparedSignals:
+    
+    '''The result of prepare_signal_events for one set of signals, i.e. 
+    everything calc_profit_simple needs that doesn't depend on lev and 
+    lev_limit. Build it with prepare_signals, which memoizes it by the 
+    content of the signals and the prices they use, and can also keep it on 
+    disk so it survives between runs'''
+    
+    def __init__(self, sigs_w_close, events, TP_pct, key):
+        self.sigs_w_close = sigs_w_close
+        self.events = events
+        self.TP_pct = TP_pct
+        self.key = key
+    
+    
+    def save(self, filename):
+        np.savez(filename, sigs_w_close=self.sigs_w_close, events=self.events, TP_pct=self.TP_pct, key=self.key)
+    
+    
+    @classmethod
+    def load(cls, filename):
+        data = np.load(filename)
+        return cls(data['sigs_w_close'], data['events'], data['TP_pct'], str(data['key']))
+
+
+# prepared signal sets from the most recent calls to prepare_signals, by key
+prepared_signals_memo = {}
+prepared_signals_memo_size = 8
+
+
+def signal_set_key(signals, price_data):
+    
+    '''Content hash identifying a set of signals together with the part of 
+    price_data it depends on (the close prices at the signal indices, since 
+    that's where positions are opened and closed)'''
+    
+    signals = np.ascontiguousarray(signals, dtype='float64')
+    
+    key = hashlib.sha1()
+    key.update(signals.tobytes())
+    key.update(np.ascontiguousarray(price_data[signals[:,0].astype(int),3], dtype='float64').tobytes())
+    
+    return key.hexdigest()
+
+
+def prepare_signals(signals, price_data, cache_dir=None):
+    
+    '''Returns a PreparedSignals for signals. Signal sets that were prepared 
+    recently are taken from memory, and if cache_dir is given, prepared sets 
+    are also saved there and reused by later runs. If signals is already a 
+    PreparedSignals it's returned as it is'''
+    
+    if isinstance(signals, PreparedSignals):
+        return signals
+    
+    key = signal_set_key(signals, price_data)
+    
+    if key in prepared_signals_memo:
+        return prepared_signals_memo[key]
+    
+    cache_filename = None
+    if cache_dir is not None:
+        cache_filename = os.path.join(cache_dir, 'prepared_signals_' + key + '.npz')
+    
+    if cache_filename is not None and os.path.isfile(cache_filename):
+        prepared = PreparedSignals.load(cache_filename)
+    else:
+        prepared = PreparedSignals(*prepare_signal_events(signals, price_data), key)
+        if cache_filename is not None:
+            prepared.save(cache_filename)
+    
+    # forget the oldest set when the memo is full
+    if len(prepared_signals_memo) >= prepared_signals_memo_size:
+        del prepared_signals_memo[next(iter(prepared_signals_memo))]
+    prepared_signals_memo[key] = prepared
+    
+    return prepared
+
+
+def calc_profit_simple(signals, price_data, lev, lev_limit, sparse=False, expand=True, compressed=False, range_index=None): 
+    '''
+    This is a simple example trading algorithm. In reality, the ones I end up 
+    using are considerably more complicated (use stop losses, take profits, 
+    moving stop losses, hedging, etc).
+    
+    Calculates profit very simply. At a buy trigger, either adds 'lev' leverage 
+    to an open long position, or closes an open short position and opens a 'lev' 
+    long position. Vice versa for a sell trigger. No hedging, i.e., long and 
+    short positions are never open at the same time. 
+
+    Parameters
+    ----------
+    signals : numpy array
+        column 0: index in the price_data where the trigger occurs
+        column 1: trigger type. 1 is a buy trigger and -1 is a sell trigger
+        can also be a PreparedSignals (see prepare_signals), which skips all 
+        of the work that doesn't depend on lev and lev_limit
+    price_data : numpy array
+        column 0: time
+        column 1: low price
+        column 2: high price
+        column 3: close price
+    lev : float
+        amount of leverage to add per trigger. 1 = 1x
+    lev_limit : float
+        maximum total leverage allowed (see process_sigs)
+    sparse : bool
+        use process_sigs_sparse instead of process_sigs. Gives the same 
+        results, but much faster
+    expand : bool
+        if False, balance_ext and positions are not expanded to one row per 
+        minute and are returned as None, so only the totals are calculated 
+        (always uses process_sigs_sparse) 
+    compressed : bool 
+        if True, balance_ext and positions are returned as ChangePoints, 
+        which only hold the values at each event and can be expanded when 
+        needed (always uses process_sigs_sparse) 
+    range_index : PriceRangeIndex
+        optional index over price_data used for the liquidation checks (see 
+        load_price_range_index)
+    
+    -------
+    None.
+
+    '''
+    
+    # can set average slippage manually (as a percentage)
+    slippage = 0.00
+    
+    instrumenting = instrumentation.enabled # see Instrumentation
+    
+    if instrumenting:
+        with instrumentation.timer('preprocessing'):
+            prepared = prepare_signals(signals, price_data)
+    else:
+        prepared = prepare_signals(signals, price_data)
+    
+    sigs_w_close, events, TP_pct = prepared.sigs_w_close, prepared.events, prepared.TP_pct
+    
+    profits = np.reshape(1 + (TP_pct*(1-0.00075*lev) - 0.0015 - slippage)*lev, (-1,1))
+    
+    
+    # keep track of individual additions to positions
+    # amounts = np.zeros((len(sigs_w_close),1))
+    
+    
+    if np.any(profits<0):
+        total_profits=0
+        total_profits_aft_tax=0
+        balance_ext = 0
+        positions = 0
+        gains = 0
+        losses = 0
+    else:
+        
+        if sparse or compressed or not expand:
+            total_profits, sigs_w_close, balance_ext, positions, gains, losses, total_profits_aft_tax, skipped_signals = process_sigs_sparse(events, price_data, sigs_w_close, lev, lev_limit, slippage, expand=expand, compressed=compressed, range_index=range_index)
+        else:
+            total_profits, sigs_w_close, balance_ext, positions, gains, losses, total_profits_aft_tax, skipped_signals = process_sigs(events, price_data, sigs_w_close, lev, lev_limit, slippage, range_index=range_index)
+        
+    
+    if instrumenting:
+        instrumentation.count('backtests')
+        instrumentation.record('backtest', lev=float(lev), lev_limit=float(lev_limit), total_profits=float(total_profits), total_profits_aft_tax=float(total_profits_aft_tax))
+    
+    return profits, total_profits, sigs_w_close, balance_ext, positions, gains, losses, total_profits_aft_tax
+
+
+class BatchBacktest:
+    
+    '''
+    calc_profit_batch that can be stopped at any candle and carried on later. 
+    The events are prepared and the parameter vectors checked when it's 
+    made, and every call to run carries all the candidates on from where the 
+    last one stopped (see resume_sigs_batch), so a backtest run up to 
+    several growing stops in turn costs the same as running it once to the 
+    last one. select drops candidates that aren't worth carrying on with.
+        
+        backtest = BatchBacktest(signals, data_comp, params, range_index) 
+        total_profits, total_profits_aft_tax = backtest.run(500000) # first 500000 candles 
+        backtest.select(total_profits_aft_tax > 1) 
+        total_profits, total_profits_aft_tax = backtest.run() # the rest, for the ones left
+    '''
+    
+    def __init__(self, signals, price_data, params, range_index=None):
+        
+        self.slippage = 0.00
+        
+        self.params = np.reshape(np.asarray(params, dtype='float64'), (-1,2))
+        self.price_data = price_data
+        self.range_index = range_index
+        
+        instrumenting = instrumentation.enabled # see Instrumentation
+        
+        if instrumenting:
+            preprocessing_start = time.perf_counter()
+        
+        self.prepared = prepare_signals(signals, price_data)
+        TP_pct = self.prepared.TP_pct
+        
+        # candidates that fail the profits check in calc_profit_simple aren't run at all
+        self.valid = np.array([not np.any(1 + (TP_pct*(1-0.00075*lev) - 0.0015 - self.slippage)*lev < 0) for lev in self.params[:,0]], dtype=bool)
+        
+        if instrumenting:
+            instrumentation.add_time('preprocessing', time.perf_counter() - preprocessing_start)
+        
+        self.state = BatchBacktestState(self.params[self.valid,0], self.params[self.valid,1], len(self.prepared.sigs_w_close))
+    
+    
+    def __len__(self):
+        return len(self.params)
+    
+    
+    @property
+    def first_index(self):
+        '''Index of the first event, i.e. where the backtest really starts'''
+        return int(self.prepared.events[0,0])
+    
+    
+    @property
+    def end_index(self):
+        '''Index just after the last event that gets processed'''
+        return int(self.prepared.events[-1,0]) + 1
+    
+    
+    def run(self, stop=None):
+        
+        '''Carries the backtest on up to (not including) the candle at index 
+        stop, or to the end if stop is None. Returns total_profits and 
+        total_profits_aft_tax up to there, as arrays with one value per 
+        candidate (0 for the ones that fail the profits check)'''
+        
+        if len(self.state) > 0:
+            resume_sigs_batch(self.state, self.prepared.events, self.price_data, self.prepared.sigs_w_close, self.slippage, stop, self.range_index)
+        
+        total_profits = np.zeros(len(self.params))
+        total_profits_aft_tax = np.zeros(len(self.params))
+        
+        total_profits[self.valid], gains, losses, total_profits_aft_tax[self.valid] = self.state.totals()
+        
+        return total_profits, total_profits_aft_tax
+    
+    
+    def select(self, keep):
+        
+        '''Only keeps the candidates in keep (a boolean mask or indices into 
+        params)'''
+        
+        keep_mask = np.zeros(len(self.params), dtype=bool)
+        keep_mask[keep] = True
+        
+        self.state = self.state.select(keep_mask[self.valid])
+        self.params = self.params[keep_mask]
+        self.valid = self.valid[keep_mask]
+
+
+def calc_profit_batch(signals, price_data, params, range_index=None):
+    '''
+    Same as calc_profit_simple with sparse=True, but for a whole population 
+    of parameter vectors at once. params is an (M, 2) array of 
+    (lev, lev_limit) pairs. The events are only prepared once (or not at all 
+    if signals is a PreparedSignals), and all M strategies are run together 
+    like in process_sigs_batch.
+    
+    Returns total_profits and total_profits_aft_tax as arrays of length M. 
+    Parameter vectors where any single trade would lose more than the whole 
+    position get 0 for both, like in calc_profit_simple. To stop part way 
+    through and carry on later, use BatchBacktest.
+    '''
+    
+    backtest = BatchBacktest(signals, price_data, params, range_index)
+    
+    total_profits, total_profits_aft_tax = backtest.run()
+    
+    if instrumentation.enabled: # see Instrumentation
+        instrumentation.count('skipped_signals', np.count_nonzero(backtest.state.skipped_signals))
+        instrumentation.count('backtests', len(backtest))
+        instrumentation.record('backtest_batch', n_candidates=len(backtest), best_profit_aft_tax=float(np.max(total_profits_aft_tax)) if len(backtest) > 0 else None)
+    
+    return total_profits, total_profits_aft_tax
+
+
+
+#------------- Functions for running the optimizer in parallel ---------------
+
+
+
+def share_arrays(arrays, folder):
+    
+    '''Saves every array in the dict "arrays" as a .npy file in folder, so that 
+    other processes can memory-map them instead of getting their own pickled 
+    copy. Returns a dict with the filename of each array'''
+    
+    filenames = {}
+    
+    for name in arrays:
+        filenames[name] = os.path.join(folder, name + '.npy')
+        np.save(filenames[name], arrays[name])
+    
+    return filenames
+
+
+def attach_arrays(filenames):
+    
+    '''Memory-maps (read only) the arrays saved by share_arrays. Nothing is 
+    read from disk until it's used, and the pages are shared by all processes 
+    through the OS file cache'''
+    
+    # np.asarray drops the memmap subclass, which makes indexing single 
+    # elements much faster, but still points at the mapped file
+    return {name: np.asarray(np.load(filenames[name], mmap_mode='r')) for name in filenames}
+
+
+# state of each worker process of a ParallelProfitFitter, set up by init_profit_worker
+profit_worker_state = {}
+
+
+def init_profit_worker(filenames, key, store=None, instrument=False):
+    
+    '''Runs once in every worker process. Attaches to the shared price data 
+    and prepared signals, which costs the same no matter how big they are. 
+    If the price data comes from a candle store, store holds the arguments 
+    for load_candle_store and the workers map the store directly. If 
+    instrument is True, the worker's instrumentation is enabled and sent 
+    back with every result'''
+    
+    arrays = attach_arrays(filenames)
+    
+    if instrument:
+        instrumentation.enable()
+    
+    if store is not None:
+        price_data = load_candle_store(*store)
+    else:
+        price_data = arrays['price_data']
+    
+    profit_worker_state['price_data'] = price_data
+    profit_worker_state['prepared'] = PreparedSignals(arrays['sigs_w_close'], arrays['events'], arrays['TP_pct'], key)
+    
+    if 'range_offsets' in arrays:
+        profit_worker_state['range_index'] = PriceRangeIndex.from_flat_levels(price_data[:,1], price_data[:,2], arrays['range_offsets'], arrays['range_mins'], arrays['range_maxs'])
+    else:
+        profit_worker_state['range_index'] = None
+
+
+def profit_worker_batch(params):
+    
+    '''Evaluates a block of (lev, lev_limit) pairs in a worker process'''
+    
+    total_profits, total_profits_aft_tax = calc_profit_batch(profit_worker_state['prepared'], profit_worker_state['price_data'], params, range_index=profit_worker_state['range_index'])
+    
+    if instrumentation.enabled:
+        return total_profits_aft_tax, instrumentation.collect()
+    
+    return total_profits_aft_tax
+
+
+class ParallelProfitFitter:
+    
+    '''
+    Objective function for differential_evolution (with vectorized=True) 
+    that spreads every generation over a pool of worker processes. 
+    
+    The price data, the prepared signals and the range index are saved once 
+    to .npy files in a temporary folder (price data that comes from a candle 
+    store is used straight from the store) and memory-mapped by each worker, so 
+    nothing big is ever pickled and starting a worker doesn't depend on the 
+    size of the data set. Each worker runs its share of the population with 
+    calc_profit_batch, and the negative profits after tax are returned.
+    
+    If instrumentation is enabled when it's made, the workers' timers, 
+    counters and records are added to it after every generation.
+    
+    Use it in a with statement (or call close) so the worker pool and the 
+    temporary files are cleaned up afterwards:
+        
+        with ParallelProfitFitter(signals, data_comp, range_index) as fitter:
+            fit_coeffs = differential_evolution(fitter, bounds, vectorized=True, updating='deferred')
+    '''
+    
+    def __init__(self, signals, price_data, range_index=None, num_cores=None, folder=None):
+        
+        prepared = prepare_signals(signals, price_data)
+        
+        self.num_cores = num_cores if num_cores is not None else os.cpu_count()
+        
+        self.own_folder = folder is None
+        self.folder = tempfile.mkdtemp(prefix='shared_data_') if folder is None else folder
+        
+        arrays = {'sigs_w_close': prepared.sigs_w_close, 
+                  'events': prepared.events, 
+                  'TP_pct': prepared.TP_pct}
+        
+        # data from a candle store is already memory-mapped, so the workers can just open the same files
+        if isinstance(price_data, CandleData) and price_data.folder is not None:
+            store = (price_data.folder, price_data.columns, price_data.start, price_data.start + len(price_data))
+        else:
+            store = None
+            arrays['price_data'] = price_data
+        
+        if range_index is not None:
+            arrays['range_offsets'], arrays['range_mins'], arrays['range_maxs'] = range_index.flat_levels()
+        
+        filenames = share_arrays(arrays, self.folder)
+        
+        self.instrument = instrumentation.enabled
+        
+        self.pool = multiprocessing.Pool(self.num_cores, initializer=init_profit_worker, initargs=(filenames, prepared.key, store, self.instrument))
+    
+    
+    def __call__(self, x):
+        
+        # differential_evolution passes one parameter vector per column
+        params = np.reshape(np.asarray(x).T, (-1,2))
+        
+        blocks = [block for block in np.array_split(params, self.num_cores) if len(block) > 0]
+        
+        results = self.pool.map(profit_worker_batch, blocks)
+        
+        if self.instrument:
+            for total_profits_aft_tax, summary in results:
+                instrumentation.merge(summary)
+            results = [total_profits_aft_tax for total_profits_aft_tax, summary in results]
+        
+        return -np.concatenate(results)
+    
+    
+    def close(self):
+        
+        self.pool.close()
+        self.pool.join()
+        
+        if self.own_folder:
+            shutil.rmtree(self.folder, ignore_errors=True)
+    
+    
+    def __enter__(self):
+        return self
+    
+    
+    def __exit__(self, *args):
+        self.close()
+
+
+
+#-------------------- Functions for plotting the results ---------------------
+
+
+
+def minmax_indices(y, n_bins):
+    
+    '''Splits y into n_bins equal bins and returns the indices of the lowest 
+    and highest point in each of them, in order. Plotting only those points 
+    looks the same as plotting all of y at screen resolution, since every 
+    peak and dip is still there'''
+    
+    n = len(y)
+    
+    if n <= 2*n_bins:
+        return np.arange(n)
+    
+    bin_length = int(np.ceil(n/n_bins))
+    n_bins = int(np.ceil(n/bin_length))
+    
+    # pad the last bin with its last value, which never adds a new min or max
+    bins = np.full(n_bins*bin_length, y[-1], dtype='float64')
+    bins[:n] = y
+    bins = bins.reshape(n_bins, bin_length)
+    
+    offsets = np.arange(n_bins)*bin_length
+    
+    mins = np.minimum(np.argmin(bins, axis=1) + offsets, n-1)
+    maxs = np.minimum(np.argmax(bins, axis=1) + offsets, n-1)
+    
+    return np.unique(np.concatenate(([0, n-1], mins, maxs)))
+
+
+def lttb_indices(x, y, n_out):
+    
+    '''Largest-Triangle-Three-Buckets downsampling: picks n_out points of 
+    (x, y), always including the first and last. The rest are split into 
+    n_out-2 buckets, and from each bucket the point that makes the largest 
+    triangle with the previously picked point and the average of the next 
+    bucket is picked, which keeps the visual shape (and extremes) of the 
+    line. Only loops over the buckets, not the points'''
+    
+    n = len(y)
+    
+    if n <= n_out or n_out < 3:
+        return np.arange(n)
+    
+    x = np.asarray(x, dtype='float64')
+    y = np.asarray(y, dtype='float64')
+    
+    edges = np.linspace(1, n-1, n_out-1).astype('int64')
+    
+    picked = np.empty(n_out, dtype='int64')
+    picked[0] = 0
+    picked[-1] = n-1
+    
+    a = 0
+    
+    for k in range(n_out-2):
+        
+        start, end = edges[k], edges[k+1]
+        
+        # the next bucket is just the last point for the last bucket
+        next_start = edges[k+1]
+        next_end = edges[k+2] if k+2 < len(edges) else n
+        
+        avg_x = x[next_start:next_end].mean()
+        avg_y = y[next_start:next_end].mean()
+        
+        areas = np.abs((x[a] - avg_x)*(y[start:end] - y[a]) - (x[a] - x[start:end])*(avg_y - y[a]))
+        
+        a = start + np.argmax(areas)
+        picked[k+1] = a
+    
+    return picked
+
+
+def decimate_series(rows, values, n_points=2000, method='minmax'):
+    
+    '''Cuts a series down to about n_points points for plotting, with 
+    minmax_indices or lttb_indices (method='lttb'). rows are the candle rows 
+    of values. Returns the rows and values of the points that are kept'''
+    
+    rows = np.asarray(rows)
+    values = np.asarray(values)
+    
+    if method == 'lttb':
+        keep = lttb_indices(rows, values, n_points)
+    else:
+        keep = minmax_indices(values, n_points//2)
+    
+    return rows[keep], values[keep]
+
+
+def step_series(series):
+    
+    '''Rows and values of the first column of a per-minute output of the 
+    backtest, which can be ChangePoints or an array with the row in column 0 
+    (like balance_ext). For ChangePoints only the change points are used, 
+    which is enough to plot it as a step function'''
+    
+    if isinstance(series, ChangePoints):
+        rows, values = series.points()
+        return rows, values[:,0]
+    
+    return series[:,0].astype('int64'), series[:,1]
+
+
+def plot_backtest(price_data, balance_ext, sigs_w_close=None, positions=None, top_drawdowns=1, 
+                  n_points=2000, method='minmax', time_index=None):
+    
+    '''
+    Plots the account balance and the (normalized) close price over time, 
+    the signal opens (o) and closes (x) and the largest drawdowns, plus the 
+    long/short/net/total leverage in a second subplot if positions is given. 
+    
+    balance_ext and positions can be the usual per-minute arrays or the 
+    ChangePoints from calc_profit_simple(..., compressed=True). Either way 
+    the lines are decimated to about n_points points each (see 
+    decimate_series) and the times are converted to datetime64 in one go, so 
+    how long the plot takes to draw doesn't depend on the length of the 
+    range. time_index (see TimeIndex) is optional and only saves reading 
+    the times from price_data. Returns the figure. 
+    '''
+    
+    import matplotlib.pyplot as plt
+    
+    def to_dates(rows):
+        rows = np.asarray(rows).astype('int64')
+        if time_index is not None:
+            return time_index.datetimes(rows)
+        return to_datetime64(price_data[rows,0])
+    
+    balance_rows, balance = step_series(balance_ext)
+    
+    first_row, last_row = int(balance_rows[0]), int(balance_rows[-1])
+    if isinstance(balance_ext, ChangePoints):
+        last_row = balance_ext.stop - 1
+    
+    step = 'steps-post' if isinstance(balance_ext, ChangePoints) else 'default'
+    
+    n_plots = 2 if positions is not None else 1
+    
+    fig, axes = plt.subplots(n_plots, 1, figsize=(24,12*n_plots), sharex=True, squeeze=False)
+    ax = axes[0,0]
+    
+    # price data, normalized to the start of the range
+    price_rows = np.arange(first_row, last_row+1)
+    closes = price_data[first_row:last_row+1,3]
+    
+    rows, values = decimate_series(price_rows, closes/closes[0], n_points, method)
+    ax.plot(to_dates(rows), values, color=(12/255, 87/255, 168/255))
+    
+    # account balance, ending at the end of the range
+    rows, values = decimate_series(np.append(balance_rows, last_row), np.append(balance, balance[-1]), n_points, method)
+    ax.plot(to_dates(rows), values, color=(7/255, 172/255, 242/255), drawstyle=step)
+    
+    # signal opens and closes
+    if sigs_w_close is not None:
+        for side, color in [(1, (8/255, 196/255, 27/255)), (-1, (1, 0, 0))]:
+            sigs = sigs_w_close[sigs_w_close[:,1]==side]
+            if len(sigs) > 0:
+                for col, marker in [(0, 'o'), (2, 'x')]:
+                    rows = sigs[:,col].astype('int64')
+                    ax.plot(to_dates(rows), price_data[rows,3]/closes[0], marker, color=color)
+    
+    # largest drawdowns
+    drawdowns = calc_drawdowns(balance_ext)
+    
+    if len(drawdowns) > 0 and top_drawdowns > 0:
+        
+        lines = []
+        labels = []
+        
+        for rank, k in enumerate(drawdowns.top(top_drawdowns)):
             
-            sub_positions[update_ind:,2] = sub_positions[update_ind:,0] + sub_positions[update_ind:,1]
-            sub_positions[update_ind:,3] = sub_positions[update_ind:,0] - sub_positions[update_ind:,1]
+            marks = np.array([drawdowns.peak_index[k], drawdowns.trough_index[k]]).astype('int64')
             
-            # if total leverage gets too high at any point, throw out the result
-            if sub_positions[update_ind,3]/sub_balance_ext[update_ind,1]>95:
-                print('Leverage too high')
-                total_profits=0
-                total_profits_aft_tax=0
-                break
+            if isinstance(balance_ext, ChangePoints):
+                marked_balance = balance_ext.at(marks)[:,0]
+            else:
+                marked_balance = balance[[drawdowns.peaks[k], drawdowns.troughs[k]]]
             
-            # if balance gets too low, give up and stop
-            if sub_balance_ext[update_ind,1] < 0.0001:
-                print('Account drained')
-                total_profits=0
-                total_profits_aft_tax=0
-                break
+            lines += ax.plot(to_dates(marks), marked_balance, 'o', color=(12/255, 87/255, 168/255), alpha=1 if rank == 0 else 0.5)
+            labels.append(('max drawdown = ' if rank == 0 else 'drawdown = ') + str(round(drawdowns.depths[k]*1000)/10) + '%')
+        
+        ax.legend(lines, labels)
+    
+    ax.set_yscale('log')
+    
+    # leverage over time
+    if positions is not None:
+        
+        ax = axes[1,0]
+        
+        if isinstance(positions, ChangePoints):
+            lev_rows, position_values = positions.points()
+            lev_balance = balance_ext.at(lev_rows)[:,0]
+        else:
+            lev_rows = balance_rows
+            position_values = positions
+            lev_balance = balance
+        
+        for col, label in enumerate(['long leverage', 'short leverage', 'net leverage', 'total leverage']):
+            rows, values = decimate_series(lev_rows, position_values[:,col]/lev_balance, n_points, method)
+            ax.plot(to_dates(rows), values, label=label, drawstyle=step)
+        
+        ax.legend()
+    
+    return fig
+
+
+
+#----------------- Functions for walk-forward optimization -------------------
+
+
+
+def walk_forward_windows(start, end, train_length, test_length, step=None, anchored=False):
+    
+    '''Schedule for walk-forward optimization over rows start to end-1 of the 
+    candle data. Each window is optimized on train_length rows and tested on 
+    the test_length rows right after them, and every window is moved step 
+    rows (test_length by default, so the test windows follow each other 
+    without gaps) from the one before. With anchored=True the training 
+    windows all start at start and only grow. Returns a list of 
+    (train_start, train_end, test_start, test_end)'''
+    
+    step = test_length if step is None else step
+    
+    windows = []
+    
+    train_start = start
+    
+    while train_start + train_length + test_length <= end:
+        train_end = train_start + train_length
+        windows.append((start if anchored else train_start, train_end, train_end, train_end + test_length))
+        train_start += step
+    
+    return windows
+
+
+def signals_in_range(signals, range_start, range_end):
+    '''The signals (sorted by index) with index in [range_start, range_end)'''
+    first, last = np.searchsorted(signals[:,0], [range_start, range_end])
+    return signals[first:last]
+
+
+def has_trades(signals):
+    '''True if a set of signals opens and closes at least one position (i.e. 
+    has a signal in each direction), which prepare_signals needs'''
+    return len(signals) > 1 and bool(np.any(signals[1:,1] != signals[:-1,1]))
+
+
+class WalkForwardResult:
+    
+    '''
+    Results of walk_forward, with one entry per window in each array: 
+    params is the best (lev, lev_limit) found on the training window (nan if 
+    it had no trades), train_profits the profit after tax it got there, and 
+    test_profits / test_profits_aft_tax what the same parameters made on 
+    the test window. equity is the out-of-sample balance over all the test 
+    windows together (as ChangePoints), with each window starting from the 
+    balance the previous one ended with. A test window that ends with 
+    nothing left (it failed the profits check in calc_profit_simple, or the 
+    account was wiped out) is counted as flat in equity and total_profits, 
+    instead of taking every window after it down to 0 as well, so its own 
+    entries in test_profits are the only place it shows up.
+    '''
+    
+    def __init__(self, windows, params, train_profits, test_profits, test_profits_aft_tax, equity):
+        self.windows = windows
+        self.params = params
+        self.train_profits = train_profits
+        self.test_profits = test_profits
+        self.test_profits_aft_tax = test_profits_aft_tax
+        self.equity = equity
+    
+    
+    def total_profits(self):
+        '''Compounded out-of-sample profit over all test windows, before and 
+        after tax, with failed windows counted as flat (see stitch_equity)'''
+        return np.prod(np.where(self.test_profits > 0, self.test_profits, 1)), np.prod(np.where(self.test_profits_aft_tax > 0, self.test_profits_aft_tax, 1))
+
+
+def stitch_equity(pieces, start, stop):
+    
+    '''Chains the balance change points of consecutive test windows (a list 
+    of (cp_index, balance) pairs, each starting from a balance of 1) into 
+    one equity curve, scaling each window by the balance the previous ones 
+    ended with. A window that ends at a balance of 0 or less failed (see 
+    WalkForwardResult), so it's shown as flat at the current balance and 
+    the next window carries on from there'''
+    
+    indices = []
+    balances = []
+    
+    scale = 1.0
+    
+    for cp_index, balance in pieces:
+        if len(balance) > 0:
+            indices.append(cp_index)
+            if balance[-1] > 0:
+                balances.append(balance*scale)
+                scale *= balance[-1]
+            else:
+                balances.append(np.full(len(balance), scale))
+    
+    cp_index = np.concatenate(indices) if len(indices) > 0 else np.zeros(0, dtype='int64')
+    balance = np.concatenate(balances) if len(balances) > 0 else np.zeros(0)
+    
+    return ChangePoints(cp_index, balance.reshape(-1,1), [1], start, stop)
+
+
+# state of each worker process of walk_forward, set up by init_walk_forward_worker
+walk_forward_state = {}
+
+
+def init_walk_forward_worker(filenames, keys, store=None, de_settings=None):
+    
+    '''Runs once in every worker process of walk_forward. Attaches to the 
+    shared price data, range index and the prepared signals of every window 
+    (see init_profit_worker)'''
+    
+    arrays = attach_arrays(filenames)
+    
+    price_data = load_candle_store(*store) if store is not None else arrays['price_data']
+    
+    walk_forward_state['price_data'] = price_data
+    walk_forward_state['de_settings'] = de_settings if de_settings is not None else {}
+    
+    if 'range_offsets' in arrays:
+        walk_forward_state['range_index'] = PriceRangeIndex.from_flat_levels(price_data[:,1], price_data[:,2], arrays['range_offsets'], arrays['range_mins'], arrays['range_maxs'])
+    else:
+        walk_forward_state['range_index'] = None
+    
+    walk_forward_state['prepared'] = {}
+    
+    for name in keys:
+        walk_forward_state['prepared'][name] = PreparedSignals(arrays[name + '_sigs_w_close'], arrays[name + '_events'], arrays[name + '_TP_pct'], keys[name])
+
+
+def walk_forward_worker(task):
+    
+    '''Optimizes one window on its training signals with differential 
+    evolution (a whole generation per calc_profit_batch call), then runs the 
+    best parameters on its test signals. Returns the window number, the best 
+    parameters, their training profit, the test profits and the test 
+    balance change points'''
+    
+    from scipy.optimize import differential_evolution
+    
+    k, bounds = task
+    
+    price_data = walk_forward_state['price_data']
+    range_index = walk_forward_state['range_index']
+    prepared = walk_forward_state['prepared']
+    
+    train = prepared.get('train' + str(k))
+    test = prepared.get('test' + str(k))
+    
+    if train is None:
+        return k, np.full(2, np.nan), 1.0, 1.0, 1.0, np.zeros(0, dtype='int64'), np.zeros(0)
+    
+    def objective(x):
+        total_profits, total_profits_aft_tax = calc_profit_batch(train, price_data, np.reshape(x.T, (-1,2)), range_index=range_index)
+        return -total_profits_aft_tax
+    
+    settings = {'popsize': 20, 'seed': k}
+    settings.update(walk_forward_state['de_settings'])
+    
+    fit_coeffs = differential_evolution(objective, bounds, vectorized=True, updating='deferred', **settings)
+    
+    if test is None:
+        return k, fit_coeffs.x, -fit_coeffs.fun, 1.0, 1.0, np.zeros(0, dtype='int64'), np.zeros(0)
+    
+    profits, total_profits, sigs_w_close, balance_ext, positions, gains, losses, total_profits_aft_tax = calc_profit_simple(test, price_data, fit_coeffs.x[0], fit_coeffs.x[1], compressed=True, range_index=range_index)
+    
+    if isinstance(balance_ext, ChangePoints):
+        cp_index, balance = balance_ext.index, balance_ext.values[:,0]
+    else:
+        # losing trades alone wipe out the account, see calc_profit_simple
+        cp_index, balance = np.array([int(test.sigs_w_close[0,0])]), np.array([float(total_profits)])
+    
+    return k, fit_coeffs.x, -fit_coeffs.fun, total_profits, total_profits_aft_tax, cp_index, balance
+
+
+def walk_forward(signals, price_data, windows, bounds, range_index=None, num_cores=None, folder=None, cache_dir=None, **de_settings):
+    
+    '''
+    Walk-forward optimization: for each window of walk_forward_windows, 
+    finds the best (lev, lev_limit) within bounds on the training rows and 
+    tests it on the test rows that follow, and stitches the out-of-sample 
+    balances together. Returns a WalkForwardResult. 
+    
+    The windows are independent, so they're spread over num_cores worker 
+    processes (all cores by default, 1 runs everything in this process). 
+    The signal sets of all windows are prepared once here (and cached in 
+    cache_dir, see prepare_signals), and the price data, range index and 
+    prepared signals are shared with the workers through memory-mapped 
+    files the same way as in ParallelProfitFitter, so every worker uses the 
+    same copy. de_settings are passed on to differential_evolution. 
+    '''
+    
+    num_cores = num_cores if num_cores is not None else os.cpu_count()
+    
+    signals = np.asarray(signals)
+    
+    arrays = {}
+    keys = {}
+    
+    for k, (train_start, train_end, test_start, test_end) in enumerate(windows):
+        for name, range_start, range_end in [('train', train_start, train_end), ('test', test_start, test_end)]:
             
-            # check for liquidations between current event and next event
-            if i<len(sub_events)-1 and sub_events[i,0] != sub_events[i+1,0]:
-                
-                if sub_positions[update_ind,2]>sub_balance_ext[update_ind,1]: #long positions with leverage below 1 can't be liquidated
-                    
-                    liq_price = sub_positions[update_ind,4]*(1 - (sub_balance_ext[update_ind,1]/sub_positions[update_ind,2]))
-                    
-                    if sum(sub_price_data[sub_events[i,0]-j*chunk:sub_events[i+1,0]-j*chunk,1]<=liq_price)>0:
-                        total_profits=0
-                        total_profits_aft_tax=0
-                        print('Long position liquidated')
-                        break
-                    
-                    
-                elif sub_positions[update_ind,2]<0: #short positions with leverage below 1 CAN be liquidated
-                    
-                    liq_price = sub_positions[update_ind,5]*(1 - (sub_balance_ext[update_ind,1]/sub_positions[update_ind,2]))
-                    
-                    if sum(sub_price_data[sub_events[i,0]-j*chunk:sub_events[i+1,0]-j*chunk,2]>=liq_price)>0:
-                        total_profits=0
-                        total_profits_aft_tax=0
-                        print('Short position liquidated')
-                        break
-                    
+            subset = signals_in_range(signals, range_start, range_end)
             
-        if total_profits == 0: #break out of the second for loop if any of the inner breaks get triggered (since they always set total_profits=0)
-            break
+            if has_trades(subset):
+                prepared = prepare_signals(subset, price_data, cache_dir)
+                arrays[name + str(k) + '_sigs_w_close'] = prepared.sigs_w_close
+                arrays[name + str(k) + '_events'] = prepared.events
+                arrays[name + str(k) + '_TP_pct'] = prepared.TP_pct
+                keys[name + str(k)] = prepared.key
+    
+    if isinstance(price_data, CandleData) and price_data.folder is not None:
+        store = (price_data.folder, price_data.columns, price_data.start, price_data.start + len(price_data))
+    else:
+        store = None
+        arrays['price_data'] = price_data
+    
+    if range_index is not None:
+        arrays['range_offsets'], arrays['range_mins'], arrays['range_maxs'] = range_index.flat_levels()
+    
+    own_folder = folder is None
+    folder = tempfile.mkdtemp(prefix='shared_data_') if folder is None else folder
+    
+    try:
+        
+        filenames = share_arrays(arrays, folder)
+        
+        tasks = [(k, bounds) for k in range(len(windows))]
+        
+        if num_cores > 1:
+            with multiprocessing.Pool(min(num_cores, len(tasks)), initializer=init_walk_forward_worker, initargs=(filenames, keys, store, de_settings)) as pool:
+                results = pool.map(walk_forward_worker, tasks, chunksize=1)
+        else:
+            init_walk_forward_worker(filenames, keys, store, de_settings)
+            results = [walk_forward_worker(task) for task in tasks]
+    
+    finally:
+        walk_forward_state.clear()
+        if own_folder:
+            shutil.rmtree(folder, ignore_errors=True)
+    
+    results = sorted(results, key=lambda result: result[0])
+    
+    params = np.array([result[1] for result in results]).reshape(-1,2)
+    train_profits = np.array([result[2] for result in results])
+    test_profits = np.array([result[3] for result in results])
+    test_profits_aft_tax = np.array([result[4] for result in results])
+    
+    equity = stitch_equity([(result[5], result[6]) for result in results], windows[0][2], windows[-1][3])
+    
+    return WalkForwardResult(windows, params, train_profits, test_profits, test_profits_aft_tax, equity)
+
+
+
+#------------- Functions for benchmarking with synthetic data ----------------
+
+
+
+def synthetic_candles(n, imp_step=60, seed=0, gap_rate=0.0005, outage_rate=0.00002, start_time=1420070400):
+    
+    '''
+    Makes n candles of fake but realistic-looking price data, in the same 
+    format dl_historical_data gives (time, low, high, open, close, volume, 
+    latest candle first), so it can be run through the whole pipeline. The 
+    same seed always gives the same data.
+    
+    The close is a random walk with changing volatility. About gap_rate of 
+    the candles are missing (in runs of 1 to 10), like quiet minutes on 
+    Coinbase, and about outage_rate of the candles start an outage of a few 
+    hours where the candles are missing too, so clean_historical_data turns 
+    them into long flat sections. Returns the candles with the missing ones 
+    left out, so there are fewer than n.
+    '''
+    
+    rng = np.random.default_rng(seed)
+    
+    # volatility that drifts slowly between calm and busy periods
+    volatility = 0.0008*np.exp(np.cumsum(rng.normal(0, 0.002, n)).clip(-1.5, 1.5))
+    
+    close = 300*np.exp(np.cumsum(rng.normal(0, 1, n)*volatility))
+    open_ = np.concatenate(([close[0]], close[:-1]))
+    
+    low = np.minimum(open_, close)*(1 - np.abs(rng.normal(0, 1, n))*volatility/2)
+    high = np.maximum(open_, close)*(1 + np.abs(rng.normal(0, 1, n))*volatility/2)
+    
+    volume = rng.gamma(2, 5, n)
+    
+    times = start_time + imp_step*np.arange(n, dtype='float64')
+    
+    data = np.column_stack((times, low, high, open_, close, volume))
+    
+    # missing candles: short gaps and long outages, marked with a difference 
+    # array so no loop over the candles is needed
+    missing = np.zeros(n+1, dtype='int64')
+    
+    for rate, min_length, max_length in [(gap_rate, 1, 11), (outage_rate, 60, 600)]:
+        starts = np.nonzero(rng.random(n) < rate)[0]
+        ends = np.minimum(starts + rng.integers(min_length, max_length, len(starts)), n)
+        np.add.at(missing, starts, 1)
+        np.add.at(missing, ends, -1)
+    
+    keep = np.cumsum(missing[:-1]) == 0
+    
+    # the first and last candles are always there, so the time range is n candles
+    keep[[0, -1]] = True
+    
+    return np.flipud(data[keep])
+
+
+def synthetic_signals(n, seed=0, dense_fraction=0.2, dense_rate=0.05, sparse_rate=0.0005, regime_length=50000):
+    
+    '''
+    Makes a deterministic set of signals (index, type) for n candles, for 
+    benchmarking the backtests. The candles are split into regimes of about 
+    regime_length candles, dense_fraction of which have a signal on about 
+    dense_rate of the candles and the rest on about sparse_rate of them, so 
+    both busy and quiet stretches are covered. The signals come in runs of 
+    the same type, like real signal generators tend to give.
+    '''
+    
+    rng = np.random.default_rng(seed + 1)
+    
+    n_regimes = int(np.ceil(n/regime_length))
+    
+    dense = rng.random(n_regimes) < dense_fraction
+    rates = np.repeat(np.where(dense, dense_rate, sparse_rate), regime_length)[:n]
+    
+    # no signal on the last candle, since a position can't be closed after it
+    indices = np.nonzero(rng.random(n-1) < rates[:-1])[0]
+    
+    # the type flips with a probability of 1/3 at each signal
+    flips = rng.random(len(indices)) < 1/3
+    types = np.where(np.cumsum(flips) % 2 == 0, 1, -1)
+    
+    signals = np.zeros((len(indices), 2))
+    signals[:,0] = indices
+    signals[:,1] = types
+    
+    return signals
+
+
+def run_benchmark_stage(stage, n_candles, func, repeats=1, measure_memory=True):
+    
+    '''Times func() (the best of repeats runs) and, if measure_memory is 
+    True, runs it once more with tracemalloc to get the peak memory it 
+    allocates (numpy arrays included). The timed runs are done without 
+    tracemalloc since it slows everything down. Returns a dict that can be 
+    saved as JSON, plus the result of the last run of func'''
+    
+    import tracemalloc
+    
+    times = []
+    
+    for k in range(repeats):
+        start = time.perf_counter()
+        result = func()
+        times.append(time.perf_counter() - start)
+    
+    record = {'stage': stage, 'n_candles': int(n_candles), 'seconds': min(times), 'repeats': repeats}
+    
+    if measure_memory:
+        result = None
+        tracemalloc.start()
+        try:
+            result = func()
+            record['peak_memory_mb'] = tracemalloc.get_traced_memory()[1]/2**20
+        finally:
+            tracemalloc.stop()
+    
+    return record, result
+
+
+def benchmark_run_info():
+    
+    '''Describes the code and machine a benchmark ran on, so results from 
+    different versions can be told apart'''
+    
+    import platform
+    import subprocess
+    
+    try:
+        version = subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], capture_output=True, text=True, 
+                                 cwd=os.path.dirname(os.path.abspath(__file__))).stdout.strip() or None
+    except OSError:
+        version = None
+    
+    return {'version': version, 
+            'date': datetime.now().isoformat(timespec='seconds'), 
+            'python': platform.python_version(), 
+            'numpy': np.__version__, 
+            'platform': platform.platform(), 
+            'cpu_count': os.cpu_count()}
+
+
+def compare_benchmarks(old_run, new_run):
+    
+    '''Lines comparing the stages two benchmark runs have in common: the 
+    time and peak memory of each, and how many times faster the new run is'''
+    
+    old_results = {(r['stage'], r['n_candles']): r for r in old_run['results']}
+    
+    lines = []
+    
+    for r in new_run['results']:
         
-        balance_ext[np.logical_and(balance_ext[:,0]>=j*chunk, balance_ext[:,0]<(j+1)*chunk),:] = sub_balance_ext
-        positions[np.logical_and(balance_ext[:,0]>=j*chunk, balance_ext[:,0]<(j+1)*chunk),:] = sub_positions
+        old = old_results.get((r['stage'], r['n_candles']))
         
-        balance_ext[balance_ext[:,0]>=(j+1)*chunk,1] = sub_balance_ext[-1,1]
-        positions[balance_ext[:,0]>=(j+1)*chunk,:] = sub_positions[-1,:]
+        if old is None:
+            continue
         
-        offset+=chunk
-    
-    # Sum up all events that generate gains and all events that generate losses. This is necessary to calculate profits after tax
-    balance_changes = np.ones((len(balance_ext),1))
-    balance_changes[0,0] = balance_ext[0,1]-1
-    balance_changes[1:,0] = balance_ext[1:,1]-balance_ext[:-1,1]
+        line = r['stage'] + ' (' + str(r['n_candles']) + '): ' + str(round(old['seconds'], 4)) + ' s -> ' + str(round(r['seconds'], 4)) + ' s, ' 
+        line += str(round(old['seconds']/max(r['seconds'], 1e-9), 2)) + 'x'
+        
+        if 'peak_memory_mb' in old and 'peak_memory_mb' in r:
+            line += ', peak memory ' + str(round(old['peak_memory_mb'], 1)) + ' MB -> ' + str(round(r['peak_memory_mb'], 1)) + ' MB'
+        
+        lines.append(line)
     
-    gains = sum(balance_changes[balance_changes>0])
-    losses = sum(balance_changes[balance_changes<0])
+    return lines
+
+
+
+#------------ Functions for backtesting several trading pairs at once --------
+
+
+
+def backtest_pair(pair):
     
-    #Calculate profits before and after tax. Because of the way Swedish taxes 
-    #work, one may only subtract 70% of ones losses from one's gains before 
-    #calculating tax. This means, e.g., that one could "break even," but still 
-    #end up owing tax. This is why it's incredibly important to use profits 
-    #AFTER tax as a metric to judge trading algorithms
-    total_profits = 1 + gains + losses
-    total_profits_aft_tax = 1 + 0.7*gains + 0.79*losses 
+    '''
+    Backtests one trading pair, for backtest_pairs. pair is a dict with:
         
-    return total_profits, sigs_w_close, balance_ext, positions, gains, losses, total_profits_aft_tax, skipped_signals
+        name: e.g. 'BTC-USD' 
+        store: candle store folder of the pair 
+        signals: SignalStore folder with the signals for that store 
+        lev, lev_limit: parameters for calc_profit_simple 
+        start, end: optional range to test, as rows of the store (ints) or 
+            as dates or timestamps (anything else to_timestamp accepts)
+    
+    The candles are memory-mapped from the store and only the signals in 
+    the range are loaded, so nothing but the change points of the balance 
+    is ever sent back. Returns the name, the total profits before and after 
+    tax, and the times and balances of the balance change points.
+    '''
+    
+    data_comp = load_candle_store(pair['store'], columns=('time', 'low', 'high', 'close'))
+    range_index = load_price_range_index(pair['store'], data_comp)
+    
+    start = pair.get('start', 0)
+    end = pair.get('end', len(data_comp))
+    
+    # anything other than a row number is a date or timestamp
+    if not isinstance(start, (int, np.integer)) or not isinstance(end, (int, np.integer)):
+        time_index = load_time_index(data_comp, pair['store'])
+        if not isinstance(start, (int, np.integer)):
+            start = time_index.rows_between(start, start)[0]
+        if not isinstance(end, (int, np.integer)):
+            end = time_index.rows_between(end, end)[0]
+    
+    end = min(end, len(data_comp))
+    
+    signals = SignalStore(pair['signals']).load(start, end)
+    
+    if not has_trades(signals):
+        return pair['name'], 1.0, 1.0, np.zeros(0), np.zeros(0)
+    
+    profits, total_profits, sigs_w_close, balance_ext, positions, gains, losses, total_profits_aft_tax = calc_profit_simple(signals, data_comp, pair['lev'], pair['lev_limit'], compressed=True, range_index=range_index)
+    
+    if isinstance(balance_ext, ChangePoints):
+        rows, balance = balance_ext.points()
+        balance = balance[:,0]
+    else:
+        # losing trades alone wipe out the account, see calc_profit_simple
+        rows, balance = np.array([int(sigs_w_close[0,0])]), np.array([float(total_profits)])
+    
+    return pair['name'], float(total_profits), float(total_profits_aft_tax), np.asarray(data_comp[rows,0]), balance
 
 
-def calc_profit_simple(signals, price_data, lev, lev_limit): 
+class PortfolioResult:
+    
+    '''
+    Results of backtest_pairs. names, total_profits and 
+    total_profits_aft_tax have one entry per pair. times are the unix 
+    timestamps of every change point of any of the pairs, balances has the 
+    balance of each pair (one column per pair, each starting at 1) at each of 
+    those times, and equity is the balance of the whole portfolio, with 
+    weights[k] of the starting capital put into pair k.
     '''
-    This is a simple example trading algorithm. In reality, the ones I end up 
-    using are considerably more complicated (use stop losses, take profits, 
-    moving stop losses, hedging, etc).
     
-    Calculates profit very simply. At a buy trigger, either adds 'lev' leverage 
-    to an open long position, or closes an open short position and opens a 'lev' 
-    long position. Vice versa for a sell trigger. No hedging, i.e., long and 
-    short positions are never open at the same time. 
+    def __init__(self, names, total_profits, total_profits_aft_tax, times, balances, weights):
+        self.names = names
+        self.total_profits = total_profits
+        self.total_profits_aft_tax = total_profits_aft_tax
+        self.times = times
+        self.balances = balances
+        self.weights = weights
+        self.equity = balances @ weights
+    
+    
+    def drawdowns(self):
+        '''Drawdowns of the portfolio equity (see calc_drawdowns), with times as the index'''
+        return calc_drawdowns(self.equity, index=self.times)
+    
+    
+    def portfolio_profits(self):
+        '''Profit of the whole portfolio before and after tax'''
+        return float(self.weights @ self.total_profits), float(self.weights @ self.total_profits_aft_tax)
 
-    Parameters
-    ----------
-    signals : numpy array
-        column 0: index in the price_data where the trigger occurs
-        column 1: trigger type. 1 is a buy trigger and -1 is a sell trigger
-    price_data : numpy array
-        column 0: time
-        column 1: low price
-        column 2: high price
-        column 3: close price
-    lev : float
-        amount of leverage to add per trigger. 1 = 1x
+
+def combine_pair_balances(times, balances):
     
-    -------
-    None.
+    '''Lines up the balance change points of several pairs (lists of arrays 
+    of times and balances, one per pair) on the union of all their times. 
+    Returns the times and an array with the balance of each pair at each of 
+    them (1 before a pair's first change point)'''
+    
+    all_times = np.unique(np.concatenate(times)) if len(times) > 0 else np.zeros(0)
+    
+    combined = np.ones((len(all_times), len(times)))
+    
+    for k in range(len(times)):
+        if len(times[k]) > 0:
+            last = np.searchsorted(times[k], all_times, side='right') - 1
+            combined[:,k] = np.where(last >= 0, balances[k][np.maximum(last, 0)], 1.0)
+    
+    return all_times, combined
 
+
+def backtest_pairs(pairs, weights=None, num_cores=None):
+    
     '''
+    Backtests several trading pairs at once (see backtest_pair for what 
+    each pair needs) and combines them into one portfolio. The pairs are 
+    spread over a pool of num_cores worker processes (all cores by default, 
+    1 runs everything in this process). Every worker memory-maps the candle 
+    stores, signal stores and range index caches straight from disk, so a 
+    store is read into memory once by the OS no matter how many processes 
+    use it, and the only things sent between processes are the pair 
+    settings and the balance change points.
     
-    # can set average slippage manually (as a percentage)
-    slippage = 0.00
+    weights is the share of the starting capital put into each pair (equal 
+    shares by default). Returns a PortfolioResult.
+    '''
     
+    num_cores = num_cores if num_cores is not None else os.cpu_count()
     
-    # convert signals to int to use the first column as indices
-    signals = signals.astype(int)
+    if num_cores > 1 and len(pairs) > 1:
+        with multiprocessing.Pool(min(num_cores, len(pairs))) as pool:
+            results = pool.map(backtest_pair, pairs, chunksize=1)
+    else:
+        results = [backtest_pair(pair) for pair in pairs]
     
-    sig_flips = np.nonzero(signals[1:,1]-signals[:-1,1])[0]+1
+    names = [result[0] for result in results]
+    total_profits = np.array([result[1] for result in results])
+    total_profits_aft_tax = np.array([result[2] for result in results])
+    
+    times, balances = combine_pair_balances([result[3] for result in results], [result[4] for result in results])
+    
+    weights = np.full(len(pairs), 1/len(pairs)) if weights is None else np.asarray(weights, dtype='float64')
+    
+    return PortfolioResult(names, total_profits, total_profits_aft_tax, times, balances, weights)
+
+
+
+#------------ Functions for optimizing with successive halving ---------------
+
+
+
+def latin_hypercube(bounds, n, rng=None):
     
-    pos_flips = signals[sig_flips[0],0]*np.ones((len(signals)))
-    for j in range(1,len(sig_flips)):
-        pos_flips[sig_flips[j-1]:sig_flips[j]] = signals[sig_flips[j],0]
+    '''n parameter vectors spread over bounds (a list of (min, max) pairs), 
+    with one vector in each of n equal slices of the range of every 
+    parameter'''
     
-    # pos_flips[sig_flips[j]:] = len(price_data)-1
-    pos_flips = pos_flips.astype(int)
+    rng = np.random.default_rng(rng)
     
-    pos_flips = pos_flips[:sig_flips[j]]
-    signals = signals[:sig_flips[j]]
+    bounds = np.asarray(bounds, dtype='float64')
     
+    slices = rng.permuted(np.tile(np.arange(n), (len(bounds),1)), axis=1).T
     
-    # new array, same as signals, plus an extra column listing when each 
-    # position is closed
-    sigs_w_close = np.zeros((len(signals),4),dtype='float64')
-    sigs_w_close[:,0] = signals[:,0]
-    sigs_w_close[:,1] = signals[:,1]
+    return bounds[:,0] + (slices + rng.random((n, len(bounds))))/n*(bounds[:,1] - bounds[:,0])
+
+
+class SuccessiveHalvingResult:
+    
+    '''
+    Result of successive_halving. x is the best parameter vector and fun its 
+    negative profit after tax over the full range, like the result of 
+    differential_evolution. rungs has (stop, number of candidates run up to 
+    stop) for every rung. candles_backtested is the number of candles 
+    backtested over all candidates, and candles_full the number it would 
+    have been if every candidate was backtested over the full range.
+    '''
     
-    profits = np.ones((len(signals),1))
+    def __init__(self, x, fun, rungs, candles_backtested, candles_full):
+        self.x = x
+        self.fun = fun
+        self.rungs = rungs
+        self.candles_backtested = candles_backtested
+        self.candles_full = candles_full
+
+
+def successive_halving(signals, price_data, bounds, n_candidates=243, eta=3, min_fraction=1/27, range_index=None, seed=None, disp=False):
+    
+    '''
+    Optimizes (lev, lev_limit) within bounds by successive halving. 
+    n_candidates parameter vectors are spread over bounds (see 
+    latin_hypercube) and backtested together over the first part of the 
+    signals. Only the best 1/eta of them (by profit after tax so far) are 
+    carried on over a part eta times as long, and so on, until the last 
+    ones left are backtested over the full range. The shortest part is 
+    min_fraction of the full range (but no shorter than needed to get down 
+    to one candidate).
+    
+    The candidates are carried on from where they stopped (see 
+    BatchBacktest) instead of starting over, so each candle is only 
+    backtested once for every candidate that gets that far. With the 
+    defaults, that's 9 times fewer candles than backtesting all 243 
+    candidates over the full range, while the final 9 are still compared 
+    over all of it. Returns a SuccessiveHalvingResult
+    '''
+    
+    candidates = latin_hypercube(bounds, n_candidates, seed)
+    
+    backtest = BatchBacktest(signals, price_data, candidates, range_index)
+    
+    start, end = backtest.first_index, backtest.end_index
+    
+    n_rungs = int(np.floor(np.log(n_candidates)/np.log(eta) + 1e-9)) + 1
+    if min_fraction is not None:
+        n_rungs = min(n_rungs, int(np.floor(np.log(1/min_fraction)/np.log(eta) + 1e-9)) + 1)
+    
+    rungs = []
+    candles_backtested = 0
+    prev_stop = start
+    
+    for r in range(n_rungs):
+        
+        stop = end if r == n_rungs-1 else start + int((end - start)*float(eta)**(r - n_rungs + 1))
+        
+        n_running = len(backtest.state)
+        
+        total_profits, total_profits_aft_tax = backtest.run(stop)
+        
+        candles_backtested += n_running*(stop - prev_stop)
+        prev_stop = stop
+        rungs.append((stop, len(backtest)))
+        
+        best = np.argmax(total_profits_aft_tax)
+        
+        if disp:
+            print('rung ' + str(r) + ': ' + str(len(backtest)) + ' candidates up to index ' + str(stop) + ', best profit AT: ' + str(round(total_profits_aft_tax[best], 4)))
+        
+        if instrumentation.enabled: # see Instrumentation
+            instrumentation.record('successive_halving_rung', rung=r, stop=stop, n_candidates=len(backtest), best_profit_aft_tax=float(total_profits_aft_tax[best]))
+        
+        if r < n_rungs-1:
+            n_keep = max(1, int(np.ceil(len(backtest)/eta)))
+            backtest.select(np.sort(np.argsort(-total_profits_aft_tax, kind='stable')[:n_keep]))
+    
+    return SuccessiveHalvingResult(backtest.params[best], -total_profits_aft_tax[best], rungs, candles_backtested, n_candidates*(end - start))
+
+
+
+#----------- Functions for caching and checkpointing the optimizer ------------
+
+
+
+def objective_context(signals, price_data, name=''):
+    
+    '''Content hash of everything a backtest objective depends on besides 
+    its parameters: the signal set (see signal_set_key), the lows and highs 
+    over the range the backtest covers (used for the liquidation checks) 
+    and name, which should tell apart objectives that score the same 
+    backtest differently'''
+    
+    prepared = prepare_signals(signals, price_data)
+    
+    first = int(prepared.events[0,0])
+    last = int(prepared.events[-1,0])
+    
+    key = hashlib.sha1()
+    key.update(name.encode())
+    key.update(prepared.key.encode())
+    key.update(np.ascontiguousarray(price_data[first:last+1,1], dtype='float64').tobytes())
+    key.update(np.ascontiguousarray(price_data[first:last+1,2], dtype='float64').tobytes())
+    
+    return key.hexdigest()
+
+
+class ObjectiveCache:
+    
+    '''
+    Memo of objective values by context (see objective_context) and 
+    quantized parameters (a tuple of ints, see CachedObjective). The most 
+    recently used max_size values are kept in memory, and if filename is 
+    given, every value is also stored in an SQLite database there, so later 
+    runs (or a run restarted after a crash) can reuse them. Values are 
+    committed to the database as soon as they're added.
+    '''
+    
+    def __init__(self, filename=None, max_size=100000):
+        
+        self.max_size = max_size
+        self.memo = OrderedDict()
+        
+        self.db = None
+        if filename is not None:
+            self.db = sqlite3.connect(filename)
+            self.db.execute('CREATE TABLE IF NOT EXISTS objective (context TEXT, params TEXT, value REAL, PRIMARY KEY (context, params))')
+            self.db.commit()
+    
+    
+    def __len__(self):
+        return len(self.memo)
+    
+    
+    def _remember(self, memo_key, value):
+        self.memo[memo_key] = value
+        self.memo.move_to_end(memo_key)
+        # forget the least recently used values when the memo is full
+        while len(self.memo) > self.max_size:
+            self.memo.popitem(last=False)
+    
+    
+    def get(self, context, params):
+        
+        '''Value for params, or None if it was never stored'''
+        
+        memo_key = (context, params)
+        
+        if memo_key in self.memo:
+            self.memo.move_to_end(memo_key)
+            return self.memo[memo_key]
+        
+        if self.db is not None:
+            row = self.db.execute('SELECT value FROM objective WHERE context = ? AND params = ?', (context, ','.join(map(str, params)))).fetchone()
+            if row is not None:
+                self._remember(memo_key, row[0])
+                return row[0]
+        
+        return None
+    
+    
+    def put_many(self, context, params, values):
+        
+        for p, value in zip(params, values):
+            self._remember((context, p), float(value))
+        
+        if self.db is not None:
+            self.db.executemany('INSERT OR REPLACE INTO objective VALUES (?, ?, ?)', [(context, ','.join(map(str, p)), float(value)) for p, value in zip(params, values)])
+            self.db.commit()
+    
+    
+    def close(self):
+        if self.db is not None:
+            self.db.close()
+            self.db = None
+    
+    
+    def __enter__(self):
+        return self
+    
+    
+    def __exit__(self, *args):
+        self.close()
+
+
+class CachedObjective:
+    
+    '''
+    Wraps an objective for differential_evolution (such as 
+    profit_fitter_batch in optimize_trading_strat.py, or a 
+    ParallelProfitFitter) with an ObjectiveCache. Parameter vectors are 
+    snapped to multiples of quantum (one step size per parameter), and the 
+    objective is only called for snapped vectors that aren't in the cache, 
+    so near-duplicate vectors, and vectors evaluated by earlier runs, cost 
+    nothing. With vectorized=True, x has one parameter vector per column 
+    and all the ones missing from the cache are passed to the objective in 
+    one call. hits and misses count the vectors found and not found.
+    
+    The cache keys are multiples of quantum, so quantum is added to the 
+    context the values are stored under, and values cached with a different 
+    quantum are never used.
+    '''
+    
+    def __init__(self, objective, cache, context, quantum, vectorized=True):
+        self.objective = objective
+        self.cache = cache
+        self.quantum = np.asarray(quantum, dtype='float64')
+        self.context = context + ':' + hashlib.sha1(self.quantum.tobytes()).hexdigest()
+        self.vectorized = vectorized
+        self.hits = 0
+        self.misses = 0
     
-    for i in range(len(signals)):
-        current_price = price_data[signals[i,0],3]
+    
+    def snap(self, params):
+        '''params (one vector per row, or a single vector) snapped to multiples 
+        of quantum, which is where the objective is evaluated'''
+        return np.round(np.asarray(params, dtype='float64')/self.quantum)*self.quantum
+    
+    
+    def __call__(self, x):
+        
+        params = np.reshape(np.asarray(x, dtype='float64').T, (-1, len(self.quantum)))
         
-        if np.sign(signals[i,1])==1:
-            TP_pct = price_data[pos_flips[i],3]/current_price - 1
+        quantized = np.round(params/self.quantum).astype('int64')
+        keys = [tuple(int(q) for q in row) for row in quantized]
+        
+        values = [self.cache.get(self.context, key) for key in keys]
+        
+        # each missing vector is only evaluated once, even if it's in x several times
+        missing = list(OrderedDict.fromkeys(keys[k] for k in range(len(keys)) if values[k] is None))
+        
+        self.hits += len(keys) - sum(value is None for value in values)
+        self.misses += len(missing)
+        
+        if len(missing) > 0:
+            
+            snapped = np.array(missing, dtype='float64')*self.quantum
+            
+            if self.vectorized:
+                new_values = np.asarray(self.objective(snapped.T), dtype='float64')
+            else:
+                new_values = np.array([self.objective(p) for p in snapped], dtype='float64')
+            
+            self.cache.put_many(self.context, missing, new_values)
             
-        elif np.sign(signals[i,1])==-1:
-            TP_pct = 1 - price_data[pos_flips[i],3]/current_price
+            new_values = dict(zip(missing, new_values))
+            values = [new_values[keys[k]] if values[k] is None else values[k] for k in range(len(keys))]
         
-        profits[i] = 1 + (TP_pct*(1-0.00075*lev) - 0.0015 - slippage)*lev
-        sigs_w_close[i,2] = pos_flips[i]
-        sigs_w_close[i,3] = price_data[pos_flips[i],3]
+        values = np.array(values, dtype='float64')
+        
+        return values if self.vectorized else values[0]
+
+
+class DECheckpoint:
     
+    '''
+    Callback for differential_evolution that saves the population, the 
+    energies, the best vector so far and the generation to filename after 
+    every generation. load returns the saved state if it belongs to the same 
+    context (see objective_context), so a restarted run can carry on from it 
+    (see resumable_differential_evolution). The file is written to a 
+    temporary name first, so a crash while saving leaves the last one intact.
     
-    # put all opens and closes into a single list. 0: index in price_data when 
-    # it takes place, 1: indicates whether it's open long/short (+/-1) or 
-    # close long/short (+/-2), 2: row number in sigs_w_close where the event 
-    # came from
-    events = np.zeros((2*len(sigs_w_close),3))
+    If callback is given, it's called with intermediate_result after every 
+    save, and what it returns is passed back, so it can still stop the run.
+    '''
     
-    events[:len(sigs_w_close),:2] = sigs_w_close[:,:2]
-    events[:len(sigs_w_close),2] = range(len(sigs_w_close))
-    events[len(sigs_w_close):,0] = sigs_w_close[:,2]
-    events[len(sigs_w_close):,1] = 2*sigs_w_close[:,1]
-    events[len(sigs_w_close):,2] = range(len(sigs_w_close))
+    def __init__(self, filename, context='', generation=0, callback=None):
+        self.filename = filename
+        self.context = context
+        self.generation = generation
+        self.callback = callback
     
-    #sort by when they occur
-    events = events[np.lexsort((events[:,2],events[:,0])),:].astype(int)
     
-    # keep track of individual additions to positions
-    # amounts = np.zeros((len(sigs_w_close),1))
+    def __call__(self, intermediate_result):
+        
+        self.generation += 1
+        
+        tmp_filename = self.filename + '.tmp.npz'
+        np.savez(tmp_filename, population=intermediate_result.population, 
+                 population_energies=intermediate_result.population_energies, 
+                 x=intermediate_result.x, fun=intermediate_result.fun, 
+                 generation=self.generation, context=self.context)
+        os.replace(tmp_filename, self.filename)
+        
+        if self.callback is not None:
+            return self.callback(intermediate_result)
     
     
-    if np.any(profits<0):
-        total_profits=0
-        total_profits_aft_tax=0
-        balance_ext = 0
-        positions = 0
-    else:
+    def load(self):
         
-        total_profits, sigs_w_close, balance_ext, positions, gains, losses, total_profits_aft_tax, skipped_signals = process_sigs(events, price_data, sigs_w_close, lev, lev_limit)
+        '''Saved state as a dict, or None if there isn't one for this 
+        context'''
         
+        if not os.path.isfile(self.filename):
+            return None
+        
+        data = np.load(self.filename)
+        
+        if str(data['context']) != self.context:
+            return None
+        
+        return {'population': data['population'], 
+                'population_energies': data['population_energies'], 
+                'x': data['x'], 
+                'fun': float(data['fun']), 
+                'generation': int(data['generation'])}
+
+
+def resumable_differential_evolution(objective, bounds, checkpoint_filename, context='', maxiter=1000, **de_settings):
+    
+    '''
+    differential_evolution that checkpoints itself after every generation 
+    (see DECheckpoint). If a checkpoint for the same context is found, the 
+    run carries on from the saved population, for whatever is left of 
+    maxiter. The saved population is evaluated again at the start, so 
+    objective should be a CachedObjective to get those values back for 
+    free. The checkpoint is removed once the run finishes. de_settings are 
+    passed on to differential_evolution (but init is replaced when resuming). 
+    A callback in de_settings is called after every checkpoint (see 
+    DECheckpoint), and has to take intermediate_result.
+    
+    bounds and de_settings are added to context, so a checkpoint saved with 
+    different ones is never resumed. maxiter isn't, so a run can be carried 
+    on with a different number of generations. Settings that are functions 
+    (like a custom strategy) are identified by their qualified name, and 
+    other objects that can't be compared between runs raise a ValueError.
+    
+    If objective is a CachedObjective, result.x is snapped to its quantum, 
+    so it's the vector result.fun was actually evaluated at.
+    '''
+    
+    from scipy.optimize import differential_evolution
+    
+    callback = de_settings.pop('callback', None)
+    
+    # disp doesn't change the run, so it's left out
+    settings = []
+    for name, value in sorted(de_settings.items()):
+        if name == 'disp':
+            continue
+        if isinstance(value, np.ndarray):
+            value = value.tolist()
+        elif callable(value):
+            value = str(getattr(value, '__module__', '')) + '.' + getattr(value, '__qualname__', type(value).__qualname__)
+        elif not isinstance(value, (int, float, str, bool, tuple, list, type(None))):
+            raise ValueError('setting ' + name + ' can\'t be identified between runs, so it can\'t be checkpointed')
+        settings.append((name, value))
+    
+    key = hashlib.sha1()
+    key.update(context.encode())
+    key.update(np.asarray(bounds, dtype='float64').tobytes())
+    key.update(repr(settings).encode())
+    
+    checkpoint = DECheckpoint(checkpoint_filename, key.hexdigest(), callback=callback)
+    
+    saved = checkpoint.load()
+    
+    if saved is not None:
+        checkpoint.generation = saved['generation']
+        de_settings['init'] = saved['population']
+        maxiter = max(1, maxiter - saved['generation'])
+    
+    result = differential_evolution(objective, bounds, maxiter=maxiter, callback=checkpoint, **de_settings)
+    
+    result.generations = checkpoint.generation
+    
+    if isinstance(objective, CachedObjective):
+        result.x = objective.snap(result.x)
     
-    if total_profits != 0:
-        print('profit BT: ' + str(round(total_profits,4)) + ', profit AT: ' + str(round(total_profits_aft_tax,4)) + ', params: [' + str(round(lev,8)) + ']')
+    if os.path.isfile(checkpoint_filename):
+        os.remove(checkpoint_filename)
     
-    return profits, total_profits, sigs_w_close, balance_ext, positions, gains, losses, total_profits_aft_tax
\ No newline at end of file
+    return result
@@ -0,0 +1,134 @@
+# -*- coding: utf-8 -*-
+"""
+Created on Sun Oct 17 10:05:21 2021
+
+Benchmark the main steps of the project on synthetic data, so changes can be 
+checked for speed and memory without the real price data or any downloads. 
+Each run is added to a JSON file and compared with the run before it.
+
+@author: sebas
+"""
+
+from all_functions import synthetic_candles, synthetic_signals, clean_historical_data, generate_inputs, valid_input_mask, split_into_blocks, run_signal_block, open_signal_buffer, compact_signals, calc_profit_simple, process_sigs, prepare_signals, calc_max_drawdown, prepared_signals_memo, run_benchmark_stage, benchmark_run_info, compare_benchmarks
+import numpy as np
+import os
+import json
+import shutil
+import tempfile
+
+
+sizes = [100000, 1000000, 5000000] # numbers of candles to run every benchmark for
+
+seed = 0 # same seed, same data
+
+fitlength = 720
+
+params = [0.05, 5] # lev, lev_limit for the backtests
+
+dense_max_candles = 1000000 # process_sigs (the dense version) is only run up to this many candles, since it's slow
+
+repeats = 1 # each stage is timed this many times, and the best time is kept
+
+measure_memory = True # also run each stage with tracemalloc to get its peak memory
+
+results_filename = 'benchmark_results.json' # every run is added to this file
+
+
+folder = tempfile.mkdtemp(prefix='benchmark_')
+
+run = benchmark_run_info()
+run['seed'] = seed
+run['results'] = []
+
+try:
+    
+    for n in sizes:
+        
+        # ---------- price data ----------
+        raw_filename = os.path.join(folder, 'raw.npy')
+        np.save(raw_filename, synthetic_candles(n, seed=seed))
+        
+        record, data = run_benchmark_stage('clean_historical_data', n, lambda: clean_historical_data(raw_filename), repeats, measure_memory)
+        run['results'].append(record)
+        
+        # time, close like in generate_signals.py, and time, low, high, close for the backtests
+        data_signals = np.ascontiguousarray(data[:,[0,4]])
+        data_comp = np.ascontiguousarray(data[:,[0,1,2,4]])
+        del data
+        
+        
+        # ---------- signal generation ----------
+        record, inputs = run_benchmark_stage('generate_inputs', n, lambda: generate_inputs(data_signals, fitlength, 0, n-1), repeats, measure_memory)
+        run['results'].append(record)
+        
+        def signal_pipeline():
+            np.random.seed(seed)
+            valid_inputs = valid_input_mask(data_signals, fitlength)
+            inputs = np.nonzero(valid_inputs)[0]
+            signal_buffer = open_signal_buffer(os.path.join(folder, 'buffer.npy'), n)
+            for block_start, block_end in split_into_blocks(inputs, 64):
+                run_signal_block(data_signals, block_start, block_end, fitlength, out=signal_buffer)
+            signals = compact_signals(signal_buffer)
+            del signal_buffer
+            return signals
+        
+        record, signals = run_benchmark_stage('signal_pipeline', n, signal_pipeline, repeats, measure_memory)
+        record['n_signals'] = len(signals)
+        run['results'].append(record)
+        
+        
+        # ---------- backtests ----------
+        signals = synthetic_signals(n, seed=seed)
+        
+        def prepare():
+            prepared_signals_memo.clear() # otherwise every run after the first just gets it from memory
+            return prepare_signals(signals, data_comp)
+        
+        record, prepared = run_benchmark_stage('prepare_signals', n, prepare, repeats, measure_memory)
+        record['n_signals'] = len(signals)
+        run['results'].append(record)
+        
+        for stage, kwargs in [('calc_profit_simple', {'sparse': True}),
+                              ('calc_profit_simple_compressed', {'compressed': True}),
+                              ('calc_profit_simple_totals', {'expand': False})]:
+            record, outputs = run_benchmark_stage(stage, n, lambda: calc_profit_simple(prepared, data_comp, params[0], params[1], **kwargs), repeats, measure_memory)
+            record['n_signals'] = len(signals)
+            record['total_profits'] = float(outputs[1])
+            run['results'].append(record)
+            
+            if stage == 'calc_profit_simple':
+                balance_ext = outputs[3]
+        
+        if n <= dense_max_candles:
+            record, outputs = run_benchmark_stage('process_sigs', n, lambda: process_sigs(prepared.events, data_comp, prepared.sigs_w_close, params[0], params[1], 0.0), repeats, measure_memory)
+            record['n_signals'] = len(signals)
+            run['results'].append(record)
+        
+        record, outputs = run_benchmark_stage('calc_max_drawdown', n, lambda: calc_max_drawdown(balance_ext), repeats, measure_memory)
+        run['results'].append(record)
+        
+        del data_signals, data_comp, balance_ext
+
+finally:
+    shutil.rmtree(folder, ignore_errors=True)
+
+
+for record in run['results']:
+    print(record['stage'] + ' (' + str(record['n_candles']) + '): ' + str(round(record['seconds'], 4)) + ' s' + (', peak memory ' + str(round(record['peak_memory_mb'], 1)) + ' MB' if 'peak_memory_mb' in record else ''))
+
+
+# add this run to the results file, and compare it with the previous one
+runs = []
+if os.path.isfile(results_filename):
+    with open(results_filename) as f:
+        runs = json.load(f)
+
+if len(runs) > 0:
+    print('\ncompared to ' + str(runs[-1]['version']) + ' (' + runs[-1]['date'] + '):')
+    for line in compare_benchmarks(runs[-1], run):
+        print(line)
+
+runs.append(run)
+
+with open(results_filename, 'w') as f:
+    json.dump(runs, f, indent=1)
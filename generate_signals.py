@@ -12,7 +12,7 @@ from joblib import Parallel, delayed
 import numpy as np
 import os
 import math
-from all_functions import signal_generator_function, generate_inputs, merge_signals
+from all_functions import signal_generator_batch, valid_input_mask, load_candle_store, split_into_blocks, run_signal_block, ExampleStreamingGenerator, SignalStore, open_signal_buffer, signal_records, compact_signals
 
 
 
@@ -22,10 +22,9 @@ imp_step = 60
 # Length (in candles) of data chunk to be input into the signal generator function each time it is run
 fitlength = 720
 
-# Import historical data
-data_comp = np.load('BTC-USD_historical_data_' + str(int(imp_step/60)) + 'min_complete.npy')
-
-data_comp = data_comp[:,[0,4]] # Keep only the times and close prices
+# Import historical data. Only the times and close prices are needed, and 
+# they're memory-mapped from the candle store rather than read into memory
+data_comp = load_candle_store('BTC-USD_historical_data_' + str(int(imp_step/60)) + 'min_complete', columns=('time', 'close'))
 
 
 ''' Because some signal generators can take some time to run, I break up 
@@ -42,44 +41,63 @@ start = time.time() # I like to time things
 
 num_cores=16 # Number of CPU cores to use for running the code in parallel
 
+blocks_per_core = 4 # The inputs of each subsection are split into this many blocks per core
+
+# Streaming signal generators are fed one candle at a time and keep their own 
+# rolling state, so each subsection is just replayed through them in order 
+# (in this process) instead of running the batched generator in parallel
+streaming = False
+streaming_generator = ExampleStreamingGenerator(fitlength)
+
+# Indices where the signal generator function should be run (i.e., not in or 
+# just after long flat sections), found for the whole data set at once
+valid_inputs = valid_input_mask(data_comp, fitlength)
+
+folder = 'signals_flen' + str(fitlength) # Folder to save the generated signals in
+
+# Each finished subsection is appended to the signal store, and any range of 
+# signals can be loaded from it later, so there's no need to merge anything
+signal_store = SignalStore('Example_signal_A/' + folder)
+
 for i in range_starts:
     
-    folder = 'signals_flen' + str(fitlength) # Folder to save the generated signals in
-    
-    if not os.path.isfile('Example_signal_A/' + folder + '/' + folder + '_range' + str(i) + '_' + str(i+range_length) + '.npy'): # Check if this subsection has already been completed
+    if not signal_store.has_range(i, i+range_length): # Check if this subsection has already been completed
         
         # Generate list of indices where the signal generator function will be run
-        inputs = generate_inputs(data_comp, fitlength, i, range_length)
-        
-        # Create a parallel pool to run the signal generator function at every index in "inputs"
-        processed_list = Parallel(n_jobs=num_cores)(delayed(signal_generator_function)(data_comp[j-fitlength:j,:]) for j in inputs)
-        
-        print(time.time()-start)
-        
-        np.save('Example_signal_A/test.npy',processed_list)
+        inputs = np.nonzero(valid_inputs[i:i+range_length])[0] + i
         
-        processed_list= np.load('Example_signal_A/test.npy',allow_pickle=True)
+        # The results of the subsection are written straight into this 
+        # memory-mapped buffer (one typed entry per index, see signal_dtype), 
+        # which starts out as all "no signal"
+        buffer_filename = 'Example_signal_A/' + folder + '/buffer.npy'
+        signal_buffer = open_signal_buffer(buffer_filename, range_length)
         
-        reduced_list = processed_list[processed_list!=None]
+        if streaming:
+            
+            processed_list = streaming_generator.replay(data_comp, i, i+range_length)
+            
+            processed_list[~valid_inputs[i:i+range_length],1] = 0
+            
+            first = max(0, i-fitlength)
+            signal_buffer[:] = signal_records(processed_list, data_comp[first:i+range_length,0], first)
         
-        np.save('Example_signal_A/test2.npy',reduced_list)
+        else:
+            
+            # Split the inputs into a few large blocks of consecutive indices per 
+            # core, and run the batched signal generator on each block in parallel. 
+            # data_comp is memory-mapped, so each worker just reopens the candle 
+            # store, and joblib reopens the buffer in each worker as well, so the 
+            # workers write their results directly into it
+            blocks = split_into_blocks(inputs, num_cores*blocks_per_core)
+            
+            Parallel(n_jobs=num_cores)(delayed(run_signal_block)(data_comp, block_start, block_end, fitlength, signal_generator_batch, signal_buffer, i) for block_start, block_end in blocks)
         
-        signals = np.zeros((len(reduced_list),2))
+        print(time.time()-start)
         
-        j = 0
+        # keep only the indices that gave a signal
+        signals = compact_signals(signal_buffer)
         
-        for row in reduced_list:
-            signals[j,:] = np.array(row)
-            signals[j,0] = np.where(data_comp[:,0]==signals[j,0])[0][0]
-            j+=1
+        signal_store.append(signals, i, i+range_length, fitlength) # signals can be dated up to fitlength candles before i
         
-        if not os.path.isdir('Example_signal_A/' + folder):
-            os.mkdir('Example_signal_A/' + folder)
-            
-        np.save('Example_signal_A/' + folder + '/' + folder + '_range' + str(i) + '_' + str(i+range_length) + '.npy', signals)
-
-
-start_subsection = 0
-end_subsection = math.floor(len(data_comp)/range_length)
-
-merge_signals(fitlength, range_length, start_subsection, end_subsection) #merge the subsection signals together
\ No newline at end of file
+        del signal_buffer
+        os.remove(buffer_filename)
@@ -7,11 +7,11 @@ Download and clean historical price data from Coinbase Pro servers
 @author: sebas
 """
 
-from datetime import datetime, timedelta
+from datetime import datetime
 from math import ceil
-import numpy as np
 import time
-from all_functions import dl_historical_data, clean_historical_data
+import os
+from all_functions import download_historical_data, clean_historical_data, save_candle_store, update_candle_store, update_candle_pyramid, pyramid_widths
 
 
 #------------------ IMPORT DATA ----------------------------------------------
@@ -30,59 +30,66 @@ trading_pair = 'BTC-USD'
 # Filename to store imported data
 filename = trading_pair + '_historical_data_' + str(int(imp_step/60)) + 'min_test.npy'
 
+# Folder of the cleaned candle store
+store_folder = trading_pair + '_historical_data_' + str(int(imp_step/60)) + 'min_complete'
+
+# If the candle store already exists, only download the candles after the 
+# last one stored and append them, instead of importing everything again
+update_only = True
+
+# Also build (or bring up to date) the wider candles from these ones, each as 
+# its own candle store, so the other scripts can use any of them by setting 
+# imp_step without downloading them separately
+build_pyramid = True
+
 # Number of candles to be downloaded
 N_steps = import_period*365*24*60*60/imp_step  
 
 start = time.time()
 
-# Coinbase servers return a maximum of 300 candles per request
-if N_steps <= 300:  # if <300 steps are needed, everything can be imported with one request
-    
-    # start and end time for the request
-    starttime = (datetime.now() - timedelta(seconds=imp_step*N_steps)).isoformat()
-    endtime = datetime.now().isoformat()
+if update_only and os.path.isdir(store_folder):
     
-    data = np.array(dl_historical_data(trading_pair, starttime, endtime, imp_step))
+    # Gaps are filled from the last stored candle onwards, so the new rows 
+    # join up with the old ones
+    added_rows = update_candle_store(store_folder, trading_pair, imp_step, max_workers=8, rate=5)
     
+    print(str(added_rows) + ' candles added after ' + "{:.2f}".format(time.time() - start) + ' s.')
+
 else:
     
+    # Coinbase servers return a maximum of 300 candles per request
     N_imports = ceil(N_steps/300) + 1  # number of requests needed to import all data
+    
+    # Requests are sent in parallel, but limited to a few per second overall to 
+    # avoid flooding Coinbase servers. If this crashes, rerunning it picks up 
+    # where it left off
     timenow = datetime.now()
     
-    for i in range(N_imports):
-        
-        # start and end time for the request
-        starttime = (timenow - timedelta(seconds=imp_step*300*(i+1))).isoformat()
-        endtime = (timenow - timedelta(seconds=imp_step*300*i)).isoformat()
-        
-        subdata = np.array(dl_historical_data(trading_pair, starttime, endtime, granularity=imp_step))
-        
-        if i == 0 and len(subdata)>0: # For first request, define data
-            data = subdata
-            
-        elif len(subdata)>0: # Otherwise, add to existing data
-            data = np.vstack((data, subdata))  # add data to total with each request
-            
-        time.sleep(0.6)  # pause between requests to avoid flooding Coinbase servers
-        
-        # Periodically report progress and save data imported so far
-        if (i>0) and i % 100 == 0:
-            np.save(filename,data)
-            
-            progress = 100*i/N_imports
-            prog_time = time.time()
-            print("{:.1f}".format(progress) + '% complete after ' + "{:.2f}".format(prog_time - start) + 
-                  ' s. Estimated time remaining: ' + 
-                  "{:.2f}".format((prog_time - start)*(100-progress)/progress) + ' s.')
-
-
-#------------------ FILL IN MISSING ROWS -------------------------------------
-
-# Coinbase apparently doesn't store candles with 0 volume, so this code fills 
-# in the missing candles which have OLHC all equal to the previous candle's 
-# close price, and 0 volume.
-
-data_comp = clean_historical_data(filename)
-
-np.save(trading_pair + '_historical_data_' + str(int(imp_step/60)) + 'min_complete.npy',data_comp)
+    data = download_historical_data(trading_pair, timenow, N_imports, imp_step, filename, max_workers=8, rate=5)
+    
+    print('Download complete after ' + "{:.2f}".format(time.time() - start) + ' s.')
+    
+    
+    #------------------ FILL IN MISSING ROWS -------------------------------------
+    
+    # Coinbase apparently doesn't store candles with 0 volume, so this code fills 
+    # in the missing candles which have OLHC all equal to the previous candle's 
+    # close price, and 0 volume.
+    
+    data_comp = clean_historical_data(filename)
+    
+    # Save as a columnar store (one file per column) that the other scripts can 
+    # memory-map, instead of loading the whole array into memory each time. Old 
+    # ..._complete.npy files can be converted with candle_store_from_npy
+    save_candle_store(data_comp, store_folder, trading_pair, imp_step)
 
+
+#------------------ WIDER CANDLES --------------------------------------------
+
+if build_pyramid:
+    
+    # Only the candles added since the last run are read to extend each level
+    added_rows = update_candle_pyramid(store_folder, pyramid_widths)
+    
+    for width in added_rows:
+        print(str(added_rows[width]) + ' ' + str(int(width/60)) + ' min candles added.')
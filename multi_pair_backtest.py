@@ -0,0 +1,86 @@
+# -*- coding: utf-8 -*-
+"""
+Created on Sun Oct 24 13:40:02 2021
+
+Backtest a trading strategy on several trading pairs at once, and combine 
+them into a portfolio.
+
+@author: sebas
+"""
+
+from all_functions import backtest_pairs, decimate_series, to_datetime64
+import time
+import matplotlib.pyplot as plt
+
+
+imp_step = 60
+
+fitlength = 60
+
+num_cores = 16 # Number of CPU cores to spread the pairs over. Set to 1 to run everything in this process
+
+trading_pairs = ['BTC-USD', 'ETH-USD', 'LTC-USD']
+
+best_params = {'BTC-USD': [0,0], 'ETH-USD': [0,0], 'LTC-USD': [0,0]} # lev, lev_limit for each pair
+
+weights = None # share of the starting capital for each pair, equal shares if None
+
+# Period to test (UTC). Can also be rows of the candle stores, but those
+# don't line up between pairs
+range_start = '2021-06-01'
+range_end = '2022-01-01'
+
+
+# Worker processes re-import this script on Windows, so everything that does
+# actual work has to be kept out of them
+if __name__ == '__main__':
+    
+    # Every pair has its own candle store and signal store (see
+    # historical_data_importer.py and generate_signals.py)
+    pairs = [{'name': trading_pair,
+              'store': trading_pair + '_historical_data_' + str(int(imp_step/60)) + 'min_complete',
+              'signals': 'Example_signal_A/' + trading_pair + '_signals_flen' + str(fitlength),
+              'lev': best_params[trading_pair][0],
+              'lev_limit': best_params[trading_pair][1],
+              'start': range_start,
+              'end': range_end} for trading_pair in trading_pairs]
+    
+    
+    start = time.time()
+    
+    result = backtest_pairs(pairs, weights, num_cores)
+    
+    print(time.time() - start)
+    
+    
+    for k in range(len(pairs)):
+        print(result.names[k] + ': profit BT: ' + str(round(result.total_profits[k],4)) + ', profit AT: ' + str(round(result.total_profits_aft_tax[k],4)))
+    
+    total_profits, total_profits_aft_tax = result.portfolio_profits()
+    
+    print('portfolio: profit BT: ' + str(round(total_profits,4)) + ', profit AT: ' + str(round(total_profits_aft_tax,4)))
+    
+    drawdowns = result.drawdowns()
+    
+    if len(drawdowns) > 0:
+        largest_drawdown, peak, trough = drawdowns.max()
+        print('max drawdown = ' + str(round(largest_drawdown*1000)/10) + '%')
+    
+    
+    # Plot the portfolio balance over time, and the balance of each pair
+    fig = plt.figure(figsize=(24,12))
+    ax = fig.gca()
+    
+    times, equity = decimate_series(result.times, result.equity)
+    plt.plot(to_datetime64(times), equity, color=(7/255, 172/255, 242/255), drawstyle='steps-post', label='portfolio')
+    
+    for k in range(len(pairs)):
+        times, balance = decimate_series(result.times, result.balances[:,k])
+        plt.plot(to_datetime64(times), balance, drawstyle='steps-post', alpha=0.5, label=result.names[k])
+    
+    if len(drawdowns) > 0:
+        plt.plot(to_datetime64(result.times[[peak, trough]]), result.equity[[peak, trough]], 'o', color=(12/255, 87/255, 168/255))
+    
+    plt.yscale('log')
+    
+    ax.legend()
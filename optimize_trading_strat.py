@@ -9,9 +9,7 @@ Optimize the profit trading algo for the price data + signals
 
 
 
-from scipy.optimize import curve_fit, differential_evolution, least_squares, dual_annealing, shgo, basinhopping, NonlinearConstraint, LinearConstraint
-from all_functions import calc_profit_simple
-import numpy as np
+from all_functions import calc_profit_simple, calc_profit_batch, load_price_range_index, prepare_signals, ParallelProfitFitter, load_candle_store, SignalStore, load_time_index, instrumentation
 import time
 
 imp_step = 60
@@ -20,23 +18,26 @@ fitlength = 60
 
 optimization_range_upper_limit = 2400000 #lower limit is just 0. I typically use around 75% of my historical data for training.
 
+optimization_end_date = None # or set the upper limit by date instead, e.g. '2021-06-01' (UTC)
 
-folder = 'signals_flen' + str(fitlength)
+num_cores = 16 # Number of CPU cores to spread each generation of the optimizer over. Set to 1 to run everything in this process
 
-data_comp = np.load('BTC-USD_historical_data_1min_complete.npy')
+optimizer = 'differential_evolution' # or 'successive_halving', which only backtests the most promising candidates over the whole range (see successive_halving in all_functions.py)
 
-data_comp = data_comp[:,[0,1,2,4]]
+successive_halving_settings = {'n_candidates': 243, 'eta': 3, 'min_fraction': 1/27} # candidates are cut down to 1/eta of them each time the range they're tested over grows eta times
 
+cache_objective = True # remember the profit of every (lev, lev_limit) tried (also on disk, for later runs), and checkpoint differential evolution after every generation so a run that dies carries on from there when restarted
 
-test_range = range(optimization_range_upper_limit+1)
-
-signals = np.load('Example_signal_A/' + folder + '/' + folder + '_range0_' + str(optimization_range_upper_limit) + '.npy')
+objective_quantum = [0.0001, 0.01] # lev and lev_limit are rounded to multiples of these, so near-duplicates are only backtested once
 
+instrument = False # collect timers and counters from the backtests (see Instrumentation in all_functions.py) and print a summary at the end
 
 
 def profit_fitter(x):
     
-    profits, total_profits, sigs_w_close, balance_ext, positions, gains, losses, total_profits_aft_tax = calc_profit_simple(signals, data_comp, x[0], x[1])
+    # The sparse kernel gives the same profits as process_sigs but much faster, 
+    # and there's no need to expand the balance over time since it isn't used here
+    profits, total_profits, sigs_w_close, balance_ext, positions, gains, losses, total_profits_aft_tax = calc_profit_simple(signals, data_comp, x[0], x[1], sparse=True, expand=False, range_index=range_index)
     
     # Minimize the negative profit. I don't always use this metric as my "cost function," but this is the simplest option
     to_minimize = -total_profits_aft_tax
@@ -44,30 +45,120 @@ def profit_fitter(x):
     return to_minimize
 
 
+def profit_fitter_batch(x):
+    
+    # With vectorized=True, differential_evolution passes the whole population 
+    # at once, with one parameter vector per column of x
+    total_profits, total_profits_aft_tax = calc_profit_batch(signals, data_comp, x.T, range_index=range_index)
+    
+    return -total_profits_aft_tax
 
 
-# Define bounds
-bounds = [(0.003, 0.2),(1,50)] # calc_profit_simple
-
-
-start = time.time()
-
-# I often use differential evolution because my cost function has a ton of local minima
-fit_coeffs = differential_evolution(profit_fitter, bounds, popsize=20, disp=True)
-
-
-# Alternative minimization algorithms
-
-# fit_coeffs = dual_annealing(profit_fitter, bounds, seed=1234)
-# fit_coeffs = shgo(profit_fitter, bounds, iters=1)
-# fit_coeffs = basinhopping(profit_fitter, [0.05, 0.05, 5])
-
-
-
-best_value = fit_coeffs.x
-best_profit = -fit_coeffs.fun
 
-print(time.time()-start)
 
-print(best_value)
-print(best_profit)
\ No newline at end of file
+# Worker processes for the parallel mode re-import this script on Windows, so 
+# everything that does actual work has to be kept out of them
+if __name__ == '__main__':
+    
+    folder = 'signals_flen' + str(fitlength)
+    
+    filename = 'BTC-USD_historical_data_1min_complete'
+    
+    # time, low, high and close, memory-mapped from the candle store
+    data_comp = load_candle_store(filename, columns=('time', 'low', 'high', 'close'))
+    
+    # min/max index over the lows and highs for fast liquidation checks (built once and cached next to the data file)
+    range_index = load_price_range_index(filename, data_comp)
+    
+    if optimization_end_date is not None:
+        optimization_range_upper_limit = load_time_index(data_comp, filename).rows_between(0, optimization_end_date)[1]
+    
+    
+    test_range = range(optimization_range_upper_limit+1)
+    
+    signals = SignalStore('Example_signal_A/' + folder).load(0, optimization_range_upper_limit)
+    
+    # Everything that doesn't depend on the parameters being optimized is done 
+    # once here (and saved, so later runs with the same signals can skip it)
+    signals = prepare_signals(signals, data_comp, cache_dir='Example_signal_A/' + folder)
+    
+    
+    
+    # Define bounds
+    bounds = [(0.003, 0.2),(1,50)] # calc_profit_simple
+    
+    
+    if instrument:
+        instrumentation.enable()
+    
+    start = time.time()
+    
+    # I often use differential evolution because my cost function has a ton of local minima. 
+    # With vectorized=True each generation is evaluated in a single batched backtest
+    # Only the functions of the chosen optimizer are imported
+    if optimizer == 'successive_halving':
+        
+        from all_functions import successive_halving
+        
+        # Runs in this process, since the candidates left are carried on from where they stopped
+        fit_coeffs = successive_halving(signals, data_comp, bounds, range_index=range_index, disp=True, **successive_halving_settings)
+        
+        print('candles backtested: ' + str(fit_coeffs.candles_backtested) + ' (' + str(round(fit_coeffs.candles_full/fit_coeffs.candles_backtested, 1)) + ' times fewer than testing every candidate over the full range)')
+    
+    elif cache_objective:
+        
+        from all_functions import objective_context, ObjectiveCache, CachedObjective, resumable_differential_evolution
+        
+        # Identifies the signals and price range, so values and checkpoints from other ones aren't used
+        context = objective_context(signals, data_comp, 'total_profits_aft_tax')
+        
+        fitter = ParallelProfitFitter(signals, data_comp, range_index, num_cores=num_cores) if num_cores > 1 else None
+        
+        try:
+            with ObjectiveCache('Example_signal_A/' + folder + '/objective_cache.sqlite') as cache:
+                
+                objective = CachedObjective(fitter if fitter is not None else profit_fitter_batch, cache, context, objective_quantum)
+                
+                fit_coeffs = resumable_differential_evolution(objective, bounds, 'Example_signal_A/' + folder + '/de_checkpoint.npz', context, popsize=20, disp=True, vectorized=True, updating='deferred')
+        finally:
+            if fitter is not None:
+                fitter.close()
+        
+        print('backtested ' + str(objective.misses) + ' parameter vectors, ' + str(objective.hits) + ' taken from the cache')
+    
+    elif num_cores > 1:
+        
+        from scipy.optimize import differential_evolution
+        
+        # The data and signals are memory-mapped by the worker processes instead of being copied to each of them
+        with ParallelProfitFitter(signals, data_comp, range_index, num_cores=num_cores) as fitter:
+            fit_coeffs = differential_evolution(fitter, bounds, popsize=20, disp=True, vectorized=True, updating='deferred')
+    
+    else:
+        from scipy.optimize import differential_evolution
+        fit_coeffs = differential_evolution(profit_fitter_batch, bounds, popsize=20, disp=True, vectorized=True, updating='deferred')
+    
+    # Same thing, but evaluating one parameter vector at a time
+    # fit_coeffs = differential_evolution(profit_fitter, bounds, popsize=20, disp=True)
+    
+    
+    # Alternative minimization algorithms (also in scipy.optimize)
+    
+    # fit_coeffs = dual_annealing(profit_fitter, bounds, seed=1234)
+    # fit_coeffs = shgo(profit_fitter, bounds, iters=1)
+    # fit_coeffs = basinhopping(profit_fitter, [0.05, 0.05, 5])
+    
+    
+    
+    best_value = fit_coeffs.x
+    best_profit = -fit_coeffs.fun
+    
+    print(time.time()-start)
+    
+    print(best_value)
+    print(best_profit)
+    
+    if instrument:
+        summary = instrumentation.collect()
+        print(summary['counters'])
+        print({stage: round(seconds, 2) for stage, seconds in summary['timers'].items()})
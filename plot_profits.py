@@ -8,26 +8,32 @@ and trading strategy.
 @author: sebas
 """
 
-from all_functions import calc_profit_simple, calc_max_drawdown
-import numpy as np
-from datetime import datetime
+from all_functions import calc_profit_simple, load_price_range_index, load_candle_store, SignalStore, load_time_index, plot_backtest
 import time
-import matplotlib.pyplot as plt
 
 
 imp_step = 60 # this is the timeframe to use
 
-data_comp = np.load('BTC-USD_historical_data_' + str(int(imp_step/60)) + 'min_complete.npy')
+filename = 'BTC-USD_historical_data_' + str(int(imp_step/60)) + 'min_complete'
 
-data_comp = data_comp[:,[0,1,2,4]] # 0=time, 1=low, 2=high, 3=open, 4=close, 5=volume
+data_comp = load_candle_store(filename, columns=('time', 'low', 'high', 'close')) # memory-mapped from the candle store
 
-dateconv = np.vectorize(datetime.fromtimestamp)
+range_index = load_price_range_index(filename, data_comp)
+
+time_index = load_time_index(data_comp, filename) # for picking the range by date and converting rows to datetime64 for the plots
 
 
 # ---------- input parameters for the signal generator ----------
 fitlength = 60
 range_start = 2400000
 range_end = 3100000
+
+# Alternatively, the range can be picked by date, e.g. ('2021-06-01', '2022-01-01') (UTC)
+range_dates = None
+
+if range_dates is not None:
+    range_start, range_end = time_index.rows_between(range_dates[0], range_dates[1])
+
 range_length = range_end-range_start
 
 best_params = [0,0] #input the parameters obtained during optimization for the given trading strategy and signal generator function
@@ -38,69 +44,34 @@ folder = 'signals_flen' + str(fitlength)
 test_range = range(range_start,range_start+range_length+1)
 plot_range = test_range
 
-signals = np.load('Example_signal_A/' + folder + '/' + folder + '_range' + str(test_range[0]) + '_' + str(test_range[-1]) + '.npy')
+signals = SignalStore('Example_signal_A/' + folder).load(range_start, range_end)
 
 
 
 start = time.time()
 
-profits, total_profits, sigs_w_close, balance_ext, positions, gains, losses, total_profits_aft_tax = calc_profit_simple(signals, data_comp, best_params[0], best_params[1])
+# The balance and positions are returned as change points, which plot_backtest 
+# can plot directly without ever expanding them to one row per minute
+profits, total_profits, sigs_w_close, balance_ext, positions, gains, losses, total_profits_aft_tax = calc_profit_simple(signals, data_comp, best_params[0], best_params[1], compressed=True, range_index=range_index)
 
 print(time.time() - start)
 
+print('profit BT: ' + str(round(total_profits,4)) + ', profit AT: ' + str(round(total_profits_aft_tax,4)))
 
-# Calculate the largest drawdown for the entire period, to be marked and labeled in the plot
-largest_drawdown, largest_drawdown_index, min_index = calc_max_drawdown(balance_ext)
-
-
-s = ['max drawdown = ' + str(round(largest_drawdown*1000)/10) + '%']
-
-# Plot
-fig = plt.figure(figsize=(24,12))
-ax = fig.gca()
-
-#plot account balance over time
-plt.plot(dateconv(data_comp[balance_ext[:,0].astype(int),0]),data_comp[balance_ext[:,0].astype(int),3]/data_comp[balance_ext[0,0].astype(int),3], color=(12/255, 87/255, 168/255))
-
-#plot the price data
-plt.plot(dateconv(data_comp[balance_ext[:,0].astype(int),0]), balance_ext[:,1], color=(7/255, 172/255, 242/255))
-
-
-#plot the signal opens and closes
-if len(sigs_w_close[sigs_w_close[:,1]==1,0])>0:
-    plt.plot(dateconv(data_comp[sigs_w_close[sigs_w_close[:,1]==1,0].astype(int),0]),data_comp[sigs_w_close[sigs_w_close[:,1]==1,0].astype(int),3]/data_comp[balance_ext[0,0].astype(int),3],'o', color=(8/255, 196/255, 27/255))
-    plt.plot(dateconv(data_comp[sigs_w_close[sigs_w_close[:,1]==1,2].astype(int),0]),data_comp[sigs_w_close[sigs_w_close[:,1]==1,2].astype(int),3]/data_comp[balance_ext[0,0].astype(int),3],'x', color=(8/255, 196/255, 27/255))
-
-if len(sigs_w_close[sigs_w_close[:,1]==-1,0])>0:
-    plt.plot(dateconv(data_comp[sigs_w_close[sigs_w_close[:,1]==-1,0].astype(int),0]),data_comp[sigs_w_close[sigs_w_close[:,1]==-1,0].astype(int),3]/data_comp[balance_ext[0,0].astype(int),3],'ro')
-    plt.plot(dateconv(data_comp[sigs_w_close[sigs_w_close[:,1]==-1,2].astype(int),0]),data_comp[sigs_w_close[sigs_w_close[:,1]==-1,2].astype(int),3]/data_comp[balance_ext[0,0].astype(int),3],'rx')
-
-#mark the largest drawdown for the plotted period
-dd = plt.plot(dateconv(data_comp[balance_ext[[largest_drawdown_index,min_index],0].astype(int),0]),balance_ext[[largest_drawdown_index,min_index],1], 'o', color=(12/255, 87/255, 168/255))
-
-plt.yscale('log')
-
-yrange = ax.get_ylim()
 
-ax.legend(dd, s)
+# Plot the account balance and price over time, with the signal opens/closes 
+# and the largest drawdowns (top_drawdowns of them) marked and labeled. 
+# Every line is cut down to about n_points points that keep its peaks and 
+# dips, so plotting takes about the same time for any range length
+top_drawdowns = 1
 
+n_points = 2000
 
+# Can also add a second plot to study other metrics for a given trading 
+# strategy (long/short leverage over time)
+show_leverage = False
 
-# Can create a second plot to study other metrics for a given trading strategy (long/short leverage over time, long/short average entry price spread)
+fig = plot_backtest(data_comp, balance_ext, sigs_w_close, positions if show_leverage else None, 
+                    top_drawdowns=top_drawdowns, n_points=n_points, time_index=time_index)
 
-if False:
-    fig = plt.figure(figsize=(24,12))
-    ax = fig.gca()
-    
-    if True:
-        plt.plot(dateconv(data_comp[balance_ext[:,0].astype(int),0]), positions[:,0]/balance_ext[:,1], label='long leverage')
-        plt.plot(dateconv(data_comp[balance_ext[:,0].astype(int),0]), positions[:,1]/balance_ext[:,1], label='short leverage')
-        plt.plot(dateconv(data_comp[balance_ext[:,0].astype(int),0]), positions[:,2]/balance_ext[:,1], label='net leverage')
-        plt.plot(dateconv(data_comp[balance_ext[:,0].astype(int),0]), positions[:,3]/balance_ext[:,1], label='total leverage')
-    
-    if False:
-        plt.plot(dateconv(data_comp[balance_ext[:,0].astype(int),0]), (positions[:,5]-positions[:,4])/data_comp[int(signals[0,0]):,3], label='long/short entry spread')
-        plt.ylim(-0.02,0.02)
-        # plt.plot(dateconv(data_comp[balance_ext[:,0].astype(int),0]), positions[:,1]/balance_ext[:,1], label='short leverage')
-    
-    ax.legend()
+yrange = fig.axes[0].get_ylim()
@@ -0,0 +1,72 @@
+# -*- coding: utf-8 -*-
+"""
+Created on Sat Oct  9 16:12:40 2021
+
+Walk-forward optimization of the trading strategy: optimize on a training 
+window, test the result on the window right after it, move forward and 
+repeat. The out-of-sample results of all the test windows are stitched 
+together and plotted.
+
+@author: sebas
+"""
+
+from all_functions import load_candle_store, load_price_range_index, load_time_index, SignalStore, walk_forward_windows, walk_forward, plot_backtest
+import numpy as np
+import time
+
+
+imp_step = 60
+
+fitlength = 60
+
+num_cores = 16 # Number of CPU cores to spread the windows over. Set to 1 to run everything in this process
+
+# Window schedule (in candles). Each window is trained on train_length
+# candles and tested on the test_length candles after them
+range_start = 0
+range_end = 3100000
+train_length = 1000000
+test_length = 100000
+step = test_length # how far each window moves forward
+anchored = False # if True, every training window starts at range_start
+
+bounds = [(0.003, 0.2),(1,50)] # calc_profit_simple
+
+de_settings = {'popsize': 20} # passed on to differential_evolution
+
+
+# Worker processes re-import this script on Windows, so everything that does
+# actual work has to be kept out of them
+if __name__ == '__main__':
+    
+    folder = 'signals_flen' + str(fitlength)
+    
+    filename = 'BTC-USD_historical_data_' + str(int(imp_step/60)) + 'min_complete'
+    
+    # time, low, high and close, memory-mapped from the candle store
+    data_comp = load_candle_store(filename, columns=('time', 'low', 'high', 'close'))
+    
+    range_index = load_price_range_index(filename, data_comp)
+    
+    time_index = load_time_index(data_comp, filename)
+    
+    signals = SignalStore('Example_signal_A/' + folder).load(range_start, range_end)
+    
+    windows = walk_forward_windows(range_start, range_end, train_length, test_length, step, anchored)
+    
+    
+    start = time.time()
+    
+    result = walk_forward(signals, data_comp, windows, bounds, range_index, num_cores=num_cores, cache_dir='Example_signal_A/' + folder, **de_settings)
+    
+    print(time.time()-start)
+    
+    
+    for k in range(len(windows)):
+        print(str(time_index.datetimes(windows[k][2])) + ': params ' + str(np.round(result.params[k], 4)) + ', train profit AT: ' + str(round(result.train_profits[k], 4)) + ', test profit AT: ' + str(round(result.test_profits_aft_tax[k], 4)))
+    
+    total_profits, total_profits_aft_tax = result.total_profits()
+    
+    print('out-of-sample profit BT: ' + str(round(total_profits, 4)) + ', profit AT: ' + str(round(total_profits_aft_tax, 4)))
+    
+    fig = plot_backtest(data_comp, result.equity, time_index=time_index)